@@ -0,0 +1,1094 @@
+/* A CPython extension module over the C code in consensus.c, seqtools.c, and swalign.c.
+ * This does the same work as the ctypes wrappers in consensus.py, seqtools.py, and swalign.py, but
+ * without their per-call overhead: sequences can be given as str (ASCII), bytes, or any other
+ * object supporting the buffer protocol, and they're passed to the C code without being copied.
+ * The GIL is released while the C code runs, so several threads can compute at once.
+ * Results are returned as bytes.
+ * Build it with "make ext". It links against the shared libraries built by "make local".
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+// From consensus.c
+#define N_BASES 6
+char *rm_gaps_buf(char *consensus, int cons_len, char *output);
+char *build_consensus_duplex_simple_buf(char *cons1, char *cons2, int gapped, char *cons);
+char *get_consensus_buf(char *align[], char *quals[], int n_seqs, int seq_len, double cons_thres,
+                        int min_reads, char qual_thres, int gapped, char *consensus);
+char *get_consensus_duplex_buf(char *align1[], char *align2[], char *quals1[], char *quals2[],
+                               int n_seqs1, int n_seqs2, int seq_len, double cons_thres,
+                               int min_reads, char qual_thres, int gapped, char *method,
+                               char *consensus);
+int fill_gap_quals_batch(char *quals[], int seq_lens[], int n_seqs, char *output[]);
+
+// From seqtools.c
+char *get_revcomp(char *input);
+double *get_diffs_frac_simple(char *cons, char *seqs[], int n_seqs);
+double **get_diffs_frac_binned(char *cons, char *seqs[], int n_seqs, int seq_len, int bins);
+char *transfer_gaps(char *gapped_seq, char *inseq, char gap_char1, char gap_char2);
+
+// From swalign.c (these must match the structs in swalign.h).
+typedef struct {
+  char *a;
+  unsigned int alen;
+  char *b;
+  unsigned int blen;
+} seq_pair_t;
+
+typedef struct {
+  seq_pair_t *seqs;
+  int start_a;
+  int start_b;
+  int end_a;
+  int end_b;
+  int matches;
+  double score;
+} align_t;
+
+align_t *smith_waterman(seq_pair_t *problem, int local);
+align_t *smith_waterman_banded(seq_pair_t *problem, int local, int band);
+void destroy_align(align_t *align);
+double smith_waterman_score(seq_pair_t *problem);
+void smith_waterman_batch(seq_pair_t *problems, unsigned int n, int local, int band,
+                          unsigned int threads, align_t **aligns);
+void smith_waterman_score_batch(seq_pair_t *problems, unsigned int n, unsigned int threads,
+                                double *scores);
+
+
+/* Converting arguments:
+ * A cstr_t holds a string argument. "str" points into the Python object itself when possible:
+ * the UTF-8 representation of a str (which, for ASCII, is the string's own data), the contents of a
+ * bytes object, or the memory exposed by another buffer-protocol object. Only when the C function
+ * needs a null-terminated string and the buffer doesn't provide one is a copy made.
+ * A new reference to the object is held until release_cstr(), so it can't be freed (e.g. by another
+ * thread modifying the list it came from) while the GIL is released.
+ */
+typedef struct {
+  PyObject *obj;
+  Py_buffer view;
+  int has_view;
+  char *copy;
+  char *str;
+  Py_ssize_t len;
+} cstr_t;
+
+typedef struct {
+  Py_ssize_t n;
+  cstr_t *items;
+  char **strs;
+} cstrs_t;
+
+
+static int get_cstr(PyObject *obj, cstr_t *cstr, int need_nul) {
+  memset(cstr, 0, sizeof(cstr_t));
+  if (PyUnicode_Check(obj)) {
+    const char *str = PyUnicode_AsUTF8AndSize(obj, &cstr->len);
+    if (str == NULL) {
+      return 0;
+    }
+    cstr->str = (char *)str;
+  } else if (PyBytes_Check(obj)) {
+    cstr->str = PyBytes_AS_STRING(obj);
+    cstr->len = PyBytes_GET_SIZE(obj);
+  } else {
+    if (PyObject_GetBuffer(obj, &cstr->view, PyBUF_SIMPLE) == -1) {
+      return 0;
+    }
+    cstr->has_view = 1;
+    cstr->str = cstr->view.buf;
+    cstr->len = cstr->view.len;
+    if (need_nul) {
+      cstr->copy = PyMem_Malloc(cstr->len + 1);
+      if (cstr->copy == NULL) {
+        PyBuffer_Release(&cstr->view);
+        PyErr_NoMemory();
+        return 0;
+      }
+      memcpy(cstr->copy, cstr->str, cstr->len);
+      cstr->copy[cstr->len] = '\0';
+      cstr->str = cstr->copy;
+    }
+  }
+  if (cstr->len > INT_MAX) {
+    if (cstr->has_view) {
+      PyBuffer_Release(&cstr->view);
+    }
+    PyMem_Free(cstr->copy);
+    PyErr_SetString(PyExc_ValueError, "Sequence too long.");
+    return 0;
+  }
+  Py_INCREF(obj);
+  cstr->obj = obj;
+  return 1;
+}
+
+
+static void release_cstr(cstr_t *cstr) {
+  if (cstr->obj == NULL) {
+    return;
+  }
+  if (cstr->has_view) {
+    PyBuffer_Release(&cstr->view);
+  }
+  PyMem_Free(cstr->copy);
+  Py_CLEAR(cstr->obj);
+}
+
+
+// Convert a sequence of strings into an array of char pointers. None or an empty sequence gives an
+// empty array (with "strs" set to NULL).
+static int get_cstrs(PyObject *seq, cstrs_t *cstrs, int need_nul) {
+  cstrs->n = 0;
+  cstrs->items = NULL;
+  cstrs->strs = NULL;
+  if (seq == NULL || seq == Py_None) {
+    return 1;
+  }
+  if (PyUnicode_Check(seq) || PyBytes_Check(seq)) {
+    PyErr_SetString(PyExc_TypeError, "Expected a sequence of strings, not a single string.");
+    return 0;
+  }
+  PyObject *fast = PySequence_Fast(seq, "Expected a sequence of strings.");
+  if (fast == NULL) {
+    return 0;
+  }
+  Py_ssize_t n = PySequence_Fast_GET_SIZE(fast);
+  if (n == 0) {
+    Py_DECREF(fast);
+    return 1;
+  }
+  cstrs->items = PyMem_Calloc(n, sizeof(cstr_t));
+  cstrs->strs = PyMem_Malloc(n * sizeof(char *));
+  if (cstrs->items == NULL || cstrs->strs == NULL) {
+    PyMem_Free(cstrs->items);
+    PyMem_Free(cstrs->strs);
+    Py_DECREF(fast);
+    PyErr_NoMemory();
+    return 0;
+  }
+  Py_ssize_t i;
+  for (i = 0; i < n; i++) {
+    if (!get_cstr(PySequence_Fast_GET_ITEM(fast, i), &cstrs->items[i], need_nul)) {
+      cstrs->n = i;
+      Py_DECREF(fast);
+      return 0;
+    }
+    cstrs->strs[i] = cstrs->items[i].str;
+  }
+  cstrs->n = n;
+  Py_DECREF(fast);
+  return 1;
+}
+
+
+static void release_cstrs(cstrs_t *cstrs) {
+  Py_ssize_t i;
+  for (i = 0; i < cstrs->n; i++) {
+    release_cstr(&cstrs->items[i]);
+  }
+  PyMem_Free(cstrs->items);
+  PyMem_Free(cstrs->strs);
+  cstrs->n = 0;
+  cstrs->items = NULL;
+  cstrs->strs = NULL;
+}
+
+
+// Check that all the strings in the arrays have the same length, and return it (or -1 on error).
+// Arrays that are empty are skipped.
+static Py_ssize_t get_common_len(cstrs_t *arrays[], int n_arrays) {
+  Py_ssize_t seq_len = -2;
+  int a;
+  Py_ssize_t i;
+  for (a = 0; a < n_arrays; a++) {
+    for (i = 0; i < arrays[a]->n; i++) {
+      if (seq_len == -2) {
+        seq_len = arrays[a]->items[i].len;
+      } else if (arrays[a]->items[i].len != seq_len) {
+        PyErr_Format(PyExc_ValueError, "All sequences and quals lines in the alignment must be the "
+                     "same length: %zdbp != %zdbp.", seq_len, arrays[a]->items[i].len);
+        return -1;
+      }
+    }
+  }
+  if (seq_len == -2) {
+    return 0;
+  }
+  return seq_len;
+}
+
+
+// Allocate a bytes object for a result of at most "len" chars. The C code can write into it (with
+// the GIL released, since no other code can see it yet), and finish_bytes() will then trim it to
+// the length of the null-terminated string inside.
+static PyObject *new_bytes(Py_ssize_t len, char **buf) {
+  PyObject *bytes = PyBytes_FromStringAndSize(NULL, len);
+  if (bytes != NULL) {
+    *buf = PyBytes_AS_STRING(bytes);
+    (*buf)[0] = '\0';
+  }
+  return bytes;
+}
+
+
+static PyObject *finish_bytes(PyObject *bytes) {
+  Py_ssize_t len = strlen(PyBytes_AS_STRING(bytes));
+  if (len != PyBytes_GET_SIZE(bytes)) {
+    if (_PyBytes_Resize(&bytes, len) == -1) {
+      return NULL;
+    }
+  }
+  return bytes;
+}
+
+
+/***** consensus.c *****/
+
+typedef struct {
+  cstrs_t align;
+  cstrs_t quals;
+  Py_ssize_t seq_len;
+  PyObject *result;
+  char *buf;
+} family_t;
+
+
+static void release_family(family_t *family) {
+  release_cstrs(&family->align);
+  release_cstrs(&family->quals);
+  Py_CLEAR(family->result);
+}
+
+
+// Convert the (align, quals) arguments of a family and allocate its result.
+static int get_family(PyObject *align_obj, PyObject *quals_obj, family_t *family) {
+  memset(family, 0, sizeof(family_t));
+  if (!get_cstrs(align_obj, &family->align, 0) || !get_cstrs(quals_obj, &family->quals, 0)) {
+    return 0;
+  }
+  if (family->quals.n && family->quals.n != family->align.n) {
+    PyErr_SetString(PyExc_ValueError, "Different number of sequences and quals.");
+    return 0;
+  }
+  cstrs_t *arrays[2] = {&family->align, &family->quals};
+  family->seq_len = get_common_len(arrays, 2);
+  if (family->seq_len < 0) {
+    return 0;
+  }
+  family->result = new_bytes(family->seq_len, &family->buf);
+  return family->result != NULL;
+}
+
+
+static void compute_family(family_t *family, double cons_thres, int min_reads, char qual_thres,
+                           int gapped) {
+  if (family->align.n == 0) {
+    return;
+  }
+  get_consensus_buf(family->align.strs, family->quals.strs, family->align.n, family->seq_len,
+                    cons_thres, min_reads, qual_thres, gapped, family->buf);
+}
+
+
+PyDoc_STRVAR(get_consensus_doc,
+"get_consensus(align, quals=None, cons_thres=-1.0, min_reads=0, qual_thres=32, gapped=False)\n"
+"Make the consensus of a list of aligned sequences, like consensus.get_consensus().\n"
+"qual_thres is the ASCII value of the threshold quality score.");
+
+static PyObject *py_get_consensus(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"align", "quals", "cons_thres", "min_reads", "qual_thres", "gapped",
+                           NULL};
+  PyObject *align_obj;
+  PyObject *quals_obj = Py_None;
+  double cons_thres = -1.0;
+  int min_reads = 0;
+  int qual_thres = ' ';
+  int gapped = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|Odiip", kwlist, &align_obj, &quals_obj,
+                                   &cons_thres, &min_reads, &qual_thres, &gapped)) {
+    return NULL;
+  }
+  family_t family;
+  if (!get_family(align_obj, quals_obj, &family)) {
+    release_family(&family);
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  compute_family(&family, cons_thres, min_reads, (char)qual_thres, gapped);
+  Py_END_ALLOW_THREADS
+  PyObject *result = finish_bytes(family.result);
+  family.result = NULL;
+  release_family(&family);
+  return result;
+}
+
+
+PyDoc_STRVAR(get_consensuses_doc,
+"get_consensuses(families, cons_thres=-1.0, min_reads=0, qual_thres=32, gapped=False)\n"
+"Make the consensus of each of a list of families, in one call.\n"
+"families is a sequence of (align, quals) pairs, as in get_consensus(). Returns a list of the\n"
+"consensus sequences.");
+
+static PyObject *py_get_consensuses(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"families", "cons_thres", "min_reads", "qual_thres", "gapped", NULL};
+  PyObject *families_obj;
+  double cons_thres = -1.0;
+  int min_reads = 0;
+  int qual_thres = ' ';
+  int gapped = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|diip", kwlist, &families_obj, &cons_thres,
+                                   &min_reads, &qual_thres, &gapped)) {
+    return NULL;
+  }
+  PyObject *fast = PySequence_Fast(families_obj, "families must be a sequence.");
+  if (fast == NULL) {
+    return NULL;
+  }
+  Py_ssize_t n_families = PySequence_Fast_GET_SIZE(fast);
+  family_t *families = PyMem_Calloc(n_families ? n_families : 1, sizeof(family_t));
+  if (families == NULL) {
+    Py_DECREF(fast);
+    return PyErr_NoMemory();
+  }
+  PyObject *results = NULL;
+  Py_ssize_t i;
+  for (i = 0; i < n_families; i++) {
+    PyObject *align_obj, *quals_obj = Py_None;
+    if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(fast, i), "O|O;families must be (align, quals)",
+                          &align_obj, &quals_obj)) {
+      goto done;
+    }
+    if (!get_family(align_obj, quals_obj, &families[i])) {
+      goto done;
+    }
+  }
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < n_families; i++) {
+    compute_family(&families[i], cons_thres, min_reads, (char)qual_thres, gapped);
+  }
+  Py_END_ALLOW_THREADS
+  results = PyList_New(n_families);
+  if (results == NULL) {
+    goto done;
+  }
+  for (i = 0; i < n_families; i++) {
+    PyObject *result = finish_bytes(families[i].result);
+    families[i].result = NULL;
+    if (result == NULL) {
+      Py_CLEAR(results);
+      goto done;
+    }
+    PyList_SET_ITEM(results, i, result);
+  }
+  done:
+  for (i = 0; i < n_families; i++) {
+    release_family(&families[i]);
+  }
+  PyMem_Free(families);
+  Py_DECREF(fast);
+  return results;
+}
+
+
+PyDoc_STRVAR(get_consensus_duplex_doc,
+"get_consensus_duplex(align1, align2, quals1=None, quals2=None, cons_thres=-1.0, min_reads=0,\n"
+"                     qual_thres=32, gapped=False, method='iupac')\n"
+"Make a duplex consensus from two alignments, like consensus.get_consensus_duplex().");
+
+static PyObject *py_get_consensus_duplex(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"align1", "align2", "quals1", "quals2", "cons_thres", "min_reads",
+                           "qual_thres", "gapped", "method", NULL};
+  PyObject *align1_obj, *align2_obj;
+  PyObject *quals1_obj = Py_None;
+  PyObject *quals2_obj = Py_None;
+  double cons_thres = -1.0;
+  int min_reads = 0;
+  int qual_thres = ' ';
+  int gapped = 0;
+  const char *method = "iupac";
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|OOdiips", kwlist, &align1_obj, &align2_obj,
+                                   &quals1_obj, &quals2_obj, &cons_thres, &min_reads, &qual_thres,
+                                   &gapped, &method)) {
+    return NULL;
+  }
+  if (strcmp(method, "iupac") && strcmp(method, "freq")) {
+    return PyErr_Format(PyExc_ValueError, "Invalid method \"%s\".", method);
+  }
+  cstrs_t align1, align2, quals1, quals2;
+  cstrs_t *arrays[4] = {&align1, &align2, &quals1, &quals2};
+  memset(arrays[0], 0, sizeof(cstrs_t));
+  memset(arrays[1], 0, sizeof(cstrs_t));
+  memset(arrays[2], 0, sizeof(cstrs_t));
+  memset(arrays[3], 0, sizeof(cstrs_t));
+  PyObject *result = NULL;
+  char *buf;
+  if (!get_cstrs(align1_obj, &align1, 0) || !get_cstrs(align2_obj, &align2, 0) ||
+      !get_cstrs(quals1_obj, &quals1, 0) || !get_cstrs(quals2_obj, &quals2, 0)) {
+    goto done;
+  }
+  if ((quals1.n && quals1.n != align1.n) || (quals2.n && quals2.n != align2.n)) {
+    PyErr_SetString(PyExc_ValueError, "Different number of sequences and quals.");
+    goto done;
+  }
+  Py_ssize_t seq_len = get_common_len(arrays, 4);
+  if (seq_len < 0) {
+    goto done;
+  }
+  result = new_bytes(seq_len, &buf);
+  if (result == NULL) {
+    goto done;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  get_consensus_duplex_buf(align1.strs, align2.strs, quals1.strs, quals2.strs, align1.n, align2.n,
+                           seq_len, cons_thres, min_reads, (char)qual_thres, gapped, (char *)method,
+                           buf);
+  Py_END_ALLOW_THREADS
+  result = finish_bytes(result);
+  done:
+  release_cstrs(&align1);
+  release_cstrs(&align2);
+  release_cstrs(&quals1);
+  release_cstrs(&quals2);
+  return result;
+}
+
+
+PyDoc_STRVAR(build_consensus_duplex_simple_doc,
+"build_consensus_duplex_simple(cons1, cons2, gapped=False)\n"
+"Combine two consensus sequences of equal length using IUPAC ambiguity codes.");
+
+static PyObject *py_build_consensus_duplex_simple(PyObject *self, PyObject *args,
+                                                  PyObject *kwargs) {
+  static char *kwlist[] = {"cons1", "cons2", "gapped", NULL};
+  PyObject *cons1_obj, *cons2_obj;
+  int gapped = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|p", kwlist, &cons1_obj, &cons2_obj,
+                                   &gapped)) {
+    return NULL;
+  }
+  cstr_t cons1, cons2;
+  memset(&cons2, 0, sizeof(cstr_t));
+  PyObject *result = NULL;
+  char *buf;
+  if (!get_cstr(cons1_obj, &cons1, 1) || !get_cstr(cons2_obj, &cons2, 1)) {
+    goto done;
+  }
+  if (cons1.len != cons2.len) {
+    PyErr_Format(PyExc_ValueError, "Consensus sequences have different lengths (%zd != %zd).",
+                 cons1.len, cons2.len);
+    goto done;
+  }
+  result = new_bytes(cons1.len, &buf);
+  if (result == NULL) {
+    goto done;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  build_consensus_duplex_simple_buf(cons1.str, cons2.str, gapped, buf);
+  Py_END_ALLOW_THREADS
+  result = finish_bytes(result);
+  done:
+  release_cstr(&cons1);
+  release_cstr(&cons2);
+  return result;
+}
+
+
+PyDoc_STRVAR(rm_gaps_doc,
+"rm_gaps(seq)\n"
+"Remove the '-' characters from a sequence.");
+
+static PyObject *py_rm_gaps(PyObject *self, PyObject *seq_obj) {
+  cstr_t seq;
+  if (!get_cstr(seq_obj, &seq, 0)) {
+    return NULL;
+  }
+  char *buf;
+  PyObject *result = new_bytes(seq.len, &buf);
+  if (result != NULL) {
+    rm_gaps_buf(seq.str, seq.len, buf);
+    result = finish_bytes(result);
+  }
+  release_cstr(&seq);
+  return result;
+}
+
+
+PyDoc_STRVAR(fill_gap_quals_doc,
+"fill_gap_quals(quals)\n"
+"Replace the gaps (spaces) in each of a list of quality score strings with a score averaged from\n"
+"the ones around it, like consensus.fill_gap_quals(). Returns a list of the filled-in strings.");
+
+static PyObject *py_fill_gap_quals(PyObject *self, PyObject *quals_obj) {
+  cstrs_t quals;
+  if (!get_cstrs(quals_obj, &quals, 0)) {
+    release_cstrs(&quals);
+    return NULL;
+  }
+  PyObject *results = PyList_New(quals.n);
+  int *seq_lens = PyMem_Malloc((quals.n ? quals.n : 1) * sizeof(int));
+  char **outputs = PyMem_Calloc(quals.n ? quals.n : 1, sizeof(char *));
+  Py_ssize_t i;
+  if (results == NULL || seq_lens == NULL || outputs == NULL) {
+    if (results != NULL) {
+      PyErr_NoMemory();
+    }
+    Py_CLEAR(results);
+    goto done;
+  }
+  for (i = 0; i < quals.n; i++) {
+    seq_lens[i] = quals.items[i].len;
+    PyObject *result = new_bytes(quals.items[i].len, &outputs[i]);
+    if (result == NULL) {
+      Py_CLEAR(results);
+      goto done;
+    }
+    PyList_SET_ITEM(results, i, result);
+  }
+  int failed;
+  Py_BEGIN_ALLOW_THREADS
+  failed = fill_gap_quals_batch(quals.strs, seq_lens, quals.n, outputs);
+  Py_END_ALLOW_THREADS
+  if (failed != -1) {
+    PyErr_Format(PyExc_ValueError, "No gap quality score could be obtained for %R.",
+                 quals.items[failed].obj);
+    Py_CLEAR(results);
+  }
+  done:
+  PyMem_Free(seq_lens);
+  PyMem_Free(outputs);
+  release_cstrs(&quals);
+  return results;
+}
+
+
+/***** seqtools.c *****/
+
+PyDoc_STRVAR(get_revcomp_doc,
+"get_revcomp(seq)\n"
+"Return the reverse complement of a sequence.");
+
+static PyObject *py_get_revcomp(PyObject *self, PyObject *seq_obj) {
+  cstr_t seq;
+  if (!get_cstr(seq_obj, &seq, 1)) {
+    return NULL;
+  }
+  char *revcomp;
+  Py_BEGIN_ALLOW_THREADS
+  revcomp = get_revcomp(seq.str);
+  Py_END_ALLOW_THREADS
+  release_cstr(&seq);
+  PyObject *result = PyBytes_FromString(revcomp);
+  free(revcomp);
+  return result;
+}
+
+
+static int get_gap_char(PyObject *obj, char *gap_char) {
+  cstr_t cstr;
+  if (!get_cstr(obj, &cstr, 0)) {
+    return 0;
+  }
+  if (cstr.len != 1) {
+    release_cstr(&cstr);
+    PyErr_SetString(PyExc_ValueError, "Gap characters must be a single character.");
+    return 0;
+  }
+  *gap_char = cstr.str[0];
+  release_cstr(&cstr);
+  return 1;
+}
+
+
+PyDoc_STRVAR(transfer_gaps_multi_doc,
+"transfer_gaps_multi(seqs, aligned, gap_char_in='-', gap_char_out='-')\n"
+"Insert gaps into each sequence in seqs according to the corresponding sequence in aligned.\n"
+"Returns a list of the gapped sequences.");
+
+static PyObject *py_transfer_gaps_multi(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"seqs", "aligned", "gap_char_in", "gap_char_out", NULL};
+  PyObject *seqs_obj, *aligned_obj;
+  PyObject *gap_char_in_obj = NULL;
+  PyObject *gap_char_out_obj = NULL;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|OO", kwlist, &seqs_obj, &aligned_obj,
+                                   &gap_char_in_obj, &gap_char_out_obj)) {
+    return NULL;
+  }
+  char gap_char_in = '-';
+  char gap_char_out = '-';
+  if ((gap_char_in_obj && !get_gap_char(gap_char_in_obj, &gap_char_in)) ||
+      (gap_char_out_obj && !get_gap_char(gap_char_out_obj, &gap_char_out))) {
+    return NULL;
+  }
+  cstrs_t seqs, aligned;
+  memset(&aligned, 0, sizeof(cstrs_t));
+  PyObject *results = NULL;
+  char **outseqs = NULL;
+  Py_ssize_t i;
+  if (!get_cstrs(seqs_obj, &seqs, 1) || !get_cstrs(aligned_obj, &aligned, 1)) {
+    goto done;
+  }
+  if (seqs.n != aligned.n) {
+    PyErr_Format(PyExc_ValueError, "Unequal number of gapped and ungapped sequences (%zd vs %zd "
+                 "sequences, respectively)", aligned.n, seqs.n);
+    goto done;
+  }
+  for (i = 0; i < seqs.n; i++) {
+    Py_ssize_t ungapped_len = 0;
+    Py_ssize_t j;
+    for (j = 0; j < aligned.items[i].len; j++) {
+      if (aligned.strs[i][j] != gap_char_in) {
+        ungapped_len++;
+      }
+    }
+    if (ungapped_len > seqs.items[i].len) {
+      PyErr_Format(PyExc_ValueError, "Sequence %zd is shorter than its aligned version (%zdbp < "
+                   "%zdbp).", i, seqs.items[i].len, ungapped_len);
+      goto done;
+    }
+  }
+  outseqs = PyMem_Calloc(seqs.n ? seqs.n : 1, sizeof(char *));
+  if (outseqs == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < seqs.n; i++) {
+    outseqs[i] = transfer_gaps(aligned.strs[i], seqs.strs[i], gap_char_in, gap_char_out);
+  }
+  Py_END_ALLOW_THREADS
+  results = PyList_New(seqs.n);
+  for (i = 0; results != NULL && i < seqs.n; i++) {
+    PyObject *result = PyBytes_FromString(outseqs[i]);
+    if (result == NULL) {
+      Py_CLEAR(results);
+    } else {
+      PyList_SET_ITEM(results, i, result);
+    }
+  }
+  done:
+  if (outseqs != NULL) {
+    for (i = 0; i < seqs.n; i++) {
+      free(outseqs[i]);
+    }
+    PyMem_Free(outseqs);
+  }
+  release_cstrs(&seqs);
+  release_cstrs(&aligned);
+  return results;
+}
+
+
+// get_diffs_frac_simple() and get_diffs_frac_binned() uppercase the consensus in place, so they
+// get a copy.
+static char *copy_cstr(cstr_t *cstr) {
+  char *copy = PyMem_Malloc(cstr->len + 1);
+  if (copy == NULL) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  memcpy(copy, cstr->str, cstr->len);
+  copy[cstr->len] = '\0';
+  return copy;
+}
+
+
+PyDoc_STRVAR(get_diffs_frac_simple_doc,
+"get_diffs_frac_simple(consensus, family)\n"
+"Return a tuple of the fraction of positions at which each sequence differs from the consensus.");
+
+static PyObject *py_get_diffs_frac_simple(PyObject *self, PyObject *args) {
+  PyObject *cons_obj, *family_obj;
+  if (!PyArg_ParseTuple(args, "OO", &cons_obj, &family_obj)) {
+    return NULL;
+  }
+  cstr_t cons;
+  cstrs_t family;
+  memset(&family, 0, sizeof(cstrs_t));
+  PyObject *result = NULL;
+  char *cons_copy = NULL;
+  if (!get_cstr(cons_obj, &cons, 0) || !get_cstrs(family_obj, &family, 1)) {
+    goto done;
+  }
+  cons_copy = copy_cstr(&cons);
+  if (cons_copy == NULL) {
+    goto done;
+  }
+  double *fracs;
+  Py_BEGIN_ALLOW_THREADS
+  fracs = get_diffs_frac_simple(cons_copy, family.strs, family.n);
+  Py_END_ALLOW_THREADS
+  result = PyTuple_New(family.n);
+  Py_ssize_t i;
+  for (i = 0; result != NULL && i < family.n; i++) {
+    PyObject *frac = PyFloat_FromDouble(fracs[i]);
+    if (frac == NULL) {
+      Py_CLEAR(result);
+    } else {
+      PyTuple_SET_ITEM(result, i, frac);
+    }
+  }
+  free(fracs);
+  done:
+  PyMem_Free(cons_copy);
+  release_cstr(&cons);
+  release_cstrs(&family);
+  return result;
+}
+
+
+PyDoc_STRVAR(get_diffs_frac_binned_doc,
+"get_diffs_frac_binned(consensus, family, bins)\n"
+"Like get_diffs_frac_simple(), but tally the differences separately in each of \"bins\" bins\n"
+"along the sequences. Returns a list of tuples, or None if the sequences aren't all the same\n"
+"length.");
+
+static PyObject *py_get_diffs_frac_binned(PyObject *self, PyObject *args) {
+  PyObject *cons_obj, *family_obj;
+  int bins;
+  if (!PyArg_ParseTuple(args, "OOi", &cons_obj, &family_obj, &bins)) {
+    return NULL;
+  }
+  if (bins <= 0) {
+    PyErr_SetString(PyExc_ValueError, "bins must be greater than zero.");
+    return NULL;
+  }
+  cstr_t cons;
+  cstrs_t family;
+  memset(&family, 0, sizeof(cstrs_t));
+  PyObject *result = NULL;
+  char *cons_copy = NULL;
+  if (!get_cstr(cons_obj, &cons, 0) || !get_cstrs(family_obj, &family, 1)) {
+    goto done;
+  }
+  cstrs_t *arrays[1] = {&family};
+  Py_ssize_t seq_len = get_common_len(arrays, 1);
+  if (seq_len < 0) {
+    PyErr_Clear();
+    result = Py_None;
+    Py_INCREF(result);
+    goto done;
+  }
+  cons_copy = copy_cstr(&cons);
+  if (cons_copy == NULL) {
+    goto done;
+  }
+  double **fracs;
+  Py_BEGIN_ALLOW_THREADS
+  fracs = get_diffs_frac_binned(cons_copy, family.strs, family.n, seq_len, bins);
+  Py_END_ALLOW_THREADS
+  result = PyList_New(family.n);
+  Py_ssize_t i;
+  int bin;
+  for (i = 0; i < family.n; i++) {
+    PyObject *seq_fracs = result ? PyTuple_New(bins) : NULL;
+    for (bin = 0; seq_fracs != NULL && bin < bins; bin++) {
+      PyObject *frac = PyFloat_FromDouble(fracs[i][bin]);
+      if (frac == NULL) {
+        Py_CLEAR(seq_fracs);
+      } else {
+        PyTuple_SET_ITEM(seq_fracs, bin, frac);
+      }
+    }
+    if (seq_fracs == NULL) {
+      Py_CLEAR(result);
+    } else {
+      PyList_SET_ITEM(result, i, seq_fracs);
+    }
+    free(fracs[i]);
+  }
+  free(fracs);
+  done:
+  PyMem_Free(cons_copy);
+  release_cstr(&cons);
+  release_cstrs(&family);
+  return result;
+}
+
+
+/***** swalign.c *****/
+
+// Convert an alignment to a tuple, and free it.
+static PyObject *align_to_tuple(align_t *align) {
+  PyObject *result = Py_BuildValue("(yyiiiiid)", align->seqs->a, align->seqs->b, align->start_a,
+                                   align->start_b, align->end_a, align->end_b, align->matches,
+                                   align->score);
+  destroy_align(align);
+  return result;
+}
+
+
+// A "band" of -1 means to compute the full matrix. Otherwise, see smith_waterman_banded().
+static align_t *align_pair(seq_pair_t *pair, int local, int band) {
+  if (band < 0) {
+    return smith_waterman(pair, local);
+  } else {
+    return smith_waterman_banded(pair, local, band);
+  }
+}
+
+
+static void init_seq_pair(seq_pair_t *pair, cstr_t *target, cstr_t *query) {
+  pair->a = target->str;
+  pair->alen = target->len;
+  pair->b = query->str;
+  pair->blen = query->len;
+}
+
+
+PyDoc_STRVAR(smith_waterman_doc,
+"smith_waterman(target, query, local=True, band=-1)\n"
+"Align query to target. Returns a tuple of (aligned target, aligned query, start_target,\n"
+"start_query, end_target, end_query, matches, score), as in swalign.Align.\n"
+"A band of -1 computes the full matrix, 0 chooses a band automatically, and a positive number\n"
+"only computes the cells within that distance of the diagonal.");
+
+static PyObject *py_smith_waterman(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"target", "query", "local", "band", NULL};
+  PyObject *target_obj, *query_obj;
+  int local = 1;
+  int band = -1;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|pi", kwlist, &target_obj, &query_obj,
+                                   &local, &band)) {
+    return NULL;
+  }
+  cstr_t target, query;
+  if (!get_cstr(target_obj, &target, 0)) {
+    return NULL;
+  }
+  if (!get_cstr(query_obj, &query, 0)) {
+    release_cstr(&target);
+    return NULL;
+  }
+  seq_pair_t pair;
+  init_seq_pair(&pair, &target, &query);
+  align_t *align;
+  Py_BEGIN_ALLOW_THREADS
+  align = align_pair(&pair, local, band);
+  Py_END_ALLOW_THREADS
+  release_cstr(&target);
+  release_cstr(&query);
+  return align_to_tuple(align);
+}
+
+
+PyDoc_STRVAR(smith_waterman_score_doc,
+"smith_waterman_score(target, query)\n"
+"Return the score smith_waterman() would give the alignment of query to target, without doing\n"
+"the traceback.");
+
+static PyObject *py_smith_waterman_score(PyObject *self, PyObject *args) {
+  PyObject *target_obj, *query_obj;
+  if (!PyArg_ParseTuple(args, "OO", &target_obj, &query_obj)) {
+    return NULL;
+  }
+  cstr_t target, query;
+  if (!get_cstr(target_obj, &target, 0)) {
+    return NULL;
+  }
+  if (!get_cstr(query_obj, &query, 0)) {
+    release_cstr(&target);
+    return NULL;
+  }
+  seq_pair_t pair;
+  init_seq_pair(&pair, &target, &query);
+  double score;
+  Py_BEGIN_ALLOW_THREADS
+  score = smith_waterman_score(&pair);
+  Py_END_ALLOW_THREADS
+  release_cstr(&target);
+  release_cstr(&query);
+  return PyFloat_FromDouble(score);
+}
+
+
+// Convert lists of targets and queries into an array of pairs. Returns NULL on error.
+static seq_pair_t *get_seq_pairs(PyObject *targets_obj, PyObject *queries_obj, cstrs_t *targets,
+                                 cstrs_t *queries) {
+  if (!get_cstrs(targets_obj, targets, 0)) {
+    return NULL;
+  }
+  if (!get_cstrs(queries_obj, queries, 0)) {
+    release_cstrs(targets);
+    return NULL;
+  }
+  if (targets->n != queries->n || targets->n > UINT_MAX) {
+    PyErr_Format(PyExc_ValueError, "Got %zd targets but %zd queries.", targets->n, queries->n);
+    release_cstrs(targets);
+    release_cstrs(queries);
+    return NULL;
+  }
+  seq_pair_t *pairs = PyMem_Calloc(targets->n ? targets->n : 1, sizeof(seq_pair_t));
+  if (pairs == NULL) {
+    release_cstrs(targets);
+    release_cstrs(queries);
+    PyErr_NoMemory();
+    return NULL;
+  }
+  Py_ssize_t i;
+  for (i = 0; i < targets->n; i++) {
+    init_seq_pair(&pairs[i], &targets->items[i], &queries->items[i]);
+  }
+  return pairs;
+}
+
+
+PyDoc_STRVAR(smith_waterman_batch_doc,
+"smith_waterman_batch(targets, queries, local=True, band=-1, threads=1)\n"
+"Align each query to the target at the same index, splitting the work between \"threads\" threads.\n"
+"Returns the results by column: a tuple of lists (aligned targets, aligned queries, start_targets,\n"
+"start_queries, end_targets, end_queries, matches, scores), each with one value per pair.");
+
+static PyObject *py_smith_waterman_batch(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"targets", "queries", "local", "band", "threads", NULL};
+  PyObject *targets_obj, *queries_obj;
+  int local = 1;
+  int band = -1;
+  int threads = 1;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|pii", kwlist, &targets_obj, &queries_obj,
+                                   &local, &band, &threads)) {
+    return NULL;
+  }
+  cstrs_t targets, queries;
+  seq_pair_t *pairs = get_seq_pairs(targets_obj, queries_obj, &targets, &queries);
+  if (pairs == NULL) {
+    return NULL;
+  }
+  Py_ssize_t n = targets.n;
+  align_t **aligns = PyMem_Calloc(n ? n : 1, sizeof(align_t *));
+  if (aligns == NULL) {
+    PyMem_Free(pairs);
+    release_cstrs(&targets);
+    release_cstrs(&queries);
+    return PyErr_NoMemory();
+  }
+  Py_BEGIN_ALLOW_THREADS
+  smith_waterman_batch(pairs, n, local, band, threads > 0 ? threads : 1, aligns);
+  Py_END_ALLOW_THREADS
+  PyMem_Free(pairs);
+  release_cstrs(&targets);
+  release_cstrs(&queries);
+  // Build the columns.
+  PyObject *columns = PyTuple_New(8);
+  Py_ssize_t c, i;
+  for (c = 0; columns != NULL && c < 8; c++) {
+    PyObject *column = PyList_New(n);
+    if (column == NULL) {
+      Py_CLEAR(columns);
+      break;
+    }
+    PyTuple_SET_ITEM(columns, c, column);
+  }
+  for (i = 0; columns != NULL && i < n; i++) {
+    align_t *align = aligns[i];
+    PyObject *values[8] = {
+      PyBytes_FromString(align->seqs->a), PyBytes_FromString(align->seqs->b),
+      PyLong_FromLong(align->start_a), PyLong_FromLong(align->start_b),
+      PyLong_FromLong(align->end_a), PyLong_FromLong(align->end_b),
+      PyLong_FromLong(align->matches), PyFloat_FromDouble(align->score)
+    };
+    for (c = 0; c < 8; c++) {
+      if (values[c] == NULL) {
+        Py_CLEAR(columns);
+      }
+      if (columns == NULL) {
+        Py_XDECREF(values[c]);
+      } else {
+        PyList_SET_ITEM(PyTuple_GET_ITEM(columns, c), i, values[c]);
+      }
+    }
+  }
+  for (i = 0; i < n; i++) {
+    destroy_align(aligns[i]);
+  }
+  PyMem_Free(aligns);
+  return columns;
+}
+
+
+PyDoc_STRVAR(smith_waterman_score_batch_doc,
+"smith_waterman_score_batch(targets, queries, threads=1)\n"
+"Return a list of the smith_waterman_score() of each query against the target at the same index,\n"
+"splitting the work between \"threads\" threads.");
+
+static PyObject *py_smith_waterman_score_batch(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"targets", "queries", "threads", NULL};
+  PyObject *targets_obj, *queries_obj;
+  int threads = 1;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|i", kwlist, &targets_obj, &queries_obj,
+                                   &threads)) {
+    return NULL;
+  }
+  cstrs_t targets, queries;
+  seq_pair_t *pairs = get_seq_pairs(targets_obj, queries_obj, &targets, &queries);
+  if (pairs == NULL) {
+    return NULL;
+  }
+  Py_ssize_t n = targets.n;
+  double *scores = PyMem_Calloc(n ? n : 1, sizeof(double));
+  PyObject *results = NULL;
+  if (scores == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  smith_waterman_score_batch(pairs, n, threads > 0 ? threads : 1, scores);
+  Py_END_ALLOW_THREADS
+  results = PyList_New(n);
+  Py_ssize_t i;
+  for (i = 0; results != NULL && i < n; i++) {
+    PyObject *score = PyFloat_FromDouble(scores[i]);
+    if (score == NULL) {
+      Py_CLEAR(results);
+    } else {
+      PyList_SET_ITEM(results, i, score);
+    }
+  }
+  done:
+  PyMem_Free(scores);
+  PyMem_Free(pairs);
+  release_cstrs(&targets);
+  release_cstrs(&queries);
+  return results;
+}
+
+
+static PyMethodDef methods[] = {
+  {"get_consensus", (PyCFunction)(void(*)(void))py_get_consensus, METH_VARARGS | METH_KEYWORDS,
+   get_consensus_doc},
+  {"get_consensuses", (PyCFunction)(void(*)(void))py_get_consensuses,
+   METH_VARARGS | METH_KEYWORDS, get_consensuses_doc},
+  {"get_consensus_duplex", (PyCFunction)(void(*)(void))py_get_consensus_duplex,
+   METH_VARARGS | METH_KEYWORDS, get_consensus_duplex_doc},
+  {"build_consensus_duplex_simple", (PyCFunction)(void(*)(void))py_build_consensus_duplex_simple,
+   METH_VARARGS | METH_KEYWORDS, build_consensus_duplex_simple_doc},
+  {"rm_gaps", py_rm_gaps, METH_O, rm_gaps_doc},
+  {"fill_gap_quals", py_fill_gap_quals, METH_O, fill_gap_quals_doc},
+  {"get_revcomp", py_get_revcomp, METH_O, get_revcomp_doc},
+  {"transfer_gaps_multi", (PyCFunction)(void(*)(void))py_transfer_gaps_multi,
+   METH_VARARGS | METH_KEYWORDS, transfer_gaps_multi_doc},
+  {"get_diffs_frac_simple", py_get_diffs_frac_simple, METH_VARARGS, get_diffs_frac_simple_doc},
+  {"get_diffs_frac_binned", py_get_diffs_frac_binned, METH_VARARGS, get_diffs_frac_binned_doc},
+  {"smith_waterman", (PyCFunction)(void(*)(void))py_smith_waterman, METH_VARARGS | METH_KEYWORDS,
+   smith_waterman_doc},
+  {"smith_waterman_score", py_smith_waterman_score, METH_VARARGS, smith_waterman_score_doc},
+  {"smith_waterman_batch", (PyCFunction)(void(*)(void))py_smith_waterman_batch,
+   METH_VARARGS | METH_KEYWORDS, smith_waterman_batch_doc},
+  {"smith_waterman_score_batch", (PyCFunction)(void(*)(void))py_smith_waterman_score_batch,
+   METH_VARARGS | METH_KEYWORDS, smith_waterman_score_batch_doc},
+  {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef module = {
+  PyModuleDef_HEAD_INIT,
+  "_dunovo",
+  "Fast, GIL-releasing bindings to the consensus, seqtools, and swalign C code.",
+  -1,
+  methods
+};
+
+
+PyMODINIT_FUNC PyInit__dunovo(void) {
+  return PyModule_Create(&module);
+}
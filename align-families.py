@@ -5,11 +5,18 @@ import time
 import logging
 import argparse
 import tempfile
+import heapq
+import json
+import signal
+import asyncio
 import resource
 import subprocess
 import collections
+import multiprocessing
 import distutils.spawn
 import parallel_tools
+import socket_executor
+import msa_cache
 import seqtools
 import shims
 # There can be problems with the submodules, but none are essential.
@@ -27,6 +34,8 @@ phone = shims.get_module_or_shim('ET.phone')
 USAGE = """$ %(prog)s [options] families.tsv > families.msa.tsv
        $ cat families.tsv | %(prog)s [options] > families.msa.tsv"""
 DESCRIPTION = """Read in sorted FASTQ data and do multiple sequence alignments of each family."""
+# The modules for a forkserver to import before starting the worker processes.
+PRELOAD_MODULES = ('__main__', 'parallel_tools', 'seqtools', 'msa_cache')
 
 def make_argparser():
 
@@ -50,6 +59,24 @@ def make_argparser():
               '8. read 2 quality scores'))
   parser.add_argument('-a', '--aligner', choices=('mafft', 'kalign', 'dummy'), default='kalign',
     help=wrap('The multiple sequence aligner to use. Default: %(default)s'))
+  parser.add_argument('-j', '--joint', action='store_true',
+    help=wrap('Align the two families which will make up each duplex consensus read together (the '
+              'ab reads from mate 1 with the ba reads from mate 2, and vice versa), instead of '
+              'aligning all 4 families separately. The output format is the same, but each pair '
+              'of families shares the same alignment columns. Use with "make-consensi.py --joint", '
+              'which can then build duplex consensus sequences without aligning the single-strand '
+              'consensus sequences to each other.'))
+  parser.add_argument('-t', '--timeout', type=float,
+    help=wrap('Give up on aligning a family with mafft after this many seconds and move on to the '
+              'next --fallback aligner. kalign runs inside the worker process and can\'t be '
+              'interrupted, so this only applies to mafft. Default: no timeout.'))
+  parser.add_argument('-f', '--fallback', choices=('mafft', 'kalign', 'dummy', 'none'),
+                      action='append',
+    help=wrap('If the --aligner times out or fails on a family, try this aligner instead. Give '
+              'this option multiple times to try several aligners, in order. If the last one '
+              'fails too, the family is left out of the output and counted as a failure. Give '
+              '"none" to never fall back. Default: kalign if the --aligner is mafft and there\'s '
+              'a --timeout, otherwise none.'))
   parser.add_argument('-I', '--no-check-ids', dest='check_ids', action='store_false', default=True,
     help='Don\'t check to make sure read pairs have identical ids. By default, if this '
          'encounters a pair of reads in families.tsv with ids that aren\'t identical (minus an '
@@ -58,10 +85,75 @@ def make_argparser():
     help=wrap('Number of worker subprocesses to use. If 0, no subprocesses will be started and '
               'everything will be done inside one process. Give "auto" to use as many processes '
               'as there are CPU cores. Default: %(default)s.'))
+  parser.add_argument('--async', dest='async_slots', metavar='N', type=int,
+    help=wrap('Instead of using worker --processes, run up to N mafft commands at once from this '
+              'single process, using asyncio. This gives the same parallelism as N worker '
+              'processes with much less memory. Only works with "--aligner mafft". --processes is '
+              'ignored. --queue-size is the number of duplexes in flight at once.'))
+  parser.add_argument('-w', '--worker', dest='workers', metavar='HOST:PORT', action='append',
+    help=wrap('Send the duplexes to a dunovo-worker.py listening at this address, instead of to '
+              'local worker --processes. Give this option multiple times to use several workers '
+              '(e.g. on several nodes of a cluster). The address can also be the path of a Unix '
+              'socket. TCP addresses require the {} environment variable. The workers need '
+              'access to the same aligners, and to the --cache, if given. See '
+              '"dunovo-worker.py --help".'.format(socket_executor.AUTHKEY_VAR)))
   parser.add_argument('--queue-size', type=int,
     help=wrap('How long to go accumulating responses from worker subprocesses before dealing '
               f'with all of them. Default: {parallel_tools.QUEUE_SIZE_MULTIPLIER} * the number of '
               'worker --processes.'))
+  parser.add_argument('--queue-mem', metavar='MB', type=float,
+    help=wrap('Also stop to deal with the responses from the workers whenever the duplexes waiting '
+              'on them add up to this many megabytes (estimated from the length of their reads). '
+              'This bounds the memory used by a mix of small and huge families, where --queue-size '
+              'alone can let a few huge ones pile up. Default: no limit.'))
+  parser.add_argument('--start-method', choices=multiprocessing.get_all_start_methods(),
+    help=wrap('How to start the worker --processes: the multiprocessing start method. With '
+              '"forkserver", a server process imports this script and the C libraries once, and '
+              'every worker is forked from it, already warmed up. Default: the platform default '
+              '("fork" on Linux).'))
+  parser.add_argument('--metrics', metavar='metrics.jsonl',
+    help=wrap('Periodically write statistics on the worker --processes to this file, as one JSON '
+              'object per line: the tasks in flight, how busy each worker was, how long this '
+              'process spent waiting on them, the pickled size of the tasks, and the results per '
+              'second. If this is an existing Unix socket, connect to it and write there instead. '
+              'See parallel_tools.PoolMetrics for the fields. Warning: Will overwrite the file.'))
+  parser.add_argument('--metrics-interval', metavar='SECONDS', type=float,
+    default=parallel_tools.METRICS_INTERVAL,
+    help=wrap('How often to write a --metrics record. Default: %(default)s'))
+  parser.add_argument('--max-retries', metavar='N', type=int, default=2,
+    help=wrap('If a worker process dies (e.g. it\'s killed for using too much memory, or the aligner '
+              'crashes it) or fails on a duplex, replace it and retry each duplex it was working on '
+              'on its own, up to N times. Default: %(default)s'))
+  parser.add_argument('--rejects', metavar='rejects.tsv', type=argparse.FileType('w'),
+    help=wrap('Write the duplexes which still fail after --max-retries to this file (in the same '
+              'format as the input) and carry on without them. Without this, the first one ends '
+              'the run with an error. Warning: Will overwrite the file.'))
+  parser.add_argument('--no-mmap', dest='mmap', action='store_false', default=True,
+    help=wrap('Always parse the input in the main process. By default, when using worker '
+              '--processes and the input is a regular file, the main process only scans for the '
+              'boundaries of each duplex and the workers read and parse their own duplexes from a '
+              'memory-mapped copy of the file.'))
+  parser.add_argument('--cache', metavar='alignments.db',
+    help=wrap('Cache alignments in this file and reuse them when the same family (the same '
+              'sequences in the same order) is aligned again with the same aligner. Useful when '
+              're-running on the same input. The file can be shared by concurrent runs.'))
+  parser.add_argument('--cache-size', metavar='MB', type=float, default=1024,
+    help=wrap('Maximum size of the --cache, in megabytes. Once it grows beyond this, the least '
+              'recently used alignments are removed. Default: %(default)s'))
+  parser.add_argument('--family-stats', metavar='family-stats.tsv', type=argparse.FileType('w'),
+    help=wrap('Write a record on the alignment of each family (each mate of each strand) to this '
+              'file. Columns: barcode, order, mate, number of reads, read length (longest read), '
+              'aligner which produced the alignment ("cache" if it was found in the --cache, "none" '
+              'if no alignment was needed or every aligner failed), seconds spent aligning, and '
+              'whether the alignment succeeded ("True" or "False"). Warning: Will overwrite the '
+              'file.'))
+  parser.add_argument('--family-stats-format', choices=('tsv', 'jsonl'), default='tsv',
+    help=wrap('Format of the --family-stats file. "jsonl" writes one JSON object per line. '
+              'Default: %(default)s'))
+  parser.add_argument('--slowest', metavar='N', type=int,
+    help=wrap('At the end, log a summary of alignment time by family size and the N families that '
+              'took the longest to align. Default: 10 if --family-stats is given, otherwise no '
+              'summary.'))
   parser.add_argument('--phone-home', action='store_true',
     help=wrap('Report helpful usage data to the developer, to better understand the use cases and '
               'performance of the tool. The only data which will be recorded is the name and '
@@ -105,8 +197,12 @@ def main(argv):
     data = {
       'stdin': args.infile is sys.stdin,
       'aligner': args.aligner,
+      'joint': args.joint,
       'processes': args.processes,
+      'async': args.async_slots,
       'queue_size': args.queue_size,
+      'start_method': args.start_method,
+      'workers': len(args.workers) if args.workers else 0,
     }
     if data['stdin']:
       data['input_size'] = None
@@ -119,21 +215,112 @@ def main(argv):
   try:
     if args.queue_size is not None and args.queue_size <= 0:
       fail('Error: --queue-size must be greater than zero.')
+    if args.queue_mem is not None and args.queue_mem <= 0:
+      fail('Error: --queue-mem must be greater than zero.')
 
     # If we're using mafft, check that we can execute it.
     if args.aligner == 'mafft' and not distutils.spawn.find_executable('mafft'):
       fail('Error: Could not find "mafft" command on $PATH.')
 
+    if args.async_slots is not None:
+      if args.async_slots <= 0:
+        fail('Error: --async must be greater than zero.')
+      if args.aligner != 'mafft':
+        fail('Error: --async only works with "--aligner mafft".')
+    if args.timeout is not None and args.timeout <= 0:
+      fail('Error: --timeout must be greater than zero.')
+    if args.workers and args.async_slots is not None:
+      fail('Error: --worker and --async cannot be used together.')
+    if args.metrics and args.async_slots is not None:
+      fail('Error: --metrics does not work with --async.')
+    if args.metrics_interval <= 0:
+      fail('Error: --metrics-interval must be greater than zero.')
+    if args.max_retries < 0:
+      fail('Error: --max-retries cannot be negative.')
+    if args.rejects and args.async_slots is not None:
+      fail('Error: --rejects does not work with --async.')
+    fallbacks = get_fallbacks(args.aligner, args.fallback, args.timeout)
+    if 'kalign' in fallbacks and not kalign_is_available():
+      if args.fallback is None:
+        logging.warning('Warning: Could not import the kalign module. Will not use a fallback '
+                        'aligner.')
+        fallbacks = ()
+      else:
+        fail('Error: Could not import the kalign module for --fallback.')
+    if 'mafft' in fallbacks and not distutils.spawn.find_executable('mafft'):
+      fail('Error: Could not find "mafft" command on $PATH.')
+
     # Open a pool of worker processes.
-    stats = {'duplexes':0, 'time':0, 'pairs':0, 'runs':0, 'failures':0, 'aligned_pairs':0}
-    pool = parallel_tools.SyncAsyncPool(
-      process_duplex, processes=args.processes, static_kwargs={'aligner':args.aligner},
-      queue_size=args.queue_size, callback=process_result, callback_args=[stats]
+    # If we can, let the workers parse their own duplexes straight from the input file.
+    # (Remote workers can't read our input file, though.)
+    use_mmap = (args.mmap and args.async_slots is None and str(args.processes) != '0' and
+                not args.workers and parallel_tools.is_mappable(args.infile))
+    stats = {
+      'duplexes':0, 'time':0, 'pairs':0, 'runs':0, 'failures':0, 'aligned_pairs':0, 'cache_hits':0,
+      'timeouts':0, 'fallbacks':0, 'rejects':0,
+    }
+    if args.slowest is None and args.family_stats:
+      args.slowest = 10
+    if args.family_stats or args.slowest:
+      telemetry = {'outfile':args.family_stats, 'format':args.family_stats_format,
+                   'bins':collections.defaultdict(lambda: [0, 0.0]), 'slowest':[],
+                   'max_slowest':args.slowest or 0}
+    else:
+      telemetry = None
+    static_kwargs = {
+      'aligner':args.aligner, 'fallbacks':fallbacks, 'timeout':args.timeout,
+      'family_stats':telemetry is not None, 'joint':args.joint,
+    }
+    if args.cache:
+      static_kwargs['cache_path'] = args.cache
+      static_kwargs['cache_size'] = int(args.cache_size*1024*1024)
+    pool_kwargs = {}
+    if args.async_slots is not None:
+      pool_class = parallel_tools.AsyncioPool
+      function = process_duplex_async
+      processes = args.async_slots
+    else:
+      pool_class = parallel_tools.SyncAsyncPool
+      processes = args.processes
+      pool_kwargs = {'start_method':args.start_method, 'preload':PRELOAD_MODULES,
+                     'max_retries':args.max_retries}
+      if args.rejects:
+        pool_kwargs['reject_callback'] = reject_duplex
+        pool_kwargs['reject_args'] = [args.rejects, stats]
+      if args.workers:
+        try:
+          pool_kwargs['executor'] = socket_executor.SocketExecutor(args.workers)
+        # An AssertionError means the worker didn't expect authentication (but we did).
+        except (OSError, ValueError, AssertionError, multiprocessing.AuthenticationError) as error:
+          fail(f'Error: Could not connect to --worker: {type(error).__name__}: {error}')
+      if args.metrics:
+        try:
+          pool_kwargs['metrics'] = parallel_tools.PoolMetrics.open(args.metrics,
+                                                                   interval=args.metrics_interval)
+        except OSError as error:
+          fail(f'Error: Could not open --metrics output {args.metrics!r}: {error}')
+      if use_mmap:
+        function = process_duplex_slice
+        static_kwargs['check_ids'] = args.check_ids
+      else:
+        function = process_duplex
+    if args.queue_mem is None:
+      max_bytes = None
+    else:
+      max_bytes = int(args.queue_mem*1024*1024)
+    pool = pool_class(
+      function, processes=processes, static_kwargs=static_kwargs,
+      queue_size=args.queue_size, callback=process_result, callback_args=[stats, telemetry],
+      max_bytes=max_bytes, task_sizer=parallel_tools.slice_task_size if use_mmap else None,
+      **pool_kwargs
     )
 
     try:
       # The main loop.
-      align_families(args.infile, pool, stats, check_ids=args.check_ids)
+      if use_mmap:
+        align_families_mmap(args.infile.name, pool, stats)
+      else:
+        align_families(args.infile, pool, stats, check_ids=args.check_ids)
     finally:
       # If an exception occurs in the parent without stopping the child processes, this will hang.
       # Make sure to kill the children in all cases.
@@ -142,6 +329,15 @@ def main(argv):
       # Close input filehandle if it's open.
       if args.infile is not sys.stdin:
         args.infile.close()
+      if args.family_stats:
+        args.family_stats.close()
+      if args.rejects:
+        args.rejects.close()
+
+    # Save any access times pending in this process (with -p 0), and make sure the cache ends the
+    # run within --cache-size, even if no insertion has taken it over (e.g. it's been lowered).
+    if args.cache:
+      msa_cache.open_cache(args.cache, max_size=static_kwargs['cache_size']).close()
 
     # Final stats on the run.
     run_time = int(time.time() - start_time)
@@ -150,11 +346,26 @@ def main(argv):
       'Processed {pairs} read pairs in {duplexes} duplexes, with {failures} alignment failures.'
       .format(**stats)
     )
+    if args.timeout is not None:
+      logging.error('{timeouts} alignments timed out and {fallbacks} families were aligned with a '
+                    'fallback aligner.'.format(**stats))
+    if args.cache:
+      logging.error(f'{stats["cache_hits"]} family alignments were found in the cache.')
+    if stats['rejects']:
+      logging.error(f'{stats["rejects"]} duplexes kept failing and were written to --rejects.')
     if stats['aligned_pairs'] > 0 and stats['runs'] > 0:
       per_pair = stats['time'] / stats['aligned_pairs']
       per_run = stats['time'] / stats['runs']
       logging.error(f'{per_pair:0.3f}s per pair, {per_run:0.3f}s per run.')
     logging.error(f'in {run_time}s total time and {max_mem:0.2f}MB RAM.')
+    if pool.time_to_first_result is not None:
+      logging.info(f'The first result was ready {pool.time_to_first_result:0.3f}s after starting '
+                   'the workers.')
+    if max_bytes is not None:
+      logging.info(f'At most {pool.max_inflight_bytes/1024/1024:0.2f}MB of duplexes were in flight '
+                   'at once.')
+    if telemetry and telemetry['max_slowest']:
+      log_telemetry_summary(telemetry)
 
   except (Exception, KeyboardInterrupt) as exception:
     if args.phone_home and call:
@@ -186,6 +397,29 @@ def main(argv):
     call.send_data('end', run_time=run_time, run_data=run_data)
 
 
+def get_fallbacks(aligner, fallback_args, timeout):
+  if fallback_args is None:
+    if aligner == 'mafft' and timeout is not None:
+      return ('kalign',)
+    else:
+      return ()
+  fallbacks = []
+  for fallback in fallback_args:
+    if fallback == 'none':
+      return ()
+    elif fallback != aligner and fallback not in fallbacks:
+      fallbacks.append(fallback)
+  return tuple(fallbacks)
+
+
+def kalign_is_available():
+  try:
+    from kalign import kalign
+  except ImportError:
+    return False
+  return True
+
+
 def get_max_mem():
   """Get the maximum memory usage (RSS) of this process and all its children, in MB."""
   maxrss_total  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -201,6 +435,8 @@ def get_run_data(stats, pool, aligner, max_mem=None):
     run_data['mem'] = max_mem
   run_data['processes'] = pool.processes
   run_data['queue_size'] = pool.queue_size
+  run_data['max_inflight_bytes'] = pool.max_inflight_bytes
+  run_data['time_to_first_result'] = pool.time_to_first_result
   run_data['aligner'] = aligner
   return run_data
 
@@ -208,7 +444,32 @@ def get_run_data(stats, pool, aligner, max_mem=None):
 def align_families(infile, pool, stats, check_ids=True):
   """The main loop.
   This processes whole duplexes (pairs of strands) at a time for a future option to align the
-  whole duplex at a time.
+  whole duplex at a time."""
+  for duplex, barcode in parse_duplexes(infile, stats, check_ids=check_ids):
+    # orders_str = '/'.join([str(len(duplex[o])) for o in duplex]
+    # logging.debug(f'processing {barcode}: {len(duplex)} orders ({orders_str})'
+    pool.compute(duplex, barcode)
+    stats['duplexes'] += 1
+  # Retrieve the remaining results.
+  logging.info('Flushing remaining results from worker processes..')
+  pool.flush()
+
+
+def align_families_mmap(path, pool, stats):
+  """The main loop, when workers parse their own input.
+  Only the barcode column is read here. Each worker gets the byte range of its duplex in the file
+  and parses it in process_duplex_slice()."""
+  for offset, length, barcode, num_lines in parallel_tools.scan_duplex_offsets(path, 8):
+    pool.compute(path, offset, length, barcode)
+    stats['duplexes'] += 1
+    stats['pairs'] += num_lines
+  logging.info('Flushing remaining results from worker processes..')
+  pool.flush()
+
+
+def parse_duplexes(lines, stats=None, check_ids=True):
+  """Parse lines from a families.tsv file and yield the reads in each duplex.
+  Yields a tuple for each duplex: (duplex, barcode).
   duplex data structure:
   duplex = {
     'ab': [
@@ -234,7 +495,7 @@ def align_families(infile, pool, stats, check_ids=True):
   family = []
   barcode = None
   order = None
-  for line in infile:
+  for line in lines:
     fields = line.rstrip('\r\n').split('\t')
     if len(fields) != 8:
       continue
@@ -248,27 +509,19 @@ def align_families(infile, pool, stats, check_ids=True):
       # If the barcode is different, we're at the end of the whole duplex. Process the it and start
       # a new one. If the barcode is the same, we're in the same duplex, but we've switched strands.
       if this_barcode != barcode:
-        # orders_str = '/'.join([str(len(duplex[o])) for o in duplex]
-        # logging.debug(f'processing {barcode}: {len(duplex)} orders ({orders_str})'
         if barcode is not None:
-          pool.compute(duplex, barcode)
-          stats['duplexes'] += 1
+          yield duplex, barcode
         duplex = collections.OrderedDict()
       barcode = this_barcode
       order = this_order
       family = []
     pair = {'name1': name1, 'seq1':seq1, 'qual1':qual1, 'name2':name2, 'seq2':seq2, 'qual2':qual2}
     family.append(pair)
-    stats['pairs'] += 1
+    if stats is not None:
+      stats['pairs'] += 1
   # Process the last family.
   duplex[order] = family
-  # orders_str = '/'.join([str(len(duplex[o])) for o in duplex]
-  # logging.debug(f'processing {barcode}: {len(duplex)} orders ({orders_str})'
-  pool.compute(duplex, barcode)
-  stats['duplexes'] += 1
-  # Retrieve the remaining results.
-  logging.info('Flushing remaining results from worker processes..')
-  pool.flush()
+  yield duplex, barcode
 
 
 def assert_read_ids_match(name1, name2):
@@ -289,66 +542,260 @@ def assert_read_ids_match(name1, name2):
     raise ValueError(f'Read names {name1!r} and {name2!r} do not match.')
 
 
-def process_duplex(duplex, barcode, aligner='mafft'):
-  output = ''
-  orders_str = '", "'.join(map(str, duplex.keys()))
-  logging.debug(f'Starting {barcode} (orders "{orders_str}")')
-  run_stats = {'time':0, 'runs':0, 'aligned_pairs':0, 'failures':0}
-  orders = tuple(duplex.keys())
-  if len(duplex) == 0 or None in duplex:
-    logging.warning(f'Empty duplex {barcode}.')
-    return '', {}
-  elif len(duplex) == 1:
-    # If there's only one strand in the duplex, just process the first mate, then the second.
-    combos = ((1, orders[0]), (2, orders[0]))
-  elif len(duplex) == 2:
-    # If there's two strands, process in a criss-cross order:
-    # strand1/mate1, strand2/mate2, strand1/mate2, strand2/mate1
-    combos = ((1, orders[0]), (2, orders[1]), (2, orders[0]), (1, orders[1]))
-  else:
-    raise AssertionError(f'More than 2 orders in duplex {barcode}: {orders}')
-  for mate, order in combos:
-    family = duplex[order]
+def process_duplex_slice(path, offset, length, barcode, check_ids=True, **kwargs):
+  """Read and parse one duplex from a byte range of the input file, then run process_duplex() on it.
+  NOTE: This must execute in the child process."""
+  lines = parallel_tools.read_slice(path, offset, length)
+  duplexes = list(parse_duplexes(lines, check_ids=check_ids))
+  assert len(duplexes) == 1, (barcode, [barcode for duplex, barcode in duplexes])
+  duplex, parsed_barcode = duplexes[0]
+  assert parsed_barcode == barcode, (barcode, parsed_barcode)
+  return process_duplex(duplex, barcode, **kwargs)
+
+
+def process_duplex(duplex, barcode, aligner='mafft', fallbacks=(), timeout=None, cache_path=None,
+                   cache_size=None, family_stats=False, joint=False, as_text=True):
+  """Align each family in the duplex.
+  If joint is True, align the families which will make up each duplex consensus read together
+  (ab.1 with ba.2, and ab.2 with ba.1), so their consensus sequences will share coordinates.
+  Returns the formatted alignments, the stats for the run, and, if family_stats is True, a list of
+  records on the alignment of each family (see make_family_record()).
+  If as_text is False, the alignments are returned unformatted, in the duplex structure used by
+  make-consensi.py: a dict mapping (order, mate) (with mate 0-indexed) to the list of aligned reads,
+  each a dict with the keys 'name', 'seq', and 'qual'."""
+  run = DuplexRun(duplex, barcode, aligner, cache_path, cache_size, family_stats, joint, as_text)
+  for unit in run.units:
+    family, mate = run.get_family(unit)
     start = time.time()
     try:
-      alignment = align_family(family, mate, aligner=aligner)
+      alignment, used_aligner = align_family(
+        family, mate, aligner=aligner, fallbacks=fallbacks, timeout=timeout, cache=run.cache,
+        run_stats=run.run_stats
+      )
     except AssertionError as error:
-      logging.exception(f'While processing duplex {barcode}, order {order}, mate {mate}:')
+      logging.exception(f'While processing duplex {barcode}, {run.format_unit(unit)}:')
       raise
     except (OSError, subprocess.CalledProcessError) as error:
-      logging.warning(
-        f'{type(error).__name__} on family {barcode}, order {order}, mate {mate}:\n{error}'
+      run.log_error(error, unit)
+      alignment = used_aligner = None
+    run.add_alignment(alignment, unit, time.time() - start, used_aligner)
+  return run.get_result()
+
+
+async def process_duplex_async(duplex, barcode, slots, aligner='mafft', fallbacks=(), timeout=None,
+                               cache_path=None, cache_size=None, family_stats=False, joint=False):
+  """Like process_duplex(), but run up to 4 mafft alignments on the duplex's families at once.
+  slots is an asyncio.Semaphore limiting how many mafft commands run at once (across all duplexes).
+  The time recorded for each family includes any time spent waiting for a slot."""
+  run = DuplexRun(duplex, barcode, aligner, cache_path, cache_size, family_stats, joint)
+  async def align(unit):
+    family, mate = run.get_family(unit)
+    start = time.time()
+    try:
+      alignment, used_aligner = await align_family_async(
+        family, mate, slots, aligner=aligner, fallbacks=fallbacks, timeout=timeout,
+        cache=run.cache, run_stats=run.run_stats
       )
-      alignment = None
+    except AssertionError as error:
+      logging.exception(f'While processing duplex {barcode}, {run.format_unit(unit)}:')
+      raise
+    except (OSError, subprocess.CalledProcessError) as error:
+      run.log_error(error, unit)
+      alignment = used_aligner = None
+    return alignment, time.time() - start, used_aligner
+  results = await asyncio.gather(*[align(unit) for unit in run.units])
+  # Tally the results in the same order process_duplex() would.
+  for unit, (alignment, elapsed, used_aligner) in zip(run.units, results):
+    run.add_alignment(alignment, unit, elapsed, used_aligner)
+  return run.get_result()
+
+
+class DuplexRun(object):
+  """Collects the output and stats from aligning the families in one duplex.
+  The families are aligned in "units", each a tuple of (mate, order) pairs identifying the families
+  to align together. Normally each unit is a single family, but in joint mode each is the two
+  families which will make up one duplex consensus read."""
+
+  def __init__(self, duplex, barcode, aligner, cache_path=None, cache_size=None,
+               family_stats=False, joint=False, as_text=True):
+    self.duplex = duplex
+    self.barcode = barcode
+    self.aligner = aligner
+    self.family_stats = family_stats
+    self.as_text = as_text
+    if as_text:
+      self.output = ''
+    else:
+      self.output = collections.OrderedDict()
+    self.family_records = []
+    orders_str = '", "'.join(map(str, duplex.keys()))
+    logging.debug(f'Starting {barcode} (orders "{orders_str}")')
+    self.run_stats = {
+      'time':0, 'runs':0, 'aligned_pairs':0, 'failures':0, 'cache_hits':0, 'timeouts':0,
+      'fallbacks':0,
+    }
+    if cache_path:
+      self.cache = msa_cache.open_cache(cache_path, max_size=cache_size)
+    else:
+      self.cache = None
+    orders = tuple(duplex.keys())
+    if len(duplex) == 0 or None in duplex:
+      logging.warning(f'Empty duplex {barcode}.')
+      self.units = ()
+      self.run_stats = {}
+    elif len(duplex) == 1:
+      # If there's only one strand in the duplex, just process the first mate, then the second.
+      self.units = (((1, orders[0]),), ((2, orders[0]),))
+    elif len(duplex) == 2:
+      if joint:
+        # Align the families which go into the same duplex consensus read together:
+        # strand1/mate1 + strand2/mate2, then strand1/mate2 + strand2/mate1
+        self.units = (((1, orders[0]), (2, orders[1])), ((2, orders[0]), (1, orders[1])))
+      else:
+        # If there's two strands, process in a criss-cross order:
+        # strand1/mate1, strand2/mate2, strand1/mate2, strand2/mate1
+        self.units = (((1, orders[0]),), ((2, orders[1]),), ((2, orders[0]),), ((1, orders[1]),))
+    else:
+      raise AssertionError(f'More than 2 orders in duplex {barcode}: {orders}')
+
+  def get_family(self, unit):
+    """Get the read pairs to align for this unit, and which mate of them to align."""
+    if len(unit) == 1:
+      mate, order = unit[0]
+      return self.duplex[order], mate
+    # Combine the families into one, storing whichever mate we're aligning from each one as mate 1.
+    family = []
+    for mate, order in unit:
+      for pair in self.duplex[order]:
+        family.append({
+          'name1':pair['name'+str(mate)], 'seq1':pair['seq'+str(mate)],
+          'qual1':pair['qual'+str(mate)],
+        })
+    return family, 1
+
+  def format_unit(self, unit):
+    return ' + '.join([f'order {order}, mate {mate}' for mate, order in unit])
+
+  def log_error(self, error, unit):
+    logging.warning(
+      f'{type(error).__name__} on family {self.barcode}, {self.format_unit(unit)}:\n{error}'
+    )
+
+  def add_alignment(self, alignment, unit, elapsed, aligner=None):
+    """aligner is the one which actually produced the alignment, as returned by align_family()."""
     # Compile statistics.
-    elapsed = time.time() - start
-    pairs = len(family)
+    pairs = sum([len(self.duplex[order]) for mate, order in unit])
     logging.debug(f'{elapsed} sec for {pairs} read pairs.')
     if pairs > 1:
-      run_stats['time'] += elapsed
-      run_stats['runs'] += 1
-      run_stats['aligned_pairs'] += pairs
+      self.run_stats['time'] += elapsed
+      self.run_stats['runs'] += 1
+      self.run_stats['aligned_pairs'] += pairs
     if alignment is None:
-      logging.warning(f'Error aligning family {barcode}/{order} (read {mate}).')
-      run_stats['failures'] += 1
+      for mate, order in unit:
+        logging.warning(f'Error aligning family {self.barcode}/{order} (read {mate}).')
+      self.run_stats['failures'] += 1
     else:
-      output += format_msa(alignment, barcode, order, mate)
-  return output, run_stats
+      # Split a joint alignment back into its families.
+      start = 0
+      for mate, order in unit:
+        end = start + len(self.duplex[order])
+        if self.as_text:
+          self.output += format_msa(alignment[start:end], self.barcode, order, mate)
+        else:
+          self.output[(order, mate-1)] = alignment[start:end]
+        start = end
+    if self.family_stats:
+      family, family_mate = self.get_family(unit)
+      record = make_family_record(
+        family, self.barcode, unit[0][1], family_mate, aligner or 'none', elapsed,
+        alignment is not None
+      )
+      if len(unit) > 1:
+        # Label joint families like "ab+ba" and "1+2".
+        record['order'] = '+'.join([order for mate, order in unit])
+        record['mate'] = '+'.join([str(mate) for mate, order in unit])
+      self.family_records.append(record)
 
+  def get_result(self):
+    return self.output, self.run_stats, self.family_records
 
-def align_family(family, mate, aligner='mafft'):
-  """Do a multiple sequence alignment of the reads in a family and their quality scores."""
+
+def make_family_record(family, barcode, order, mate, aligner, elapsed, success):
+  read_len = max([len(pair['seq'+str(mate)]) for pair in family], default=0)
+  return {
+    'barcode':barcode, 'order':order, 'mate':mate, 'reads':len(family), 'read_len':read_len,
+    'aligner':aligner, 'time':elapsed, 'success':success,
+  }
+
+
+def align_family(family, mate, aligner='mafft', fallbacks=(), timeout=None, cache=None,
+                 run_stats=None):
+  """Do a multiple sequence alignment of the reads in a family and their quality scores.
+  If the aligner fails or takes longer than timeout seconds, try each of the fallbacks in turn.
+  Returns the alignment (None if they all time out) and the name of the aligner which produced it:
+  "cache" if it came from the cache, or None if no aligner was needed or none succeeded.
+  If a cache (an msa_cache.MsaCache) is given, look up the alignment there first, and store it
+  there if it has to be computed (but only if it was computed by the primary aligner)."""
   mate = str(mate)
   assert mate == '1' or mate == '2'
+  used_aligner = None
   if len(family) == 0:
-    return None
+    return None, None
   elif len(family) == 1:
     # If there's only one read pair, there's no alignment to be done (and MAFFT won't accept it).
     aligned_seqs = [family[0]['seq'+mate]]
   else:
     # Do the multiple sequence alignment.
-    aligned_seqs = make_msa(family, mate, aligner=aligner)
-  # Transfer the alignment to the quality scores.
+    aligned_seqs, key = get_cached_msa(family, mate, aligner, cache, run_stats)
+    if aligned_seqs is None:
+      aligned_seqs, used_aligner = make_msa_fallback(family, mate, aligner, fallbacks, timeout,
+                                                     run_stats)
+      if key is not None and used_aligner == aligner:
+        cache.put(key, aligned_seqs)
+    else:
+      used_aligner = 'cache'
+    if aligned_seqs is None:
+      return None, None
+  return transfer_alignment(family, mate, aligned_seqs), used_aligner
+
+
+async def align_family_async(family, mate, slots, aligner='mafft', fallbacks=(), timeout=None,
+                             cache=None, run_stats=None):
+  """Like align_family(), but run mafft as an asyncio subprocess once one of the slots is free.
+  Other aligners are run directly (blocking the event loop)."""
+  mate = str(mate)
+  if len(family) <= 1:
+    return align_family(family, mate, aligner=aligner, run_stats=run_stats)
+  aligned_seqs, key = get_cached_msa(family, mate, aligner, cache, run_stats)
+  if aligned_seqs is None:
+    aligned_seqs, used_aligner = await make_msa_fallback_async(
+      family, mate, slots, aligner, fallbacks, timeout, run_stats
+    )
+    if key is not None and used_aligner == aligner:
+      cache.put(key, aligned_seqs)
+  else:
+    used_aligner = 'cache'
+  if aligned_seqs is None:
+    return None, None
+  return transfer_alignment(family, mate, aligned_seqs), used_aligner
+
+
+def get_cached_msa(family, mate, aligner, cache, run_stats=None):
+  """Look up the family's alignment in the cache.
+  Returns the aligned sequences (or None if it's not cached) and the cache key (or None if there's
+  no cache)."""
+  if cache is None or aligner == 'dummy':
+    return None, None
+  seqs = [pair['seq'+mate] for pair in family]
+  key = cache.make_key(seqs, get_aligner_id(aligner))
+  aligned_seqs = cache.get(key)
+  if aligned_seqs is not None and run_stats is not None:
+    run_stats['cache_hits'] += 1
+  return aligned_seqs, key
+
+
+def transfer_alignment(family, mate, aligned_seqs):
+  """Transfer the alignment to the quality scores and package it all up."""
   ## Get a list of all quality scores in the family for this mate.
   quals_raw = [pair['qual'+mate] for pair in family]
   qual_alignment = seqtools.transfer_gaps_multi(quals_raw, aligned_seqs, gap_char_out=' ')
@@ -359,9 +806,88 @@ def align_family(family, mate, aligner='mafft'):
   return alignment
 
 
-def make_msa(family, mate, aligner='mafft'):
+# The name and version of each aligner, once it's been determined in this process.
+ALIGNER_IDS = {}
+
+def get_aligner_id(aligner):
+  """Get a string identifying the aligner and its version, for use in cache keys."""
+  if aligner in ALIGNER_IDS:
+    return ALIGNER_IDS[aligner]
+  version_str = None
   if aligner == 'mafft':
-    return make_msa_mafft(family, mate)
+    try:
+      # mafft prints its version to stderr.
+      result = subprocess.run(['mafft', '--version'], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+      version_str = str(result.stdout, 'utf8').strip()
+    except OSError:
+      pass
+  elif aligner == 'kalign':
+    from kalign import kalign
+    version_str = getattr(kalign, '__version__', None)
+  aligner_id = f'{aligner} {version_str}'
+  ALIGNER_IDS[aligner] = aligner_id
+  return aligner_id
+
+
+def make_msa_fallback(family, mate, aligner, fallbacks=(), timeout=None, run_stats=None):
+  """Try aligning the family with the aligner, then each of the fallbacks, until one succeeds.
+  Returns the aligned sequences and the name of the aligner that produced them. If the last one
+  times out, returns (None, None). If it fails any other way, its exception is raised."""
+  aligners = (aligner,) + tuple(fallbacks)
+  for i, this_aligner in enumerate(aligners):
+    is_last = i == len(aligners) - 1
+    try:
+      aligned_seqs = make_msa(family, mate, aligner=this_aligner, timeout=timeout)
+    except MSA_ERRORS as error:
+      handle_msa_error(error, this_aligner, is_last, family, timeout, run_stats)
+    else:
+      if i > 0 and run_stats is not None:
+        run_stats['fallbacks'] += 1
+      return aligned_seqs, this_aligner
+  return None, None
+
+
+async def make_msa_fallback_async(family, mate, slots, aligner, fallbacks=(), timeout=None,
+                                  run_stats=None):
+  """Like make_msa_fallback(), but run mafft as an asyncio subprocess."""
+  aligners = (aligner,) + tuple(fallbacks)
+  for i, this_aligner in enumerate(aligners):
+    is_last = i == len(aligners) - 1
+    try:
+      if this_aligner == 'mafft':
+        async with slots:
+          aligned_seqs = await make_msa_mafft_async(family, mate, timeout=timeout)
+      else:
+        aligned_seqs = make_msa(family, mate, aligner=this_aligner, timeout=timeout)
+    except MSA_ERRORS as error:
+      handle_msa_error(error, this_aligner, is_last, family, timeout, run_stats)
+    else:
+      if i > 0 and run_stats is not None:
+        run_stats['fallbacks'] += 1
+      return aligned_seqs, this_aligner
+  return None, None
+
+
+MSA_ERRORS = (subprocess.TimeoutExpired, OSError, ImportError, subprocess.CalledProcessError)
+
+def handle_msa_error(error, aligner, is_last, family, timeout, run_stats=None):
+  """Log and count an aligner failure. Re-raise it if it wasn't a timeout and there's no aligner
+  left to fall back on."""
+  if isinstance(error, subprocess.TimeoutExpired):
+    logging.warning(f'{aligner} timed out after {timeout}s on a family of {len(family)} reads.')
+    if run_stats is not None:
+      run_stats['timeouts'] += 1
+  elif is_last:
+    raise error
+  else:
+    logging.warning(f'{type(error).__name__} from {aligner} on a family of {len(family)} '
+                    f'reads:\n{error}')
+
+
+def make_msa(family, mate, aligner='mafft', timeout=None):
+  if aligner == 'mafft':
+    return make_msa_mafft(family, mate, timeout=timeout)
   elif aligner == 'kalign':
     return make_msa_kalign(family, mate)
   elif aligner == 'dummy':
@@ -387,9 +913,9 @@ def make_msa_kalign(family, mate):
   return aligned_seqs
 
 
-def make_msa_mafft(family, mate):
+def make_msa_mafft(family, mate, timeout=None):
   """Perform a multiple sequence alignment on a set of sequences and parse the result.
-  Uses MAFFT."""
+  Uses MAFFT. Raises subprocess.TimeoutExpired if it takes longer than timeout seconds."""
   logging.info('Aligning with mafft.')
   #TODO: Replace with tempfile.mkstemp()?
   with tempfile.NamedTemporaryFile('w', delete=False, prefix='align.msa.') as family_file:
@@ -398,16 +924,63 @@ def make_msa_mafft(family, mate):
       seq = pair['seq'+mate]
       family_file.write('>'+name+'\n')
       family_file.write(seq+'\n')
+  command = ['mafft', '--nuc', '--quiet', family_file.name]
+  try:
+    output = run_command(command, timeout=timeout)
+  finally:
+    # Make sure we delete the temporary file.
+    os.remove(family_file.name)
+  return read_fasta(str(output, 'utf8'))
+
+
+async def make_msa_mafft_async(family, mate, timeout=None):
+  """Like make_msa_mafft(), but as a coroutine. Sends the sequences to mafft through its stdin."""
+  logging.info('Aligning with mafft.')
+  fasta = ''
+  for pair in family:
+    fasta += '>'+pair['name'+mate]+'\n'+pair['seq'+mate]+'\n'
+  command = ['mafft', '--nuc', '--quiet', '-']
+  process = await asyncio.create_subprocess_exec(
+    *command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    start_new_session=True
+  )
+  try:
+    output, _ = await asyncio.wait_for(process.communicate(bytes(fasta, 'utf8')), timeout)
+  except asyncio.TimeoutError:
+    kill_process_group(process.pid)
+    await process.wait()
+    raise subprocess.TimeoutExpired(command, timeout)
+  except asyncio.CancelledError:
+    kill_process_group(process.pid)
+    raise
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command, output=output)
+  return read_fasta(str(output, 'utf8'))
+
+
+def kill_process_group(pid):
+  try:
+    os.killpg(pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+
+
+def run_command(command, timeout=None):
+  """Run the command and return its stdout, like subprocess.check_output().
+  But on a timeout, kill the command's whole process group. mafft is a shell script which runs the
+  real aligner as a child, which would otherwise keep running (and keep the output pipe open)."""
   with open(os.devnull, 'w') as devnull:
-    try:
-      command = ['mafft', '--nuc', '--quiet', family_file.name]
-      output = subprocess.check_output(command, stderr=devnull)
-    except (OSError, subprocess.CalledProcessError):
-      raise
-    finally:
-      # Make sure we delete the temporary file.
-      os.remove(family_file.name)
-  return read_fasta(output)
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull,
+                          start_new_session=True) as process:
+      try:
+        output, _ = process.communicate(timeout=timeout)
+      except subprocess.TimeoutExpired:
+        kill_process_group(process.pid)
+        process.communicate()
+        raise
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command, output=output)
+  return output
 
 
 def read_fasta(fasta):
@@ -435,14 +1008,96 @@ def format_msa(align, barcode, order, mate, outfile=sys.stdout):
   return output
 
 
-def process_result(result, stats):
+def process_result(result, stats, telemetry=None):
   """Process the outcome of a duplex run.
   Print the aligned output and sum the stats from the run with the running totals."""
-  output, run_stats = result
+  output, run_stats, family_records = result
   for key, value in run_stats.items():
     stats[key] += value
   if output:
     sys.stdout.write(output)
+  if telemetry:
+    for record in family_records:
+      record_family(record, telemetry)
+
+
+def reject_duplex(args, error, rejects, stats):
+  """Write a duplex which kept failing (the args given to pool.compute()) to the --rejects file."""
+  if len(args) == 4:
+    path, offset, length, barcode = args
+    lines = parallel_tools.read_slice(path, offset, length)
+  else:
+    duplex, barcode = args
+    lines = format_duplex(duplex, barcode)
+  logging.error(f'Error: Giving up on duplex {barcode}: {type(error).__name__}: {error}')
+  rejects.writelines(lines)
+  stats['rejects'] += 1
+
+
+def format_duplex(duplex, barcode):
+  """Format a duplex from parse_duplexes() back into the lines of a families.tsv."""
+  lines = []
+  for order, family in duplex.items():
+    for pair in family:
+      fields = [barcode, order] + [pair[key] for key in PAIR_KEYS]
+      lines.append('\t'.join(fields)+'\n')
+  return lines
+
+
+PAIR_KEYS = ('name1', 'seq1', 'qual1', 'name2', 'seq2', 'qual2')
+
+
+def record_family(record, telemetry):
+  """Add a family's record to the running telemetry and write it to the --family-stats file."""
+  outfile = telemetry['outfile']
+  if outfile:
+    if telemetry['format'] == 'jsonl':
+      outfile.write(json.dumps(record)+'\n')
+    else:
+      fields = [record[key] for key in FAMILY_RECORD_KEYS]
+      outfile.write('\t'.join(map(str, fields))+'\n')
+  bin_stats = telemetry['bins'][get_size_bin(record['reads'])]
+  bin_stats[0] += 1
+  bin_stats[1] += record['time']
+  # Keep only the slowest N families, in a min-heap.
+  max_slowest = telemetry['max_slowest']
+  if max_slowest:
+    key = (record['time'], record['barcode'], record['order'], record['mate'])
+    entry = (key, record)
+    if len(telemetry['slowest']) < max_slowest:
+      heapq.heappush(telemetry['slowest'], entry)
+    elif key > telemetry['slowest'][0][0]:
+      heapq.heapreplace(telemetry['slowest'], entry)
+
+
+FAMILY_RECORD_KEYS = ('barcode', 'order', 'mate', 'reads', 'read_len', 'aligner', 'time', 'success')
+
+
+def get_size_bin(size):
+  """Bin family sizes by powers of 2: 1, 2, 3-4, 5-8, 9-16, etc.
+  Returns the upper bound of the bin."""
+  upper = 1
+  while upper < size:
+    upper *= 2
+  return upper
+
+
+def log_telemetry_summary(telemetry):
+  logging.error('Alignment time by family size:')
+  logging.error('  reads\tfamilies\ttotal_sec\tsec_per_family')
+  for upper in sorted(telemetry['bins']):
+    count, total_time = telemetry['bins'][upper]
+    if upper <= 2:
+      label = str(upper)
+    else:
+      label = f'{upper//2+1}-{upper}'
+    logging.error(f'  {label}\t{count}\t{total_time:0.3f}\t{total_time/count:0.4f}')
+  logging.error(f'Slowest {len(telemetry["slowest"])} families:')
+  for key, record in sorted(telemetry['slowest'], key=lambda entry: entry[0], reverse=True):
+    logging.error(
+      '  {barcode}\t{order}\t{mate}\t{reads} reads\t{read_len}bp\t{aligner}\t{time:0.3f}s'
+      .format(**record)
+    )
 
 
 def tone_down_logger():
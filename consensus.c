@@ -25,32 +25,70 @@ const char *IUPAC_BASES = "N...A.M..CR...WS.....YN..GN......N.K...N.........T...
 #define WIN_LEN 4
 #define GAP_CHAR ' '
 
-int **get_votes_simple(char *align[], int n_seqs, int seq_len);
-int **get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char thres);
+// The votes for an alignment are stored in one flat array of seq_len*N_BASES ints: the votes for
+// base "b" at position "i" are at votes[i*N_BASES+b].
+#define VOTE(votes, i, b) votes[(i)*N_BASES+(b)]
+
+int *get_votes_simple(char *align[], int n_seqs, int seq_len, int *votes);
+int *get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char thres, int *votes);
+int *get_votes_weighted(char *align[], char *quals[], int n_seqs, int seq_len, int *votes);
 int init_gap_qual_window(int *window, char *quals, int seq_len);
 char get_gap_qual(int *window);
+int get_gap_qual_rounded(int *window);
+int sum_gap_window(int *window, int *score_sum);
+int fill_gap_quals_buf(char *quals, int seq_len, char *output);
+int fill_gap_quals_batch(char *quals[], int seq_lens[], int n_seqs, char *output[]);
 int push_qual(int *window, int win_edge, char *quals, int seq_len);
 void print_window(int *window, int win_edge);
-int **init_votes(int seq_len);
-void free_votes(int *votes[], int seq_len);
-void print_votes(char *consensus, int *votes[], int seq_len);
+int *init_votes(int seq_len);
+void free_votes(int *votes);
+int *get_scratch_votes(int seq_len, int n_matrices);
+char *get_scratch_seqs(int seq_len, int n_seqs);
+void free_scratch(void);
+void print_votes(char *consensus, int *votes, int seq_len);
 char *rm_gaps(char *consensus, int cons_len);
-char *build_consensus(int *votes[], int num_reads, int seq_len, double thres, int min_reads);
-char *build_consensus_duplex(int *votes1[], int *votes2[], int seq_len, double thres);
+char *rm_gaps_buf(char *consensus, int cons_len, char *output);
+char *build_consensus(int *votes, int num_reads, int seq_len, double thres, int min_reads);
+char *build_consensus_buf(int *votes, int num_reads, int seq_len, double thres, int min_reads,
+                          char *consensus);
+char *build_consensus_duplex(int *votes1, int *votes2, int seq_len, double thres);
+char *build_consensus_duplex_buf(int *votes1, int *votes2, int seq_len, double thres,
+                                 char *consensus);
 char *build_consensus_duplex_simple(char *cons1, char *cons2, int gapped);
+char *build_consensus_duplex_simple_buf(char *cons1, char *cons2, int gapped, char *cons);
 int get_base_prime(char base);
 char *get_consensus(char *align[], char *quals[], int n_seqs, int seq_len, double cons_thres,
                     int min_reads, char qual_thres, int gapped);
+char *get_consensus_buf(char *align[], char *quals[], int n_seqs, int seq_len, double cons_thres,
+                        int min_reads, char qual_thres, int gapped, char *consensus);
 char *get_consensus_duplex(char *align1[], char *align2[], char *quals1[], char *quals2[],
                            int n_seqs1, int n_seqs2, int seq_len, double cons_thres,
                            int min_reads, char qual_thres, int gapped, char *method);
+char *get_consensus_duplex_buf(char *align1[], char *align2[], char *quals1[], char *quals2[],
+                               int n_seqs1, int n_seqs2, int seq_len, double cons_thres,
+                               int min_reads, char qual_thres, int gapped, char *method,
+                               char *consensus);
+void free_consensus(char *consensus);
+
+/* Memory management:
+ * Every function which returns a new string (get_consensus(), rm_gaps(), etc.) has a "_buf" version
+ * which instead writes into a buffer given by the caller. The buffer must hold at least seq_len+1
+ * chars (for rm_gaps_buf(), cons_len+1). The versions which allocate the string return memory the
+ * caller owns, and which should be released with free_consensus().
+ * The vote matrices used internally live in a per-thread scratch buffer which is reused from call
+ * to call, growing when a longer alignment comes along. Call free_scratch() to release it.
+ */
+static __thread int *votes_scratch = NULL;
+static __thread size_t votes_scratch_size = 0;
+static __thread char *seqs_scratch = NULL;
+static __thread size_t seqs_scratch_size = 0;
 
 
 // Tally the different bases at each position in an alignment.
-// Returns an array of arrays: for each position in the alignment, an array of the number of times
-// each base occurs at that position. The order of bases is as in the "BASES" constant.
-int **get_votes_simple(char *align[], int n_seqs, int seq_len) {
-  int **votes = init_votes(seq_len);
+// Fills "votes" (an array of seq_len*N_BASES ints) with the number of times each base occurs at
+// each position, and returns it. The order of bases is as in the "BASES" constant.
+int *get_votes_simple(char *align[], int n_seqs, int seq_len, int *votes) {
+  memset(votes, 0, sizeof(int) * seq_len * N_BASES);
 
   // Tally votes for each base.
   int i, j;
@@ -59,22 +97,22 @@ int **get_votes_simple(char *align[], int n_seqs, int seq_len) {
       // N.B.: Could write this without hardcoded literals, but it's about 40% slower.
       switch (toupper(align[i][j])) {
         case 'A':
-          votes[j][0]++;
+          VOTE(votes, j, 0)++;
           break;
         case 'C':
-          votes[j][1]++;
+          VOTE(votes, j, 1)++;
           break;
         case 'G':
-          votes[j][2]++;
+          VOTE(votes, j, 2)++;
           break;
         case 'T':
-          votes[j][3]++;
+          VOTE(votes, j, 3)++;
           break;
         case 'N':
-          votes[j][4]++;
+          VOTE(votes, j, 4)++;
           break;
         case '-':
-          votes[j][5]++;
+          VOTE(votes, j, 5)++;
           break;
       }
     }
@@ -85,9 +123,9 @@ int **get_votes_simple(char *align[], int n_seqs, int seq_len) {
 
 
 //  Tally votes for each base, ignoring bases with a quality score below "thres".
-int **get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char thres) {
-  int **votes = init_votes(seq_len);
-  int *window = malloc(sizeof(int) * WIN_LEN * 2);
+int *get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char thres, int *votes) {
+  memset(votes, 0, sizeof(int) * seq_len * N_BASES);
+  int window[WIN_LEN*2];
   int win_edge;
 
   // Tally votes for each base.
@@ -110,28 +148,27 @@ int **get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char
       // N.B.: Could write this without hardcoded literals, but it's about 40% slower.
       switch (toupper(align[i][j])) {
         case 'A':
-          votes[j][0]++;
+          VOTE(votes, j, 0)++;
           break;
         case 'C':
-          votes[j][1]++;
+          VOTE(votes, j, 1)++;
           break;
         case 'G':
-          votes[j][2]++;
+          VOTE(votes, j, 2)++;
           break;
         case 'T':
-          votes[j][3]++;
+          VOTE(votes, j, 3)++;
           break;
         case 'N':
-          votes[j][4]++;
+          VOTE(votes, j, 4)++;
           break;
         case '-':
-          votes[j][5]++;
+          VOTE(votes, j, 5)++;
           break;
       }
     }
   }
 
-  free(window);
   return votes;
 }
 
@@ -146,9 +183,9 @@ int **get_votes_qual(char *align[], char *quals[], int n_seqs, int seq_len, char
  * a certain threshold, we call it an N. Theoretically, this threshold is the confidence we want in
  * our final base calls. This could even replace the arbitrary 3 reads for a consensus threshold.
  */
-int **get_votes_weighted(char *align[], char *quals[], int n_seqs, int seq_len) {
-  int **votes = init_votes(seq_len);
-  int *window = malloc(sizeof(int) * WIN_LEN * 2);
+int *get_votes_weighted(char *align[], char *quals[], int n_seqs, int seq_len, int *votes) {
+  memset(votes, 0, sizeof(int) * seq_len * N_BASES);
+  int window[WIN_LEN*2];
   int win_edge;
 
   // Tally votes for each base.
@@ -167,28 +204,27 @@ int **get_votes_weighted(char *align[], char *quals[], int n_seqs, int seq_len)
       // N.B.: Could write this without hardcoded literals, but it's about 40% slower.
       switch (toupper(align[i][j])) {
         case 'A':
-          votes[j][0] += qual;
+          VOTE(votes, j, 0) += qual;
           break;
         case 'C':
-          votes[j][1] += qual;
+          VOTE(votes, j, 1) += qual;
           break;
         case 'G':
-          votes[j][2] += qual;
+          VOTE(votes, j, 2) += qual;
           break;
         case 'T':
-          votes[j][3] += qual;
+          VOTE(votes, j, 3) += qual;
           break;
         case 'N':
-          votes[j][4] += qual;
+          VOTE(votes, j, 4) += qual;
           break;
         case '-':
-          votes[j][5] += qual;
+          VOTE(votes, j, 5) += qual;
           break;
       }
     }
   }
 
-  free(window);
   return votes;
 }
 
@@ -268,15 +304,46 @@ int push_qual(int *window, int win_edge, char *quals, int seq_len) {
 
 
 // Compute the quality of the gap based on a weighted average of the quality scores in the window.
-// The scores near the center of the window are weighted higher than the ones further away.
 char get_gap_qual(int *window) {
-  int score_sum = 0;
+  int score_sum;
+  int weight_sum = sum_gap_window(window, &score_sum);
+  if (weight_sum > 0) {
+    // Divide by the sum of the weights to get the final quality score.
+    return (char) (score_sum/weight_sum);
+  } else {
+    return '\0';
+  }
+}
+
+
+// Like get_gap_qual(), but round the average to the nearest score instead of truncating it (ties
+// go to the even score, like Python's round()). This is the gap quality utils/errstats.py uses.
+// Returns -1 if there are no quality scores in the window.
+int get_gap_qual_rounded(int *window) {
+  int score_sum;
+  int weight_sum = sum_gap_window(window, &score_sum);
+  if (weight_sum <= 0) {
+    return -1;
+  }
+  int qual = score_sum / weight_sum;
+  int remainder = score_sum % weight_sum;
+  if (remainder*2 > weight_sum || (remainder*2 == weight_sum && qual % 2 == 1)) {
+    qual++;
+  }
+  return qual;
+}
+
+
+// Add up the quality scores in the window, weighted so the ones near the center count more than
+// the ones further away. Stores the weighted sum in "score_sum" and returns the sum of the weights.
+int sum_gap_window(int *window, int *score_sum) {
   int weight_sum = 0;
   int weight = 1;
   int i;
+  *score_sum = 0;
   for (i = 0; i < WIN_LEN*2; i++) {
     if (window[i] != -1) {
-      score_sum += window[i] * weight;
+      *score_sum += window[i] * weight;
       weight_sum += weight;
     }
     // Increase the weight until we get to the middle of the window (at WIN_LEN), then decrease it.
@@ -286,12 +353,46 @@ char get_gap_qual(int *window) {
       weight--;
     }
   }
-  if (weight_sum > 0) {
-    // Divide by the sum of the weights to get the final quality score.
-    return (char) (score_sum/weight_sum);
-  } else {
-    return '\0';
+  return weight_sum;
+}
+
+
+// Write a copy of "quals" to "output" (which must have room for seq_len+1 chars), with each gap
+// replaced by its get_gap_qual_rounded() score.
+// Returns 0 if there was a gap but no quality scores to compute it from, 1 otherwise.
+int fill_gap_quals_buf(char *quals, int seq_len, char *output) {
+  int window[WIN_LEN*2];
+  int win_edge = init_gap_qual_window(window, quals, seq_len);
+  int gap_qual;
+  int i;
+  for (i = 0; i < seq_len; i++) {
+    if (quals[i] == GAP_CHAR) {
+      gap_qual = get_gap_qual_rounded(window);
+      if (gap_qual == -1) {
+        output[0] = '\0';
+        return 0;
+      }
+      output[i] = (char) gap_qual;
+    } else {
+      win_edge = push_qual(window, win_edge, quals, seq_len);
+      output[i] = quals[i];
+    }
+  }
+  output[seq_len] = '\0';
+  return 1;
+}
+
+
+// Fill in the gaps in n_seqs quality score strings in one call, with fill_gap_quals_buf().
+// Returns the index of the first string whose gaps couldn't be filled in, or -1 if all of them were.
+int fill_gap_quals_batch(char *quals[], int seq_lens[], int n_seqs, char *output[]) {
+  int i;
+  for (i = 0; i < n_seqs; i++) {
+    if (!fill_gap_quals_buf(quals[i], seq_lens[i], output[i])) {
+      return i;
+    }
   }
+  return -1;
 }
 
 
@@ -311,29 +412,53 @@ void print_window(int *window, int win_edge) {
 }
 
 
-int **init_votes(int seq_len) {
-  int **votes = malloc(sizeof(int *) * seq_len);
-  int i, j;
-  for (i = 0; i < seq_len; i++) {
-    votes[i] = malloc(sizeof(int) * N_BASES);
-    for (j = 0; j < N_BASES; j++) {
-      votes[i][j] = 0;
-    }
+// Allocate a (zeroed) vote matrix owned by the caller. Release it with free_votes().
+int *init_votes(int seq_len) {
+  return calloc((size_t)seq_len * N_BASES, sizeof(int));
+}
+
+
+void free_votes(int *votes) {
+  free(votes);
+}
+
+
+// Get room for "n_matrices" consecutive vote matrices from the scratch buffer.
+int *get_scratch_votes(int seq_len, int n_matrices) {
+  size_t size = sizeof(int) * seq_len * N_BASES * n_matrices;
+  if (size > votes_scratch_size) {
+    free(votes_scratch);
+    votes_scratch = malloc(size);
+    votes_scratch_size = size;
   }
-  return votes;
+  return votes_scratch;
 }
 
 
-void free_votes(int *votes[], int seq_len) {
-  int i;
-  for (i = 0; i < seq_len; i++) {
-    free(votes[i]);
+// Get room for "n_seqs" consecutive strings of length seq_len (plus null terminators).
+char *get_scratch_seqs(int seq_len, int n_seqs) {
+  size_t size = sizeof(char) * (seq_len + 1) * n_seqs;
+  if (size > seqs_scratch_size) {
+    free(seqs_scratch);
+    seqs_scratch = malloc(size);
+    seqs_scratch_size = size;
   }
-  free(votes);
+  return seqs_scratch;
+}
+
+
+// Release this thread's scratch buffers. They'll be reallocated if they're needed again.
+void free_scratch(void) {
+  free(votes_scratch);
+  votes_scratch = NULL;
+  votes_scratch_size = 0;
+  free(seqs_scratch);
+  seqs_scratch = NULL;
+  seqs_scratch_size = 0;
 }
 
 
-void print_votes(char *consensus, int *votes[], int seq_len) {
+void print_votes(char *consensus, int *votes, int seq_len) {
   int i, j;
   printf("   ");
   for (j = 0; j < N_BASES; j++) {
@@ -343,8 +468,8 @@ void print_votes(char *consensus, int *votes[], int seq_len) {
   for (i = 0; i < seq_len; i++) {
     printf("%c: ", consensus[i]);
     for (j = 0; j < N_BASES; j++) {
-      if (votes[i][j]) {
-        printf("%2d ", votes[i][j]);
+      if (VOTE(votes, i, j)) {
+        printf("%2d ", VOTE(votes, i, j));
       } else {
         printf("   ");
       }
@@ -358,6 +483,12 @@ void print_votes(char *consensus, int *votes[], int seq_len) {
 // actual final sequence. "cons_len" should be the length of the original, gapped, sequence.
 char *rm_gaps(char *consensus, int cons_len) {
   char *output = malloc(sizeof(char) * cons_len + 1);
+  return rm_gaps_buf(consensus, cons_len, output);
+}
+
+
+// "output" may be the same buffer as "consensus", to remove the gaps in place.
+char *rm_gaps_buf(char *consensus, int cons_len, char *output) {
   int i;
   int j = 0;
   for (i = 0; i < cons_len; i++) {
@@ -371,16 +502,21 @@ char *rm_gaps(char *consensus, int cons_len) {
 }
 
 
-char *build_consensus(int *votes[], int num_reads, int seq_len, double thres, int min_reads) {
+char *build_consensus(int *votes, int num_reads, int seq_len, double thres, int min_reads) {
   char *consensus = malloc(sizeof(char) * seq_len + 1);
-  
+  return build_consensus_buf(votes, num_reads, seq_len, thres, min_reads, consensus);
+}
+
+
+char *build_consensus_buf(int *votes, int num_reads, int seq_len, double thres, int min_reads,
+                          char *consensus) {
   int i, j;
   for (i = 0; i < seq_len; i++) {
     int max_vote = 0;
     char max_base = 'N';
     for (j = 0; j < N_BASES; j++) {
-      if (votes[i][j] > max_vote) {
-        max_vote = votes[i][j];
+      if (VOTE(votes, i, j) > max_vote) {
+        max_vote = VOTE(votes, i, j);
         max_base = BASES[j];
       }
       if (max_vote && (double)max_vote/num_reads > thres && max_vote >= min_reads) {
@@ -398,9 +534,14 @@ char *build_consensus(int *votes[], int num_reads, int seq_len, double thres, in
 
 // Build a consensus sequence from two alignments by weighting each equally and considering only
 // the frequency of each base in each alignment.
-char *build_consensus_duplex(int *votes1[], int *votes2[], int seq_len, double thres) {
+char *build_consensus_duplex(int *votes1, int *votes2, int seq_len, double thres) {
   char *consensus = malloc(sizeof(char) * seq_len + 1);
+  return build_consensus_duplex_buf(votes1, votes2, seq_len, thres, consensus);
+}
 
+
+char *build_consensus_duplex_buf(int *votes1, int *votes2, int seq_len, double thres,
+                                 char *consensus) {
   int i, j;
   for (i = 0; i < seq_len; i++) {
     // Sum the total votes at this position.
@@ -411,11 +552,11 @@ char *build_consensus_duplex(int *votes1[], int *votes2[], int seq_len, double t
      */
     int total1 = 0;
     for (j = 0; j < N_BASES; j++) {
-      total1 += votes1[i][j];
+      total1 += VOTE(votes1, i, j);
     }
     int total2 = 0;
     for (j = 0; j < N_BASES; j++) {
-      total2 += votes2[i][j];
+      total2 += VOTE(votes2, i, j);
     }
     double max_freq = 0.0;
     char max_base = 'N';
@@ -423,11 +564,11 @@ char *build_consensus_duplex(int *votes1[], int *votes2[], int seq_len, double t
       // Get the frequency of each base.
       double freq1;
       if (total1 > 0) {
-        freq1 = (double)votes1[i][j]/total1;
+        freq1 = (double)VOTE(votes1, i, j)/total1;
       }
       double freq2;
       if (total2 > 0) {
-        freq2 = (double)votes2[i][j]/total2;
+        freq2 = (double)VOTE(votes2, i, j)/total2;
       }
       // frequency of the base = average of frequencies in the two sequences
       double avg_freq;
@@ -460,8 +601,14 @@ char *build_consensus_duplex(int *votes1[], int *votes2[], int seq_len, double t
 
 // "cons1" and "cons2" must be null-terminated strings of equal lengths.
 char *build_consensus_duplex_simple(char *cons1, char *cons2, int gapped) {
+  char *cons = malloc(sizeof(char) * strlen(cons1) + 1);
+  return build_consensus_duplex_simple_buf(cons1, cons2, gapped, cons);
+}
+
+
+// "cons" must hold at least strlen(cons1)+1 chars.
+char *build_consensus_duplex_simple_buf(char *cons1, char *cons2, int gapped, char *cons) {
   int seq_len = strlen(cons1);
-  char *cons = malloc(sizeof(char) * seq_len + 1);
   int i = 0;
   int base_prime1, base_prime2;
   while (cons1[i] != '\0' && cons2[i] != '\0') {
@@ -474,7 +621,7 @@ char *build_consensus_duplex_simple(char *cons1, char *cons2, int gapped) {
   if (gapped) {
     return cons;
   } else {
-    return rm_gaps(cons, seq_len);
+    return rm_gaps_buf(cons, seq_len, cons);
   }
 }
 
@@ -504,67 +651,89 @@ int get_base_prime(char base) {
 // consensus threshold when evaluating base votes.
 char *get_consensus(char *align[], char *quals[], int n_seqs, int seq_len, double cons_thres,
                     int min_reads, char qual_thres, int gapped) {
+  char *consensus = malloc(sizeof(char) * seq_len + 1);
+  return get_consensus_buf(align, quals, n_seqs, seq_len, cons_thres, min_reads, qual_thres,
+                           gapped, consensus);
+}
+
+
+// Like get_consensus(), but write the result into "consensus", which must hold seq_len+1 chars.
+char *get_consensus_buf(char *align[], char *quals[], int n_seqs, int seq_len, double cons_thres,
+                        int min_reads, char qual_thres, int gapped, char *consensus) {
   if (cons_thres == -1.0) {
     cons_thres = THRES_DEFAULT;
   }
-  int **votes;
+  int *votes = get_scratch_votes(seq_len, 1);
   if (quals == 0) {
-    votes = get_votes_simple(align, n_seqs, seq_len);
+    get_votes_simple(align, n_seqs, seq_len, votes);
   } else {
-    votes = get_votes_qual(align, quals, n_seqs, seq_len, qual_thres);
+    get_votes_qual(align, quals, n_seqs, seq_len, qual_thres, votes);
   }
-  char *consensus_gapped = build_consensus(votes, n_seqs, seq_len, cons_thres, min_reads);
-  char *consensus;
+  build_consensus_buf(votes, n_seqs, seq_len, cons_thres, min_reads, consensus);
   if (gapped) {
-    consensus = consensus_gapped;
+    return consensus;
   } else {
-    consensus = rm_gaps(consensus_gapped, seq_len);
+    return rm_gaps_buf(consensus, seq_len, consensus);
   }
-  free_votes(votes, seq_len);
-  return consensus;
 }
 
 
 char *get_consensus_duplex(char *align1[], char *align2[], char *quals1[], char *quals2[],
                            int n_seqs1, int n_seqs2, int seq_len, double cons_thres,
                            int min_reads, char qual_thres, int gapped, char *method) {
+  char *consensus = malloc(sizeof(char) * seq_len + 1);
+  return get_consensus_duplex_buf(align1, align2, quals1, quals2, n_seqs1, n_seqs2, seq_len,
+                                  cons_thres, min_reads, qual_thres, gapped, method, consensus);
+}
+
+
+// Like get_consensus_duplex(), but write the result into "consensus", which must hold seq_len+1
+// chars. An unrecognized "method" gives an empty string.
+char *get_consensus_duplex_buf(char *align1[], char *align2[], char *quals1[], char *quals2[],
+                               int n_seqs1, int n_seqs2, int seq_len, double cons_thres,
+                               int min_reads, char qual_thres, int gapped, char *method,
+                               char *consensus) {
   if (cons_thres == -1.0) {
     cons_thres = THRES_DEFAULT;
   }
-  int **votes1;
-  int **votes2;
+  int *votes1 = get_scratch_votes(seq_len, 2);
+  int *votes2 = votes1 + seq_len * N_BASES;
   if (quals1 == 0 || quals2 == 0) {
-    votes1 = get_votes_simple(align1, n_seqs1, seq_len);
-    votes2 = get_votes_simple(align2, n_seqs2, seq_len);
+    get_votes_simple(align1, n_seqs1, seq_len, votes1);
+    get_votes_simple(align2, n_seqs2, seq_len, votes2);
   } else {
-    votes1 = get_votes_qual(align1, quals1, n_seqs1, seq_len, qual_thres);
-    votes2 = get_votes_qual(align2, quals2, n_seqs2, seq_len, qual_thres);
+    get_votes_qual(align1, quals1, n_seqs1, seq_len, qual_thres, votes1);
+    get_votes_qual(align2, quals2, n_seqs2, seq_len, qual_thres, votes2);
   }
-  char *consensus_gapped;
   if (!strncmp(method, "freq", 4)) {
-    consensus_gapped = build_consensus_duplex(votes1, votes2, seq_len, cons_thres);
+    build_consensus_duplex_buf(votes1, votes2, seq_len, cons_thres, consensus);
   } else if (!strncmp(method, "iupac", 5)) {
-    char *cons1 = build_consensus(votes1, n_seqs1, seq_len, cons_thres, min_reads);
-    char *cons2 = build_consensus(votes2, n_seqs2, seq_len, cons_thres, min_reads);
-    consensus_gapped = build_consensus_duplex_simple(cons1, cons2, 1);
+    char *cons1 = get_scratch_seqs(seq_len, 2);
+    char *cons2 = cons1 + seq_len + 1;
+    build_consensus_buf(votes1, n_seqs1, seq_len, cons_thres, min_reads, cons1);
+    build_consensus_buf(votes2, n_seqs2, seq_len, cons_thres, min_reads, cons2);
+    build_consensus_duplex_simple_buf(cons1, cons2, 1, consensus);
   } else {
-    return "";
+    consensus[0] = '\0';
+    return consensus;
   }
-  char *consensus;
   if (gapped) {
-    consensus = consensus_gapped;
+    return consensus;
   } else {
-    consensus = rm_gaps(consensus_gapped, seq_len);
+    return rm_gaps_buf(consensus, seq_len, consensus);
   }
-  free_votes(votes1, seq_len);
-  free_votes(votes2, seq_len);
-  return consensus;
+}
+
+
+// Release a string returned by one of the functions above (get_consensus(), rm_gaps(), etc.).
+void free_consensus(char *consensus) {
+  free(consensus);
 }
 
 
 void get_gap_quals(char *quals) {
   int seq_len = strlen(quals);
-  int *window = malloc(sizeof(int) * WIN_LEN * 2);
+  int window[WIN_LEN*2];
   int win_edge = init_gap_qual_window(window, quals, seq_len);
   print_window(window, win_edge);
 
@@ -600,11 +769,13 @@ int main(int argc, char *argv[]) {
 
   // get_gap_quals(align[0]);
 
-  int **votes = get_votes_simple(align, argc-1, seq_len);
+  int *votes = get_votes_simple(align, argc-1, seq_len, init_votes(seq_len));
   char *consensus = build_consensus(votes, argc-1, seq_len, THRES_DEFAULT, MIN_DEFAULT);
   print_votes(consensus, votes, seq_len);
   printf("%s\n", consensus);
-  free_votes(votes, seq_len);
+  free_votes(votes);
+  free_consensus(consensus);
+  free(align);
 
   return 0;
 }
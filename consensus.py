@@ -5,6 +5,10 @@ import errno
 import ctypes
 import argparse
 PY3 = sys.version_info.major >= 3
+try:
+  import _dunovo
+except ImportError:
+  _dunovo = None
 
 # Locate the library file.
 LIBFILE = 'libconsensus.so'
@@ -16,10 +20,13 @@ if not os.path.isfile(library_path):
   raise ioe
 
 consensus = ctypes.cdll.LoadLibrary(library_path)
-consensus.rm_gaps.restype = ctypes.c_char_p
-consensus.get_consensus.restype = ctypes.c_char_p
-consensus.get_consensus_duplex.restype = ctypes.c_char_p
-consensus.build_consensus_duplex_simple.restype = ctypes.c_char_p
+# This ctypes interface is only used when the _dunovo extension module isn't available.
+# Use the versions of the functions which write into a buffer we provide, so the results are freed
+# along with the Python objects instead of leaking.
+consensus.rm_gaps_buf.restype = ctypes.c_char_p
+consensus.get_consensus_buf.restype = ctypes.c_char_p
+consensus.get_consensus_duplex_buf.restype = ctypes.c_char_p
+consensus.build_consensus_duplex_simple_buf.restype = ctypes.c_char_p
 
 ARG_DEFAULTS = {'alignment':sys.stdin}
 DESCRIPTION = "Get the consensus of a set of aligned sequences."
@@ -47,13 +54,16 @@ def main(argv):
 
 
 def rm_gaps(seq_raw):
+  if _dunovo:
+    return str(_dunovo.rm_gaps(seq_raw), 'utf8')
   seq_len = len(seq_raw)
   if PY3:
     seq_bytes = bytes(seq_raw, 'utf8')
   else:
     seq_bytes = bytes(seq_raw)
   seq_c = ctypes.c_char_p(seq_bytes)
-  seq_gapless = consensus.rm_gaps(seq_c, seq_len)
+  output = ctypes.create_string_buffer(seq_len+1)
+  seq_gapless = consensus.rm_gaps_buf(seq_c, seq_len, output)
   if PY3:
     return str(seq_gapless, 'utf8')
   else:
@@ -62,6 +72,10 @@ def rm_gaps(seq_raw):
 
 # N.B.: The quality scores must be aligned with their accompanying sequences.
 def get_consensus(align, quals=[], cons_thres=-1.0, min_reads=0, qual_thres=' ', gapped=False):
+  seq_len = get_seq_len(align, quals)
+  if _dunovo:
+    cons = _dunovo.get_consensus(align, quals, cons_thres, min_reads, ord(qual_thres), gapped)
+    return str(cons, 'utf8')
   cons_thres_c = ctypes.c_double(cons_thres)
   if PY3:
     qual_thres_val = ord(qual_thres)
@@ -73,7 +87,37 @@ def get_consensus(align, quals=[], cons_thres=-1.0, min_reads=0, qual_thres=' ',
     gapped_c = 1
   else:
     gapped_c = 0
-  assert not quals or len(quals) == n_seqs, 'Different number of sequences and quals.'
+  align_c = str_pylist_to_str_carray(align, length=n_seqs)
+  if quals:
+    quals_c = str_pylist_to_str_carray(quals, length=n_seqs)
+  else:
+    quals_c = 0
+  output = ctypes.create_string_buffer(seq_len+1)
+  cons = consensus.get_consensus_buf(align_c, quals_c, n_seqs, seq_len, cons_thres_c, min_reads,
+                                     qual_thres_c, gapped_c, output)
+  if PY3:
+    return str(cons, 'utf8')
+  else:
+    return str(cons)
+
+
+def get_consensuses(families, cons_thres=-1.0, min_reads=0, qual_thres=' ', gapped=False):
+  """Make the consensus of each of a list of (align, quals) families, with the same parameters for
+  all. With the _dunovo extension module, the whole batch is done in one call."""
+  for align, quals in families:
+    get_seq_len(align, quals)
+  if _dunovo:
+    consensuses = _dunovo.get_consensuses(families, cons_thres, min_reads, ord(qual_thres), gapped)
+    return [str(cons, 'utf8') for cons in consensuses]
+  else:
+    return [get_consensus(align, quals, cons_thres=cons_thres, min_reads=min_reads,
+                          qual_thres=qual_thres, gapped=gapped) for align, quals in families]
+
+
+def get_seq_len(align, quals):
+  """Check that the sequences and quality scores of an alignment are all the same length, and
+  return it."""
+  assert not quals or len(quals) == len(align), 'Different number of sequences and quals.'
   seq_len = None
   for seq in (align + quals):
     if seq_len is None:
@@ -84,22 +128,14 @@ def get_consensus(align, quals=[], cons_thres=-1.0, min_reads=0, qual_thres=' ',
             'All sequences and quals lines in the alignment must be the same length: {}bp != {}bp. '
             'Problem sequence:\n{}'.format(seq_len, len(seq), seq)
         )
-  align_c = str_pylist_to_str_carray(align, length=n_seqs)
-  if quals:
-    quals_c = str_pylist_to_str_carray(quals, length=n_seqs)
-  else:
-    quals_c = 0
-  cons = consensus.get_consensus(align_c, quals_c, n_seqs, seq_len, cons_thres_c, min_reads,
-                                 qual_thres_c, gapped_c)
-  if PY3:
-    return str(cons, 'utf8')
-  else:
-    return str(cons)
+  if seq_len is None:
+    return 0
+  return seq_len
 
 
 # N.B.: The quality scores must be aligned with their accompanying sequences.
 def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0, min_reads=0,
-                         qual_thres=' ', method='iupac'):
+                         qual_thres=' ', method='iupac', gapped=False):
   assert method in ('iupac', 'freq')
   if PY3:
     method_bytes = bytes(method, 'utf8')
@@ -109,6 +145,10 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
     qual_thres_val = bytes(qual_thres)
   qual_thres_c = ctypes.c_char(qual_thres_val)
   cons_thres_c = ctypes.c_double(cons_thres)
+  if gapped:
+    gapped_c = 1
+  else:
+    gapped_c = 0
   n_seqs1 = len(align1)
   n_seqs2 = len(align2)
   assert (not quals1 and not quals2) or (quals1 and quals2)
@@ -120,6 +160,12 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
       seq_len = len(seq)
     else:
       assert seq_len == len(seq), 'All sequences in the alignment must be the same length.'
+  if seq_len is None:
+    seq_len = 0
+  if _dunovo:
+    cons = _dunovo.get_consensus_duplex(align1, align2, quals1, quals2, cons_thres, min_reads,
+                                        ord(qual_thres), gapped, method)
+    return str(cons, 'utf8')
   align1_c = str_pylist_to_str_carray(align1, length=n_seqs1)
   align2_c = str_pylist_to_str_carray(align2, length=n_seqs2)
   if quals1:
@@ -130,8 +176,10 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
     quals2_c = str_pylist_to_str_carray(quals2, length=n_seqs2)
   else:
     quals2_c = 0
-  cons = consensus.get_consensus_duplex(align1_c, align2_c, quals1_c, quals2_c, n_seqs1, n_seqs2,
-                                        seq_len, cons_thres_c, min_reads, qual_thres_c, method_bytes)
+  output = ctypes.create_string_buffer(seq_len+1)
+  cons = consensus.get_consensus_duplex_buf(align1_c, align2_c, quals1_c, quals2_c, n_seqs1,
+                                            n_seqs2, seq_len, cons_thres_c, min_reads, qual_thres_c,
+                                            gapped_c, method_bytes, output)
   if PY3:
     return str(cons, 'utf8')
   else:
@@ -141,6 +189,8 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
 def build_consensus_duplex_simple(cons1_raw, cons2_raw, gapped=False):
   assert len(cons1_raw) == len(cons2_raw), ('Consensus sequences have different lengths:\n'
                                             '  {}\n  {}'.format(cons1_raw, cons2_raw))
+  if _dunovo:
+    return str(_dunovo.build_consensus_duplex_simple(cons1_raw, cons2_raw, gapped), 'utf8')
   if PY3:
     cons1_bytes = bytes(cons1_raw, 'utf8')
     cons2_bytes = bytes(cons2_raw, 'utf8')
@@ -153,13 +203,36 @@ def build_consensus_duplex_simple(cons1_raw, cons2_raw, gapped=False):
     gapped_c = 1
   else:
     gapped_c = 0
-  cons = consensus.build_consensus_duplex_simple(cons1_c, cons2_c, gapped_c)
+  output = ctypes.create_string_buffer(len(cons1_raw)+1)
+  cons = consensus.build_consensus_duplex_simple_buf(cons1_c, cons2_c, gapped_c, output)
   if PY3:
     return str(cons, 'utf8')
   else:
     return str(cons)
 
 
+def fill_gap_quals(quals_list):
+  """Replace the gaps (spaces) in each of a list of quality score strings with a score averaged from
+  the ones around it (see get_gap_qual_rounded() in consensus.c). Returns a list of the filled-in
+  strings, doing them all in one call to the C code.
+  Raises a ValueError if a string has gaps but no scores to compute them from."""
+  if _dunovo:
+    return [str(quals, 'utf8') for quals in _dunovo.fill_gap_quals(quals_list)]
+  n_seqs = len(quals_list)
+  quals_c = str_pylist_to_str_carray(quals_list, length=n_seqs)
+  seq_lens = [len(quals_c[i]) for i in range(n_seqs)]
+  seq_lens_c = (ctypes.c_int * n_seqs)(*seq_lens)
+  buffers = [ctypes.create_string_buffer(seq_len+1) for seq_len in seq_lens]
+  outputs_c = (ctypes.c_char_p * n_seqs)(*[ctypes.addressof(buf) for buf in buffers])
+  failed = consensus.fill_gap_quals_batch(quals_c, seq_lens_c, n_seqs, outputs_c)
+  if failed != -1:
+    raise ValueError('No gap quality score could be obtained for {!r}.'.format(quals_list[failed]))
+  if PY3:
+    return [str(buf.value, 'utf8') for buf in buffers]
+  else:
+    return [str(buf.value) for buf in buffers]
+
+
 def str_pylist_to_str_carray(str_pylist, length=None, encoding='utf8'):
   if length is None:
     length = len(str_pylist)
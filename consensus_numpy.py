@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""A vectorized version of consensus.get_consensus() which works on a batch of families at once.
+It gives the same results as the C code (including the quality scores it computes for gaps), but
+does the work for all the families in a few NumPy operations instead of one library call per
+family."""
+import sys
+import argparse
+import numpy as np
+
+# These must match the constants in consensus.c.
+BASES = b'ACGTN-'
+THRES_DEFAULT = 0.5
+WIN_LEN = 4
+GAP_CHAR = ord(' ')
+# The weights given to each quality score in the window around a gap, as in get_gap_qual().
+WINDOW_WEIGHTS = np.array([1, 2, 3, 4, 4, 3, 2, 1], dtype=np.int64)
+assert len(WINDOW_WEIGHTS) == WIN_LEN*2
+
+# A lookup table from (ascii) characters in the alignment to their index in BASES, or -1 for
+# characters which don't get a vote. Like the C code, lowercase bases count.
+BASE_CODES = np.full(256, -1, dtype=np.int8)
+for i, base in enumerate(BASES):
+  BASE_CODES[base] = i
+  BASE_CODES[ord(chr(base).lower())] = i
+
+DESCRIPTION = """Get the consensus of a set of aligned sequences, using NumPy."""
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.add_argument('alignment', type=argparse.FileType('r'), nargs='?', default=sys.stdin,
+    help='The aligned sequences, in FASTA format (but no multi-line sequences).')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  sequences = []
+  line_num = 0
+  for line in args.alignment:
+    line_num += 1
+    if line_num % 2 == 0:
+      sequences.append(line.rstrip('\r\n'))
+  cons = get_consensuses([(sequences, [])])[0]
+  print(cons)
+
+
+def get_consensuses(families, cons_thres=-1.0, min_reads=0, qual_thres=' ', gapped=False):
+  """Make a consensus sequence for each family, like consensus.get_consensus().
+  families is a list of (align, quals) tuples, where align is a list of the aligned sequences in
+  the family, and quals is a list of their (aligned) quality scores (or an empty list to count every
+  base). The parameters are the same as in consensus.get_consensus(), and apply to all families.
+  Returns a list of consensus sequences, in the same order as the families."""
+  if cons_thres == -1.0:
+    cons_thres = THRES_DEFAULT
+  if not families:
+    return []
+  # Validate the input and get the dimensions of each family.
+  seq_lens = []
+  n_seqs = []
+  use_quals = None
+  for align, quals in families:
+    # An empty family has no quality scores either way, so it doesn't say which kind of batch it is.
+    if not align:
+      pass
+    elif use_quals is None:
+      use_quals = bool(quals)
+    elif use_quals != bool(quals):
+      raise ValueError('Either all families or none must have quality scores.')
+    assert not quals or len(quals) == len(align), 'Different number of sequences and quals.'
+    seq_len = None
+    for seq in (align + quals):
+      if seq_len is None:
+        seq_len = len(seq)
+      elif seq_len != len(seq):
+        raise AssertionError(
+            'All sequences and quals lines in the alignment must be the same length: {}bp != {}bp. '
+            'Problem sequence:\n{}'.format(seq_len, len(seq), seq)
+        )
+    seq_lens.append(seq_len or 0)
+    n_seqs.append(len(align))
+  # Families with no reads (or zero-length reads) just get an empty consensus.
+  consensuses = ['']*len(families)
+  indices = [i for i, (seq_len, n) in enumerate(zip(seq_lens, n_seqs)) if seq_len > 0 and n > 0]
+  if not indices:
+    return consensuses
+  families = [families[i] for i in indices]
+  seq_lens = np.array([seq_lens[i] for i in indices], dtype=np.int32)
+  n_seqs = np.array([n_seqs[i] for i in indices], dtype=np.int32)
+  # Pack all the reads into matrices, one row per read, padded to the longest read.
+  # The reads of each family are in consecutive rows.
+  row_lens = np.repeat(seq_lens, n_seqs)
+  width = int(seq_lens.max())
+  in_seq = np.arange(width, dtype=np.int32) < row_lens[:, None]
+  seqs = pack_strs([seq for align, quals in families for seq in align], in_seq, 0)
+  codes = BASE_CODES[seqs]
+  if use_quals:
+    quals = pack_strs([qual for align, quals in families for qual in quals], in_seq, GAP_CHAR)
+    quals = get_effective_quals(seqs, quals, row_lens)
+    # Don't count bases under the threshold. The C code compares signed chars.
+    codes[quals < (ord(qual_thres) + 128) % 256 - 128] = -1
+  # Tally the votes for each base at each position of each family, into an array with the shape
+  # (bases, families, width). Characters that don't get a vote are tallied as an extra base, which
+  # is then ignored.
+  codes[codes == -1] = len(BASES)
+  row_families = np.repeat(np.arange(len(families), dtype=np.int32), n_seqs)
+  plane = len(families)*width
+  bins = (codes.astype(np.int32)*plane
+          + (row_families[:, None]*width + np.arange(width, dtype=np.int32)))
+  votes = np.bincount(bins.ravel(), minlength=plane*(len(BASES)+1))
+  votes = votes.reshape(len(BASES)+1, len(families), width)
+  # Pick the consensus base at each position. Only switch to a later base if it has strictly more
+  # votes, like build_consensus().
+  max_votes = votes[0]
+  max_bases = np.full(max_votes.shape, BASES[0], dtype=np.uint8)
+  for i in range(1, len(BASES)):
+    more = votes[i] > max_votes
+    max_votes = np.where(more, votes[i], max_votes)
+    max_bases[more] = BASES[i]
+  passing = ((max_votes > 0) & (max_votes/n_seqs[:, None] > cons_thres)
+             & (max_votes >= min_reads))
+  consensus_matrix = np.where(passing, max_bases, ord('N')).astype(np.uint8)
+  for i, row, seq_len in zip(indices, consensus_matrix, seq_lens):
+    cons = str(row[:seq_len].tobytes(), 'utf8')
+    if not gapped:
+      cons = cons.replace('-', '')
+    consensuses[i] = cons
+  return consensuses
+
+
+def pack_strs(strs, in_seq, fill):
+  """Pack a list of strings into a 2D uint8 array, one string per row.
+  in_seq is a boolean array marking which cells of each row are part of its string."""
+  flat = np.frombuffer(bytes(''.join(strs), 'utf8'), dtype=np.uint8)
+  if len(flat) == in_seq.size:
+    # All the strings are full-length.
+    return flat.reshape(in_seq.shape).copy()
+  elif len(flat) != in_seq.sum():
+    raise ValueError('Sequences and quality scores must be ASCII.')
+  matrix = np.full(in_seq.shape, fill, dtype=np.uint8)
+  matrix[in_seq] = flat
+  return matrix
+
+
+def get_effective_quals(seqs, quals, row_lens):
+  """Get the quality score to use for every base, computing the quality scores of gaps.
+  This replicates the windowing in consensus.c: the quality of a gap is a weighted average of the
+  WIN_LEN "scored" quality scores on either side of it. The scored quality scores are the ones
+  which aren't GAP_CHAR, and the window advances past one every time the sequence has a character
+  that isn't '-'. Gaps are rare, so this works from the lists of gaps and unscored positions instead
+  of doing anything to every base.
+  Returns an array of signed ints (the C code compares signed chars)."""
+  result = quals.view(np.int8).astype(np.int16)
+  gap_rows, gap_cols = np.nonzero(seqs == ord('-'))
+  if len(gap_rows) == 0:
+    return result
+  n_rows, width = seqs.shape
+  # The number of times the window has advanced before each gap: the number of non-gap characters
+  # before it in the sequence.
+  pushes = gap_cols - get_ranks_in_rows(gap_rows)
+  # Find the positions of the unscored quality scores, and how many scored ones are before each.
+  in_seq = np.arange(width, dtype=np.int32) < row_lens[:, None]
+  unscored_rows, unscored_cols = np.nonzero((quals == GAP_CHAR) & in_seq)
+  scored_before = unscored_cols - get_ranks_in_rows(unscored_rows)
+  n_scored = row_lens - np.bincount(unscored_rows, minlength=n_rows)
+  # Offset each row's values so they're all in one sorted array.
+  stride = width + 1
+  unscored_keys = unscored_rows.astype(np.int64)*stride + scored_before
+  unscored_starts = np.searchsorted(unscored_rows, np.arange(n_rows))
+  # The window around each gap holds scored quality scores number pushes-WIN_LEN to
+  # pushes+WIN_LEN-1 (or -1 where those are out of range).
+  rows = gap_rows[:, None]
+  ranks = pushes[:, None] - WIN_LEN + np.arange(WIN_LEN*2)
+  in_range = (ranks >= 0) & (ranks < n_scored[rows])
+  # The column of scored quality score number "rank" is rank + the number of unscored ones before
+  # it (the ones with at most "rank" scored quality scores before them).
+  n_unscored_before = (np.searchsorted(unscored_keys, rows*stride + ranks, side='right')
+                       - unscored_starts[rows])
+  cols = np.clip(ranks + n_unscored_before, 0, width-1)
+  windows = np.where(in_range, result[rows, cols], -1)
+  weights = np.where(in_range, WINDOW_WEIGHTS, 0)
+  score_sums = (windows*weights).sum(axis=1)
+  weight_sums = weights.sum(axis=1)
+  gap_quals = np.zeros(len(gap_rows), dtype=np.int64)
+  has_weight = weight_sums > 0
+  gap_quals[has_weight] = score_sums[has_weight] // weight_sums[has_weight]
+  # Convert to a signed char, like the C code.
+  result[gap_rows, gap_cols] = gap_quals.astype(np.uint8).view(np.int8)
+  return result
+
+
+def get_ranks_in_rows(rows):
+  """Given the sorted row numbers of a list of cells (as from numpy.nonzero()), return the index of
+  each cell among the cells in its row."""
+  return np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
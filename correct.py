@@ -136,9 +136,12 @@ def main(argv):
     logging.info('Building the correction table from the graph..')
     corrections = make_correction_table(graph, family_counts, args.choose_by)
 
+    logging.info('Checking which corrections reverse the order of the barcode..')
+    reversed_corrections = get_reversed_corrections(corrections, reversed_barcodes)
+
     logging.info('Reading the families.tsv again to print corrected output..')
     with open_as_text_or_gzip(args.families.name) as families:
-      print_corrected_output(families, corrections, reversed_barcodes, args.prepend, args.limit,
+      print_corrected_output(families, corrections, reversed_corrections, args.prepend, args.limit,
                              args.output)
 
     run_time = int(time.time() - start_time)
@@ -444,8 +447,8 @@ def make_correction_table(meta_graph, family_counts, choose_by='count'):
   return corrections
 
 
-def print_corrected_output(families_file, corrections, reversed_barcodes, prepend=False, limit=None,
-                           output=True):
+def print_corrected_output(families_file, corrections, reversed_corrections, prepend=False,
+                           limit=None, output=True):
   line_num = 0
   barcode_num = 0
   barcode_last = None
@@ -481,10 +484,7 @@ def print_corrected_output(families_file, corrections, reversed_barcodes, prepen
       correct_barcode = corrections[raw_barcode]
       corrections_in_this_family += 1
       # Check if the order of the barcode reverses in the correct version.
-      # First, we check in reversed_barcodes whether either barcode was involved in a reversed
-      # alignment, to save time (is_alignment_reversed() does a full smith-waterman alignment).
-      if ((raw_barcode in reversed_barcodes or correct_barcode in reversed_barcodes) and
-          is_alignment_reversed(raw_barcode, correct_barcode)):
+      if raw_barcode in reversed_corrections:
         # If so, then switch the order field.
         corrected['reversed'] += 1
         if order == 'ab':
@@ -512,17 +512,42 @@ def print_corrected_output(families_file, corrections, reversed_barcodes, prepen
                .format(**corrected))
 
 
+def get_reversed_corrections(corrections, reversed_barcodes):
+  """Find the corrections which reverse the order of the barcode.
+  Returns the set of the (raw) barcodes whose correction is reversed, as in is_alignment_reversed().
+  Only corrections where either barcode is in reversed_barcodes (involved in a reversed alignment)
+  are checked, and those are all scored in one batch."""
+  raw_barcodes = []
+  for raw_barcode, correct_barcode in corrections.items():
+    if raw_barcode in reversed_barcodes or correct_barcode in reversed_barcodes:
+      raw_barcodes.append(raw_barcode)
+  correct_barcodes = [corrections[raw_barcode] for raw_barcode in raw_barcodes]
+  swapped_barcodes = [swap_halves(correct_barcode) for correct_barcode in correct_barcodes]
+  scores = swalign.smith_waterman_score_batch(raw_barcodes*2, correct_barcodes+swapped_barcodes)
+  fwd_scores = scores[:len(raw_barcodes)]
+  rev_scores = scores[len(raw_barcodes):]
+  reversed_corrections = set()
+  for raw_barcode, fwd_score, rev_score in zip(raw_barcodes, fwd_scores, rev_scores):
+    if rev_score > fwd_score:
+      reversed_corrections.add(raw_barcode)
+  return reversed_corrections
+
+
+def swap_halves(barcode):
+  half = len(barcode)//2
+  return barcode[half:] + barcode[:half]
+
+
 def is_alignment_reversed(barcode1, barcode2):
   """Return True if the barcodes are reversed with respect to each other, False otherwise.
   "reversed" in this case meaning the alpha + beta halves are swapped.
   Determine by aligning the two to each other, once in their original forms, and once with the
   second barcode reversed. If the smith-waterman score is higher in the reversed form, return True.
   """
-  half = len(barcode2)//2
-  barcode2_rev = barcode2[half:] + barcode2[:half]
-  fwd_align = swalign.smith_waterman(barcode1, barcode2)
-  rev_align = swalign.smith_waterman(barcode1, barcode2_rev)
-  if rev_align.score > fwd_align.score:
+  barcode2_rev = swap_halves(barcode2)
+  fwd_score = swalign.smith_waterman_score(barcode1, barcode2)
+  rev_score = swalign.smith_waterman_score(barcode1, barcode2_rev)
+  if rev_score > fwd_score:
     return True
   else:
     return False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import sys
+import signal
+import logging
+import argparse
+import socket_executor
+import shims
+# There can be problems with the submodules, but none are essential.
+# Try to load these modules, but if there's a problem, load a harmless dummy and continue.
+simplewrap = shims.get_module_or_shim('utillib.simplewrap')
+version = shims.get_module_or_shim('utillib.version')
+
+USAGE = """$ %(prog)s [options] HOST:PORT
+       $ %(prog)s [options] /path/to/socket"""
+DESCRIPTION = """Run the work of another Du Novo script in worker processes on this machine. Start \
+this on each host, then give its address to the script's --worker option (e.g. \
+"align-families.py --worker node1:7070 --worker node2:7070"). This serves one script at a time. \
+Tasks are sent as Python pickles, so only listen on a trusted network. To listen on TCP, set the \
+{} environment variable to the same secret for the workers and the script, so they \
+authenticate each other. Unix sockets can be used without it, since only their owner can connect \
+to them.""".format(socket_executor.AUTHKEY_VAR)
+
+
+def make_argparser():
+
+  wrapper = simplewrap.Wrapper()
+  wrap = wrapper.wrap
+  parser = argparse.ArgumentParser(usage=USAGE, description=wrap(DESCRIPTION),
+                                   formatter_class=argparse.RawTextHelpFormatter)
+
+  wrapper.width = wrapper.width - 24
+  parser.add_argument('address',
+    help=wrap('The address to listen on. Either HOST:PORT for TCP (use 0.0.0.0 as the HOST to '
+              'listen on all interfaces, and set {} first) or the path of a Unix socket to '
+              'create.'.format(socket_executor.AUTHKEY_VAR)))
+  parser.add_argument('-p', '--processes', type=int,
+    help=wrap('Number of worker processes to run the tasks in. Default: the number of CPU cores.'))
+  parser.add_argument('--version', action='version', version=str(version.get_version()),
+    help=wrap('Print the version number and exit.'))
+  parser.add_argument('-L', '--log-file', type=argparse.FileType('w'), default=sys.stderr,
+    help=wrap('Print log messages to this file instead of to stderr. NOTE: Will overwrite the file.'))
+  parser.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL,
+                      default=logging.WARNING)
+  parser.add_argument('-v', '--verbose', dest='volume', action='store_const', const=logging.INFO)
+  parser.add_argument('-D', '--debug', dest='volume', action='store_const', const=logging.DEBUG)
+
+  return parser
+
+
+def main(argv):
+
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+
+  logging.basicConfig(stream=args.log_file, level=args.volume, format='%(message)s')
+
+  if args.processes is not None and args.processes <= 0:
+    fail('Error: --processes must be greater than zero.')
+
+  # Exit cleanly on SIGTERM, so the worker processes are stopped and the socket file is removed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+  try:
+    socket_executor.serve(args.address, processes=args.processes)
+  except ValueError as error:
+    fail(f'Error: {error}')
+  except KeyboardInterrupt:
+    pass
+
+
+def fail(message):
+  sys.stderr.write(message+"\n")
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -3,14 +3,31 @@ import argparse
 import gzip
 import logging
 import os
+import selectors
+import signal
 import subprocess
 import sys
+import threading
+import time
 import shims
 assert sys.version_info.major >= 3, 'Python 3 required'
 version = shims.get_module_or_shim('utillib.version')
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DESCRIPTION = """Run the entire Du Novo pipeline."""
+# How often to check on the steps of a pipeline, when we can't be notified when they exit.
+PIPELINE_POLL_INTERVAL = 0.5
+# How long to wait for the steps of a failed pipeline to exit before sending them a SIGKILL.
+KILL_TIMEOUT = 5
+# The signals which should stop the run and take the steps of the pipeline down with it.
+TERMINATE_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+
+class TerminatedError(Exception):
+  """Raised in the main thread when dunovo.py receives one of the TERMINATE_SIGNALS."""
+  def __init__(self, signum):
+    super().__init__('Received signal {}.'.format(signum))
+    self.signum = signum
 
 
 def make_argparser():
@@ -39,6 +56,8 @@ def make_argparser():
     help='correct.py --pos. Default: the correct.py default.')
   params.add_argument('-a', '--aligner', choices=('mafft', 'kalign'), default='kalign',
     help='align-families.py --aligner. Default: %(default)s')
+  params.add_argument('-j', '--joint', action='store_true',
+    help='Pass --joint to align-families.py and make-consensi.py.')
   params.add_argument('-r', '--min-reads', type=int,
     help='make-consensi.py --min-reads. Default: the make-consensi.py default.')
   params.add_argument('-q', '--qual', type=int, default=25,
@@ -53,6 +72,12 @@ def make_argparser():
     help='Pass --no-check-ids to correct.py and align-families.py.')
   params.add_argument('-p', '--processes', type=int,
     help='align-families.py --processes. Default: the align-families.py default.')
+  params.add_argument('-f', '--fused', action='store_true',
+    help='Align the families and make the consensus sequences in one step, with '
+         '"make-consensi.py --align", instead of piping align-families.py into make-consensi.py. '
+         'The alignments aren\'t written to families.msa.tsv unless --keep-msa is given.')
+  params.add_argument('-k', '--keep-msa', action='store_true',
+    help='With --fused, still write the alignments to families.msa.tsv (for debugging).')
   params.add_argument('-t', '--threads', type=int,
     help='baralign.sh -t. Default: the baralign.sh default.')
   params.add_argument('-b', '--filt-bases', default='N',
@@ -92,6 +117,11 @@ def main(argv):
   stream = make_main_log_stream(args.log_dir, args.suffix)
   logging.basicConfig(stream=stream, level=args.volume, format='%(message)s')
 
+  # The steps each run in their own session, so they won't get the signals sent to our process
+  # group. Turn those signals into an exception instead, so the steps get killed on the way out.
+  for signum in TERMINATE_SIGNALS:
+    signal.signal(signum, raise_terminated)
+
   # Create and check output paths.
   if not os.path.isdir(args.outdir):
     if os.path.exists(args.outdir):
@@ -136,6 +166,10 @@ def main(argv):
       fail('Error: baralign.sh output not as expected.')
 
   # The 3rd pipeline.
+  if args.fused:
+    align_steps = get_fused_steps(args, paths, logs)
+  else:
+    align_steps = get_unfused_steps(args, paths, logs)
   steps = [
     {  # $ correct.py
       'command': ([os.path.join(args.dunovo_dir, 'correct.py')] + get_correct_args(**vars(args))
@@ -150,6 +184,25 @@ def main(argv):
       'command': ('tee', '-a', paths['families_corrected']),
       'stderr': None
     },
+  ] + align_steps
+  run_pipeline(steps)
+
+  # The 4th pipeline.
+  steps = [
+    {  # $ trimmer.py
+      'command': ([os.path.join(args.dunovo_dir, 'bfx/trimmer.py'), '--format', 'fastq']
+                  + get_trimmer_args(**vars(args)) + [paths['duplex1'], paths['duplex2'],
+                   paths['dupfilt1'], paths['dupfilt2']]),
+      'stderr': logs['trimmer']
+    }
+  ]
+  run_pipeline(steps)
+
+
+def get_unfused_steps(args, paths, logs):
+  """The steps of the 3rd pipeline which align the families and make the consensus sequences:
+  align-families.py | tee families.msa.tsv | make-consensi.py"""
+  return [
     {  # $ align-families.py
       'command': ([os.path.join(args.dunovo_dir, 'align-families.py')]
                   + get_align_families_args(**vars(args))),
@@ -161,23 +214,25 @@ def main(argv):
     },
     {  # $ make-consensi.py
       'command': ([os.path.join(args.dunovo_dir, 'make-consensi.py')]
-                  + get_make_consensi_args(**vars(args)) + ['--sscs1', paths['sscs1'], '--sscs2',
-                  paths['sscs2'], '-1', paths['duplex1'], '-2', paths['duplex2']]),
+                  + get_make_consensi_args(**vars(args)) + get_consensi_output_args(paths)),
       'stderr': logs['make-consensi']
     }
   ]
-  run_pipeline(steps)
 
-  # The 4th pipeline.
-  steps = [
-    {  # $ trimmer.py
-      'command': ([os.path.join(args.dunovo_dir, 'bfx/trimmer.py'), '--format', 'fastq']
-                  + get_trimmer_args(**vars(args)) + [paths['duplex1'], paths['duplex2'],
-                   paths['dupfilt1'], paths['dupfilt2']]),
-      'stderr': logs['trimmer']
-    }
-  ]
-  run_pipeline(steps)
+
+def get_fused_steps(args, paths, logs):
+  """The same as get_unfused_steps(), but in one make-consensi.py --align step."""
+  command = ([os.path.join(args.dunovo_dir, 'make-consensi.py'), '--align']
+             + get_make_consensi_args(**vars(args)) + get_fused_args(**vars(args))
+             + get_consensi_output_args(paths))
+  if args.keep_msa:
+    command.extend(['--msa', paths['msa']])
+  return [{'command':command, 'stderr':logs['make-consensi']}]
+
+
+def get_consensi_output_args(paths):
+  return ['--sscs1', paths['sscs1'], '--sscs2', paths['sscs2'], '-1', paths['duplex1'], '-2',
+          paths['duplex2']]
 
 
 def open_as_text_or_gzip(path):
@@ -354,6 +409,13 @@ def get_correct_args(**kwargs):
 
 
 def get_align_families_args(**kwargs):
+  arg_list = ('aligner', 'processes')
+  flag_list = ('no_check_ids', 'joint')
+  return get_generic_args(arg_list, flag_list, kwargs)
+
+
+def get_fused_args(**kwargs):
+  # --joint is already passed by get_make_consensi_args().
   arg_list = ('aligner', 'processes')
   flag_list = ('no_check_ids',)
   return get_generic_args(arg_list, flag_list, kwargs)
@@ -361,8 +423,9 @@ def get_align_families_args(**kwargs):
 
 def get_make_consensi_args(fake_phred=40, **kwargs):
   arg_list = ('min_reads', 'qual', 'cons_thres', 'min_cons_thres')
+  flag_list = ('joint',)
   args = ['--fastq-out', str(fake_phred)]
-  return args + get_generic_args(arg_list, (), kwargs)
+  return args + get_generic_args(arg_list, flag_list, kwargs)
 
 
 def get_trimmer_args(**kwargs):
@@ -481,39 +544,158 @@ def run_pipeline(steps, stdin=None, stdout=None, stdout_type=str):
         kwargs['stdout'] = stdout
         if hasattr(stdout, 'name'):
           cmd_str += ' > '+stdout.name
-    # Create the actual process and add it to the list.
-    processes.append(subprocess.Popen(step['command'], **kwargs))
+    # Create the actual process and add it to the list. Put each one in its own process group, so
+    # it can be killed along with any processes it starts.
+    processes.append(subprocess.Popen(step['command'], start_new_session=True, **kwargs))
     logging.warning(cmd_str)
-  # Kick it off by closing the first stdout. The docs say this is necessary in order for the first
-  # process to receive a SIGPIPE if the second (or later?) process exits before the first process.
-  if processes[0].stdout:
-    processes[0].stdout.close()
-  # If the input is from a function, start feeding it in.
+    # Close our copy of the pipe from the previous step, so that step receives a SIGPIPE if this one
+    # exits early.
+    if i > 0:
+      processes[i-1].stdout.close()
+  start_time = time.time()
+  threads = []
+  # If the input is from a function, feed it in from another thread, so we can watch the processes
+  # while it runs.
+  feed_errors = []
   if fxn_stdin:
-    function = stdin['function']
-    args = stdin['fxn_args']
+    thread = threading.Thread(target=feed_stdin, daemon=True,
+                              args=(processes[0].stdin, stdin['function'], stdin['fxn_args'],
+                                    feed_errors))
+    thread.start()
+    threads.append(thread)
+  # If the output was requested, collect it in another thread, too.
+  output = []
+  if stdout == subprocess.PIPE:
+    thread = threading.Thread(target=lambda: output.append(processes[-1].stdout.read()),
+                              daemon=True)
+    thread.start()
+    threads.append(thread)
+  wait_for_pipeline(processes, start_time, feed_errors)
+  for thread in threads:
+    thread.join()
+  if stdout == subprocess.PIPE:
+    processes[-1].stdout.close()
+    try:
+      if stdout_type is str:
+        return str(output[0], 'utf8').rstrip('\r\n')
+      else:
+        return stdout_type(output[0])
+    except ValueError as error:
+      fail('Error: Encountered {} when converting output of command to {}: $ {}'
+           .format(type(error).__name__, stdout_type.__name__, ' '.join(processes[-1].args)))
+
+
+def feed_stdin(stdin, function, args, errors):
+  """Write the output of the function to the first step's stdin. If the function raises an
+  exception, add it to the errors list for wait_for_pipeline() to report."""
+  try:
     for line in function(*args):
-      processes[0].stdin.write(line)
-    processes[0].stdin.close()
-  # Wait for all processes to finish and check their exit codes.
-  for i, process in enumerate(processes):
-    if i < len(steps)-1 or stdout != subprocess.PIPE:
-      result = process.wait()
-      if result != 0:
-        fail('Error: Process exited with code {}: $ {}'.format(result, ' '.join(process.args)))
-    else:
-      # Last step, whose output has been requested as the return value.
-      stdout_bytes, stderr_bytes = process.communicate()
-      if process.returncode != 0:
-        fail('Error: Process exited with code {}: $ {}'.format(result, ' '.join(process.args)))
-      try:
-        if stdout_type is str:
-          return str(stdout_bytes, 'utf8').rstrip('\r\n')
-        else:
-          return stdout_type(stdout_bytes)
-      except ValueError as error:
-        fail('Error: Encountered {} when converting output of command to {}: $ {}'
-             .format(type(error).__name__, stdout_type.__name__, ' '.join(process.args)))
+      stdin.write(line)
+  except BrokenPipeError:
+    # The first process exited. wait_for_pipeline() will find out why.
+    pass
+  except Exception as error:
+    errors.append(error)
+  finally:
+    # Always close it, or the first step will wait forever for the rest of its input.
+    try:
+      stdin.close()
+    except BrokenPipeError:
+      pass
+
+
+def wait_for_pipeline(processes, start_time, feed_errors=()):
+  """Watch all the processes in a pipeline at once until they've all exited.
+  As soon as one fails, kill all the others (and any processes they started), then fail with a
+  message saying which step failed and how long into the run. A step killed by SIGPIPE doesn't count
+  as a failure by itself: that just means a later step stopped reading its output. If that later
+  step failed, it'll be reported instead.
+  feed_errors is the list feed_stdin() adds to. If an exception shows up there, the input was cut
+  short, so the steps are killed the same way."""
+  selector = selectors.DefaultSelector()
+  # On Linux, a pidfd becomes readable when its process exits. Elsewhere, fall back to polling.
+  poll_interval = None
+  for process in processes:
+    try:
+      selector.register(os.pidfd_open(process.pid), selectors.EVENT_READ, process)
+    except (AttributeError, OSError):
+      poll_interval = PIPELINE_POLL_INTERVAL
+  running = list(processes)
+  try:
+    while running:
+      check_feed_errors(feed_errors, processes, running, start_time)
+      if selector.get_map():
+        selector.select(timeout=poll_interval)
+      else:
+        time.sleep(poll_interval)
+      for process in list(running):
+        if process.poll() is None:
+          continue
+        running.remove(process)
+        unregister_process(selector, process)
+        if process.returncode != 0 and process.returncode != -signal.SIGPIPE:
+          elapsed = time.time() - start_time
+          kill_processes(running)
+          step = processes.index(process) + 1
+          message = ('Error: Step {} of {} exited with code {} after {:0.1f} seconds: $ {}'
+                     .format(step, len(processes), process.returncode, elapsed,
+                             ' '.join(process.args)))
+          if running:
+            message += '\nKilled {} other running step(s).'.format(len(running))
+          fail(message)
+    check_feed_errors(feed_errors, processes, running, start_time)
+  except (KeyboardInterrupt, TerminatedError):
+    kill_processes(running)
+    raise
+  finally:
+    for key in list(selector.get_map().values()):
+      os.close(key.fd)
+    selector.close()
+
+
+def check_feed_errors(feed_errors, processes, running, start_time):
+  if not feed_errors:
+    return
+  error = feed_errors[0]
+  elapsed = time.time() - start_time
+  kill_processes(running)
+  message = ('Error: Reading the input failed with {}: {} after {:0.1f} seconds. It was being fed '
+             'to: $ {}'.format(type(error).__name__, error, elapsed, ' '.join(processes[0].args)))
+  if running:
+    message += '\nKilled {} running step(s).'.format(len(running))
+  fail(message)
+
+
+def raise_terminated(signum, frame):
+  raise TerminatedError(signum)
+
+
+def unregister_process(selector, process):
+  for key in list(selector.get_map().values()):
+    if key.data is process:
+      selector.unregister(key.fd)
+      os.close(key.fd)
+
+
+def kill_processes(processes):
+  """Terminate each process and the others in its process group, then kill any which are still
+  running after KILL_TIMEOUT seconds."""
+  for process in processes:
+    signal_group(process, signal.SIGTERM)
+  deadline = time.time() + KILL_TIMEOUT
+  for process in processes:
+    try:
+      process.wait(timeout=max(0, deadline-time.time()))
+    except subprocess.TimeoutExpired:
+      signal_group(process, signal.SIGKILL)
+      process.wait()
+
+
+def signal_group(process, signum):
+  try:
+    os.killpg(process.pid, signum)
+  except ProcessLookupError:
+    pass
 
 
 def fail(message):
@@ -529,3 +711,6 @@ if __name__ == '__main__':
     sys.exit(main(sys.argv))
   except BrokenPipeError:
     pass
+  except TerminatedError as error:
+    logging.critical('Error: Stopped by signal {}.'.format(error.signum))
+    sys.exit(128+error.signum)
@@ -6,20 +6,30 @@ import logging
 import argparse
 import resource
 import collections
+import multiprocessing
+import distutils.spawn
 import parallel_tools
 import consensus
 import swalign
+import threaded_writer
 import shims
 # There can be problems with the submodules, but none are essential.
 # Try to load these modules, but if there's a problem, load a harmless dummy and continue.
 simplewrap = shims.get_module_or_shim('utillib.simplewrap')
 version = shims.get_module_or_shim('utillib.version')
 phone = shims.get_module_or_shim('ET.phone')
+align_families = shims.import_script('align-families.py')
 
 # The ascii values that represent a 0 PHRED score.
 QUAL_OFFSETS = {'sanger':33, 'solexa':64}
+# The default --batch-size for --engine numpy.
+NUMPY_BATCH_SIZE = 64
+# The modules for a forkserver to import before starting the worker processes. Importing consensus
+# and swalign loads their C libraries.
+PRELOAD_MODULES = ('__main__', 'parallel_tools', 'consensus', 'swalign', 'seqtools')
 USAGE = """$ %(prog)s [options] families.msa.tsv -1 duplexes_1.fa -2 duplexes_2.fa
-       $ cat families.msa.tsv | %(prog)s [options] -1 duplexes_1.fa -2 duplexes_2.fa"""
+       $ cat families.msa.tsv | %(prog)s [options] -1 duplexes_1.fa -2 duplexes_2.fa
+       $ %(prog)s --align [options] families.tsv -1 duplexes_1.fa -2 duplexes_2.fa"""
 DESCRIPTION = """Build consensus sequences from read aligned families. Prints duplex consensus \
 sequences in FASTA to stdout. The sequence ids are BARCODE.MATE, e.g. "CTCAGATAACATACCTTATATGCA.1", \
 where "BARCODE" is the input barcode, and "MATE" is "1" or "2" as an arbitrary designation of the \
@@ -53,7 +63,8 @@ def make_argparser():
               '3. mate ("1" or "2")\n'
               '4. read name\n'
               '5. aligned sequence\n'
-              '6. aligned quality scores.'))
+              '6. aligned quality scores.\n'
+              'With --align, this is instead the input to align_families.py (families.tsv).'))
   io.add_argument('-1', '--dcs1', metavar='duplex_1.fa', type=argparse.FileType('w'),
     help=wrap('The file to output the first mates of the duplex consensus sequences into. '
               'Warning: This will be overwritten if it exists!'))
@@ -65,6 +76,10 @@ def make_argparser():
   io.add_argument('--sscs2', metavar='sscs_2.fa', type=argparse.FileType('w'),
     help=wrap('Save the single-strand consensus sequences (mate 2) in this file (FASTA format). '
               'Warning: This will be overwritten if it exists!'))
+  io.add_argument('-z', '--compress', choices=threaded_writer.COMPRESSIONS,
+    help=wrap('Compress the output files with gzip, or with BGZF (the blocked gzip format used by '
+              'samtools and tabix, which is also readable by gzip). The compression is done in a '
+              'background thread for each output file.'))
   io.add_argument('-F', '--qual-format', choices=QUAL_OFFSETS.keys(), default='sanger',
     help=wrap('FASTQ quality score format. Sanger scores are assumed to begin at \'{}\' ({}). '
               'Default: %(default)s.'.format(QUAL_OFFSETS['sanger'], chr(QUAL_OFFSETS['sanger']))))
@@ -73,6 +88,20 @@ def make_argparser():
               'bases. There is no meaningful quality score we can automatically give, so you will '
               'have to specify an artificial one. A good choice is 40, the maximum score normally '
               'output by sequencers.'))
+  align = parser.add_argument_group('Alignment')
+  align.add_argument('--align', action='store_true',
+    help=wrap('Align the families too, in place of align-families.py. The input is the sorted '
+              'families.tsv that align-families.py takes, and each duplex is aligned and made into '
+              'consensus sequences by the same worker, so the alignments never have to be written '
+              'out and parsed back in.'))
+  align.add_argument('-a', '--aligner', choices=('mafft', 'kalign', 'dummy'), default='kalign',
+    help=wrap('The multiple sequence aligner to use with --align. Default: %(default)s'))
+  align.add_argument('-I', '--no-check-ids', dest='check_ids', action='store_false', default=True,
+    help=wrap('With --align, don\'t check that the two reads in each pair have identical ids.'))
+  align.add_argument('--msa', metavar='families.msa.tsv', type=argparse.FileType('w'),
+    help=wrap('With --align, also write the alignments to this file, in the format '
+              'align-families.py outputs. Useful for debugging. Warning: This will be overwritten '
+              'if it exists!'))
   params = parser.add_argument_group('Algorithm parameters')
   params.add_argument('-r', '--min-reads', type=int, default=3,
     help=wrap('The minimum number of reads (from each strand) required to form a single-strand '
@@ -88,6 +117,11 @@ def make_argparser():
     help=wrap('The absolute threshold to use when making consensus sequences. The consensus base '
               'must be present in more than this number of reads, or N will be used as the '
               'consensus base instead. Default: %(default)s'))
+  params.add_argument('-j', '--joint', action='store_true',
+    help=wrap('The input was made with "align-families.py --joint", so the two families making up '
+              'each duplex consensus read were aligned together. Build the duplex consensus '
+              'directly from the aligned columns of the two single-strand consensus sequences '
+              'instead of aligning them to each other.'))
   phoning = parser.add_argument_group('Feedback')
   phoning.add_argument('--phone-home', action='store_true',
     help=wrap('Report helpful usage data to the developer, to better understand the use cases and '
@@ -116,10 +150,58 @@ def make_argparser():
     help=wrap('Number of worker subprocesses to use. If 0, no subprocesses will be started and '
               'everything will be done inside one process. Give "auto" to use as many processes '
               'as there are CPU cores. Default: %(default)s.'))
+  misc.add_argument('-t', '--threads', type=int,
+    help=wrap('Make the consensus sequences in this many threads inside the main process, instead '
+              'of in worker --processes. The threads share the parsed input, so nothing has to be '
+              'copied to subprocesses, and they can run at the same time because the C code '
+              'releases the GIL (this works best with the _dunovo extension module built). The '
+              'output is in the same order either way. Cannot be combined with --processes.'))
   misc.add_argument('--queue-size', type=int,
     help=wrap('How long to go accumulating responses from worker subprocesses before dealing '
               'with all of them. Default: {} * the number of worker --processes.'
               .format(parallel_tools.QUEUE_SIZE_MULTIPLIER)))
+  misc.add_argument('--queue-mem', metavar='MB', type=float,
+    help=wrap('Also stop to deal with the responses from the workers whenever the duplexes waiting '
+              'on them add up to this many megabytes (estimated from the length of their reads). '
+              'This bounds the memory used by a mix of small and huge families, where --queue-size '
+              'alone can let a few huge ones pile up. Default: no limit.'))
+  misc.add_argument('--start-method', choices=multiprocessing.get_all_start_methods(),
+    help=wrap('How to start the worker --processes: the multiprocessing start method. With '
+              '"forkserver", a server process imports this script and the C libraries once, and '
+              'every worker is forked from it, already warmed up. Default: the platform default '
+              '("fork" on Linux).'))
+  misc.add_argument('--metrics', metavar='metrics.jsonl',
+    help=wrap('Periodically write statistics on the worker --processes to this file, as one JSON '
+              'object per line: the tasks in flight, how busy each worker was, how long this '
+              'process spent waiting on them, the pickled size of the tasks, and the results per '
+              'second. If this is an existing Unix socket, connect to it and write there instead. '
+              'See parallel_tools.PoolMetrics for the fields. Warning: Will overwrite the file.'))
+  misc.add_argument('--metrics-interval', metavar='SECONDS', type=float,
+    default=parallel_tools.METRICS_INTERVAL,
+    help=wrap('How often to write a --metrics record. Default: %(default)s'))
+  misc.add_argument('--max-retries', metavar='N', type=int, default=2,
+    help=wrap('If a worker process dies (e.g. it\'s killed for using too much memory) or fails on a '
+              'duplex, replace it and retry each duplex it was working on on its own, up to N '
+              'times. Default: %(default)s'))
+  misc.add_argument('--rejects', metavar='rejects.tsv', type=argparse.FileType('w'),
+    help=wrap('Write the duplexes which still fail after --max-retries to this file (in the same '
+              'format as the input) and carry on without them. With a --batch-size, the whole '
+              'batch is written. Without this, the first one ends the run with an error. Warning: '
+              'Will overwrite the file.'))
+  misc.add_argument('--no-mmap', dest='mmap', action='store_false', default=True,
+    help=wrap('Always parse the input in the main process. By default, when using worker '
+              '--processes and the input is a regular file, the main process only scans for the '
+              'boundaries of each duplex and the workers read and parse their own duplexes from a '
+              'memory-mapped copy of the file.'))
+  misc.add_argument('--engine', choices=('c', 'numpy'), default='c',
+    help=wrap('How to compute the single-strand consensus sequences. "c" uses the C library (in '
+              'one call per --batch-size of duplexes, if the _dunovo extension module is built). '
+              '"numpy" computes them for a whole --batch-size of duplexes at once with NumPy, '
+              'which is faster for small families. The results are identical. '
+              'Default: %(default)s'))
+  misc.add_argument('--batch-size', type=int,
+    help=wrap('Number of duplexes to hand to a worker process at once. Default: {} with '
+              '--engine numpy, otherwise 1.'.format(NUMPY_BATCH_SIZE)))
   misc.add_argument('-v', '--version', action='version', version=str(version.get_version()),
     help=wrap('Print the version number and exit.'))
   misc.add_argument('-h', '--help', action='store_true',
@@ -148,7 +230,14 @@ def main(argv):
     data = {
       'stdin': args.infile is sys.stdin,
       'processes': args.processes,
+      'threads': args.threads,
+      'joint': args.joint,
+      'engine': args.engine,
+      'batch_size': args.batch_size,
       'queue_size': args.queue_size,
+      'compress': args.compress,
+      'start_method': args.start_method,
+      'aligner': args.aligner if args.align else None,
     }
     if data['stdin']:
       data['input_size'] = None
@@ -164,6 +253,21 @@ def main(argv):
     # Process and validate arguments.
     if args.queue_size is not None and args.queue_size <= 0:
       fail('Error: --queue-size must be greater than zero.')
+    if args.queue_mem is not None and args.queue_mem <= 0:
+      fail('Error: --queue-mem must be greater than zero.')
+    if args.metrics_interval <= 0:
+      fail('Error: --metrics-interval must be greater than zero.')
+    if args.max_retries < 0:
+      fail('Error: --max-retries cannot be negative.')
+    if args.threads is not None:
+      if args.threads <= 0:
+        fail('Error: --threads must be greater than zero.')
+      if str(args.processes) != '0':
+        fail('Error: --threads and --processes cannot be used together.')
+      if args.metrics:
+        fail('Error: --metrics only works with worker --processes, not --threads.')
+      if args.rejects:
+        fail('Error: --rejects only works with worker --processes, not --threads.')
     qual_start = QUAL_OFFSETS[args.qual_format]
     qual_thres = chr(args.qual + qual_start)
     if args.fastq_out is None:
@@ -180,31 +284,108 @@ def main(argv):
            'reads, give --min-reads X instead of --min-cons-reads X.')
     if not any((args.dcs1, args.dcs2, args.sscs1, args.sscs2)):
       fail('Error: must specify an output file!')
+    if args.msa and not args.align:
+      fail('Error: --msa only works with --align.')
+    if args.align and args.aligner == 'mafft' and not distutils.spawn.find_executable('mafft'):
+      fail('Error: Could not find "mafft" command on $PATH.')
+    if args.batch_size is None:
+      if args.engine == 'numpy':
+        args.batch_size = NUMPY_BATCH_SIZE
+      else:
+        args.batch_size = 1
+    elif args.batch_size <= 0:
+      fail('Error: --batch-size must be greater than zero.')
+    if args.engine == 'numpy':
+      try:
+        import consensus_numpy
+      except ImportError:
+        fail('Error: --engine numpy requires the numpy module.')
     # A dict of output filehandles.
     # Indexed so we can do filehandles['dcs'][mate].
     filehandles = {
-      'dcs': (args.dcs1, args.dcs2),
-      'sscs': (args.sscs1, args.sscs2),
+      'dcs': (open_output(args.dcs1, args.compress), open_output(args.dcs2, args.compress)),
+      'sscs': (open_output(args.sscs1, args.compress), open_output(args.sscs2, args.compress)),
+      'msa': open_output(args.msa),
+      'rejects': args.rejects,
     }
 
     # Open a pool of worker processes.
-    stats = {'time':0, 'reads':0, 'runs':0, 'duplexes':0}
+    stats = {'time':0, 'reads':0, 'runs':0, 'duplexes':0, 'total_reads':0, 'rejects':0}
+    if args.align:
+      stats.update({'align_time':0, 'align_failures':0})
     static_kwargs = {
       'min_reads': args.min_reads,
       'cons_thres': args.cons_thres,
       'min_cons_reads': args.min_cons_reads,
       'qual_thres': qual_thres,
       'output_qual': output_qual,
+      'joint': args.joint,
     }
-    pool = parallel_tools.SyncAsyncPool(process_duplex,
-                                        processes=args.processes,
-                                        static_kwargs=static_kwargs,
-                                        queue_size=args.queue_size,
-                                        callback=process_result,
-                                        callback_args=[filehandles, stats],
-                                       )
+    # If we can, let the workers parse their own duplexes straight from the input file.
+    use_mmap = (args.mmap and str(args.processes) != '0' and
+                parallel_tools.is_mappable(args.infile))
+    # Whether to hand duplexes to the workers in batches.
+    batched = args.batch_size > 1 or args.engine != 'c'
+    if batched:
+      static_kwargs['engine'] = args.engine
+      callback = process_results
+      if args.align:
+        function = align_duplexes_slice if use_mmap else align_duplexes
+      else:
+        function = process_duplexes_slice if use_mmap else process_duplexes
+    else:
+      callback = process_result
+      if args.align:
+        function = align_duplex_slice if use_mmap else align_duplex
+      else:
+        function = process_duplex_slice if use_mmap else process_duplex
+    if args.align:
+      static_kwargs['aligner'] = args.aligner
+      static_kwargs['keep_msa'] = args.msa is not None
+      if use_mmap:
+        static_kwargs['check_ids'] = args.check_ids
+    if args.queue_mem is None:
+      max_bytes = None
+    else:
+      max_bytes = int(args.queue_mem*1024*1024)
+    if args.threads:
+      pool_class = parallel_tools.SyncAsyncThreadPool
+      workers = args.threads
+      pool_kwargs = {}
+    else:
+      pool_class = parallel_tools.SyncAsyncPool
+      workers = args.processes
+      pool_kwargs = {'start_method':args.start_method, 'preload':PRELOAD_MODULES,
+                     'max_retries':args.max_retries}
+      if args.rejects:
+        pool_kwargs['reject_callback'] = reject_duplexes
+        pool_kwargs['reject_args'] = [filehandles, stats, args.align]
+      if args.metrics:
+        try:
+          pool_kwargs['metrics'] = parallel_tools.PoolMetrics.open(args.metrics,
+                                                                   interval=args.metrics_interval)
+        except OSError as error:
+          fail('Error: Could not open --metrics output {!r}: {}'.format(args.metrics, error))
+    pool = pool_class(function,
+                      processes=workers,
+                      static_kwargs=static_kwargs,
+                      queue_size=args.queue_size,
+                      callback=callback,
+                      callback_args=[filehandles, stats],
+                      max_bytes=max_bytes,
+                      task_sizer=parallel_tools.slice_task_size if use_mmap else None,
+                      **pool_kwargs
+                     )
     try:
-      process_families(args.infile, pool, stats)
+      if use_mmap:
+        process_families_mmap(args.infile.name, pool, stats, batched=batched,
+                              batch_size=args.batch_size, align=args.align)
+      else:
+        if args.align:
+          duplexes = parse_families(args.infile, stats, check_ids=args.check_ids)
+        else:
+          duplexes = parse_duplexes(args.infile, stats)
+        process_families(duplexes, pool, stats, batched=batched, batch_size=args.batch_size)
     finally:
       # If the root process encounters an exception and doesn't tell the workers to stop, it will
       # hang forever.
@@ -213,7 +394,8 @@ def main(argv):
       # Close all open filehandles.
       if args.infile is not sys.stdin:
         args.infile.close()
-      for fh_group in filehandles.values():
+      for fh_group in (filehandles['dcs'], filehandles['sscs'],
+                       (filehandles['msa'], filehandles['rejects'])):
         for fh in fh_group:
           if fh:
             fh.close()
@@ -227,7 +409,19 @@ def main(argv):
       per_read = stats['time'] / stats['reads']
       per_run = stats['time'] / stats['runs']
       logging.info('{:0.3f}s per read, {:0.3f}s per run.'.format(per_read, per_run))
+    if args.align:
+      logging.info('{:0.2f}s spent aligning, with {} alignment failures.'
+                   .format(stats['align_time'], stats['align_failures']))
     logging.info('in {}s total time and {:0.2f}MB RAM.'.format(run_time, max_mem))
+    if stats['rejects']:
+      logging.warning('{} duplexes kept failing and were written to --rejects.'
+                      .format(stats['rejects']))
+    if pool.time_to_first_result is not None:
+      logging.info('The first result was ready {:0.3f}s after starting the workers.'
+                   .format(pool.time_to_first_result))
+    if max_bytes is not None:
+      logging.info('At most {:0.2f}MB of duplexes were in flight at once.'
+                   .format(pool.max_inflight_bytes/1024/1024))
 
   except (Exception, KeyboardInterrupt) as exception:
     if args.phone_home and call:
@@ -259,15 +453,72 @@ def main(argv):
     call.send_data('end', run_time=run_time, run_data=run_data)
 
 
-def process_families(infile, pool, stats):
-  total_reads = 0
+def process_families(duplexes, pool, stats, batched=False, batch_size=1):
+  """The main loop. duplexes is the output of parse_duplexes() (or parse_families(), with --align).
+  If batched, hand the pool lists of up to batch_size (duplex, barcode) tuples instead of one duplex
+  at a time."""
+  batch = []
+  for duplex, barcode in duplexes:
+    if batched:
+      batch.append((duplex, barcode))
+      if len(batch) >= batch_size:
+        pool.compute(batch)
+        batch = []
+    else:
+      pool.compute(duplex, barcode)
+    stats['duplexes'] += 1
+  if batch:
+    pool.compute(batch)
+  # Retrieve the remaining results.
+  logging.info('Flushing remaining results from worker processes..')
+  pool.flush()
+
+
+def process_families_mmap(path, pool, stats, batched=False, batch_size=1, align=False):
+  """The main loop, when workers parse their own input.
+  Only the barcode column is read here. Each worker gets the byte range of its duplex in the file
+  and parses it in process_duplex_slice(). If batched, each worker gets the (contiguous) range
+  covering batch_size duplexes and parses it in process_duplexes_slice().
+  If align is True, the input is a families.tsv, with one line per read pair."""
+  if align:
+    offsets = parallel_tools.scan_duplex_offsets(path, 8)
+    reads_per_line = 2
+  else:
+    offsets = parallel_tools.scan_duplex_offsets(path, 6, comment='#')
+    reads_per_line = 1
+  batch_start = None
+  barcodes = []
+  for offset, length, barcode, num_lines in offsets:
+    if batched:
+      if batch_start is None:
+        batch_start = offset
+      barcodes.append(barcode)
+      if len(barcodes) >= batch_size:
+        pool.compute(path, batch_start, offset+length-batch_start, barcodes)
+        batch_start = None
+        barcodes = []
+    else:
+      pool.compute(path, offset, length, barcode)
+    stats['duplexes'] += 1
+    stats['total_reads'] += num_lines * reads_per_line
+  if barcodes:
+    pool.compute(path, batch_start, offset+length-batch_start, barcodes)
+  logging.info('Flushing remaining results from worker processes..')
+  pool.flush()
+
+
+def parse_duplexes(lines, stats=None):
+  """Parse lines from a families.msa.tsv file and yield the reads in each duplex.
+  Yields a tuple for each duplex: (duplex, barcode).
+  duplex is a dict mapping (order, mate) to the list of reads in that family, where each read is a
+  dict with the keys 'name', 'seq', and 'qual'."""
   duplex = collections.OrderedDict()
   family = []
   barcode = None
   order = None
   # Note: mate is a 0-indexed integer ("mate 1" from the input file is mate 0 here).
   mate = None
-  for line in infile:
+  for line in lines:
     # Allow comments (e.g. for test input files).
     if line.startswith('#'):
       continue
@@ -288,8 +539,7 @@ def process_families(infile, pool, stats):
       # If the barcode changed, process the last duplex and start a new one.
       if new_barcode and barcode is not None:
         assert len(duplex) <= 4, duplex.keys()
-        pool.compute(duplex, barcode)
-        stats['duplexes'] += 1
+        yield duplex, barcode
         duplex = collections.OrderedDict()
       barcode = this_barcode
       order = this_order
@@ -297,17 +547,23 @@ def process_families(infile, pool, stats):
       family = []
     read = {'name': name, 'seq':seq, 'qual':qual}
     family.append(read)
-    total_reads += 1
+    if stats is not None:
+      stats['total_reads'] += 1
   # Process the last family.
   if order is not None and mate is not None:
     duplex[(order, mate)] = family
   assert len(duplex) <= 4, duplex.keys()
-  pool.compute(duplex, barcode)
-  stats['duplexes'] += 1
-  stats['total_reads'] = total_reads
-  # Retrieve the remaining results.
-  logging.info('Flushing remaining results from worker processes..')
-  pool.flush()
+  yield duplex, barcode
+
+
+def parse_families(lines, stats=None, check_ids=True):
+  """Parse lines from a families.tsv file (the input to align-families.py), for --align.
+  Yields a tuple for each duplex: (duplex, barcode), where duplex is in the format produced by
+  align-families.py's parse_duplexes()."""
+  for duplex, barcode in align_families.parse_duplexes(lines, check_ids=check_ids):
+    if stats is not None:
+      stats['total_reads'] += 2 * sum([len(family) for family in duplex.values()])
+    yield duplex, barcode
 
 
 def get_max_mem():
@@ -325,12 +581,148 @@ def get_run_data(stats, pool, max_mem=None):
     run_data['mem'] = max_mem
   run_data['processes'] = pool.processes
   run_data['queue_size'] = pool.queue_size
+  run_data['max_inflight_bytes'] = pool.max_inflight_bytes
+  run_data['time_to_first_result'] = pool.time_to_first_result
   return run_data
 
 
+def process_duplex_slice(path, offset, length, barcode, **kwargs):
+  """Read and parse one duplex from a byte range of the input file, then run process_duplex() on it.
+  NOTE: This must execute in the child process."""
+  lines = parallel_tools.read_slice(path, offset, length)
+  duplexes = list(parse_duplexes(lines))
+  assert len(duplexes) == 1, (barcode, [barcode for duplex, barcode in duplexes])
+  duplex, parsed_barcode = duplexes[0]
+  assert parsed_barcode == barcode, (barcode, parsed_barcode)
+  return process_duplex(duplex, barcode, **kwargs)
+
+
+def process_duplexes_slice(path, offset, length, barcodes, **kwargs):
+  """Read and parse a batch of duplexes from a byte range of the input file, then run
+  process_duplexes() on them.
+  NOTE: This must execute in the child process."""
+  lines = parallel_tools.read_slice(path, offset, length)
+  duplexes = list(parse_duplexes(lines))
+  parsed_barcodes = [barcode for duplex, barcode in duplexes]
+  assert parsed_barcodes == barcodes, (barcodes, parsed_barcodes)
+  return process_duplexes(duplexes, **kwargs)
+
+
+def align_duplex_slice(path, offset, length, barcode, check_ids=True, **kwargs):
+  """Like process_duplex_slice(), but for align_duplex().
+  NOTE: This must execute in the child process."""
+  lines = parallel_tools.read_slice(path, offset, length)
+  duplexes = list(parse_families(lines, check_ids=check_ids))
+  assert len(duplexes) == 1, (barcode, [barcode for duplex, barcode in duplexes])
+  duplex, parsed_barcode = duplexes[0]
+  assert parsed_barcode == barcode, (barcode, parsed_barcode)
+  return align_duplex(duplex, barcode, **kwargs)
+
+
+def align_duplexes_slice(path, offset, length, barcodes, check_ids=True, **kwargs):
+  """Like process_duplexes_slice(), but for align_duplexes().
+  NOTE: This must execute in the child process."""
+  lines = parallel_tools.read_slice(path, offset, length)
+  duplexes = list(parse_families(lines, check_ids=check_ids))
+  parsed_barcodes = [barcode for duplex, barcode in duplexes]
+  assert parsed_barcodes == barcodes, (barcodes, parsed_barcodes)
+  return align_duplexes(duplexes, **kwargs)
+
+
+def align_duplex(duplex, barcode, aligner='kalign', keep_msa=False, joint=False, **kwargs):
+  """Align the families in one duplex from a families.tsv, then run process_duplex() on the
+  alignments (--align mode).
+  Returns the same as process_duplex(), with the alignment stats added to the run_stats, plus the
+  alignments formatted as align-families.py output if keep_msa is True (otherwise None)."""
+  msa_duplex, align_stats, msa_str = align_families_duplex(duplex, barcode, aligner, joint, keep_msa)
+  dcs_strs, sscs_strs, run_stats = process_duplex(msa_duplex, barcode, joint=joint, **kwargs)
+  run_stats.update(align_stats)
+  return dcs_strs, sscs_strs, run_stats, msa_str
+
+
+def align_duplexes(duplexes, aligner='kalign', keep_msa=False, joint=False, **kwargs):
+  """Run align_duplex() on each of a list of (duplex, barcode) tuples, making the consensus
+  sequences for the whole batch at once like process_duplexes()."""
+  msa_duplexes = []
+  all_align_stats = []
+  msa_strs = []
+  for duplex, barcode in duplexes:
+    msa_duplex, align_stats, msa_str = align_families_duplex(
+      duplex, barcode, aligner, joint, keep_msa
+    )
+    msa_duplexes.append((msa_duplex, barcode))
+    all_align_stats.append(align_stats)
+    msa_strs.append(msa_str)
+  results = []
+  consensus_results = process_duplexes(msa_duplexes, joint=joint, **kwargs)
+  for result, align_stats, msa_str in zip(consensus_results, all_align_stats, msa_strs):
+    dcs_strs, sscs_strs, run_stats = result
+    run_stats.update(align_stats)
+    results.append((dcs_strs, sscs_strs, run_stats, msa_str))
+  return results
+
+
+def align_families_duplex(duplex, barcode, aligner, joint=False, keep_msa=False):
+  """Align the families in the duplex with align-families.py's process_duplex().
+  Returns the alignments as a duplex in the format parse_duplexes() yields, the stats on the
+  alignment, and the alignments formatted as align-families.py output (if keep_msa is True)."""
+  msa_duplex, align_run_stats, family_records = align_families.process_duplex(
+    duplex, barcode, aligner=aligner, joint=joint, as_text=False
+  )
+  align_stats = {
+    'align_time': align_run_stats.get('time', 0),
+    'align_failures': align_run_stats.get('failures', 0),
+  }
+  if keep_msa:
+    msa_str = ''.join([align_families.format_msa(alignment, barcode, order, mate+1)
+                       for (order, mate), alignment in msa_duplex.items()])
+  else:
+    msa_str = None
+  return msa_duplex, align_stats, msa_str
+
+
+def process_duplexes(duplexes, min_reads=3, cons_thres=0.5, min_cons_reads=0, qual_thres=' ',
+                     output_qual=None, joint=False, engine='c'):
+  """Run process_duplex() on each of a list of (duplex, barcode) tuples.
+  The single-strand consensus sequences for the whole batch are made at once (with the C engine,
+  that's one call to the _dunovo extension module, when it's available), and so are the alignments
+  between them.
+  Returns a list of the results from process_duplex(), in the same order."""
+  kwargs = {'min_reads':min_reads, 'cons_thres':cons_thres, 'min_cons_reads':min_cons_reads,
+            'qual_thres':qual_thres, 'output_qual':output_qual, 'joint':joint}
+  start = time.time()
+  try:
+    all_sscss = make_sscss_batch(
+      [duplex for duplex, barcode in duplexes], min_reads, cons_thres, min_cons_reads, qual_thres,
+      gapped=joint, engine=engine
+    )
+    if joint:
+      all_aligns = [None]*len(all_sscss)
+    else:
+      all_aligns = align_sscs_pairs(all_sscss)
+  except AssertionError:
+    logging.exception('While processing duplexes {}:'.format(
+      ', '.join([barcode for duplex, barcode in duplexes])
+    ))
+    raise
+  sscs_time = time.time() - start
+  results = []
+  for (duplex, barcode), sscss, aligns in zip(duplexes, all_sscss, all_aligns):
+    results.append(process_duplex(duplex, barcode, sscss=sscss, aligns=aligns, **kwargs))
+  # Split the time it took to make the SSCSs between the duplexes that had any.
+  runs = [run_stats for dcs_strs, sscs_strs, run_stats in results if run_stats['runs']]
+  for run_stats in runs:
+    run_stats['time'] += sscs_time/len(runs)
+  return results
+
+
 def process_duplex(duplex, barcode, min_reads=3, cons_thres=0.5, min_cons_reads=0, qual_thres=' ',
-                   output_qual=None):
-  """Create duplex consensus sequences for the reads from one barcode."""
+                   output_qual=None, joint=False, sscss=None, aligns=None):
+  """Create duplex consensus sequences for the reads from one barcode.
+  If joint is True, the families making up each duplex consensus read must have been aligned
+  together (with "align-families.py --joint").
+  If the single-strand consensus sequences have already been made, give them as sscss, and if
+  they've been aligned, give the alignments as aligns (see make_dcss())."""
   # The code in the main loop used to ensure that "duplex" contains only reads belonging to one final
   # duplex consensus read: ab.1 and ba.2 reads OR ab.2 and ba.1 reads. (Of course, one half might
   # be missing).
@@ -339,8 +731,9 @@ def process_duplex(duplex, barcode, min_reads=3, cons_thres=0.5, min_cons_reads=
   start = time.time()
   # Construct consensus sequences.
   try:
-    sscss = make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres)
-    dcss = make_dcss(sscss)
+    if sscss is None:
+      sscss = make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres, gapped=joint)
+    dcss = make_dcss(sscss, joint=joint, aligns=aligns)
   except AssertionError:
     logging.exception('While processing duplex {}:'.format(barcode))
     raise
@@ -357,8 +750,10 @@ def process_duplex(duplex, barcode, min_reads=3, cons_thres=0.5, min_cons_reads=
   return dcs_strs, sscs_strs, run_stats
 
 
-def make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres):
-  """Create single-strand consensus sequences from families of raw reads."""
+def make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres, gapped=False):
+  """Create single-strand consensus sequences from families of raw reads.
+  If gapped is True, also keep the consensus with gaps in the alignment coordinates, as "gapped".
+  """
   sscss = {}
   for (order, mate), family in duplex.items():
     # logging.info('\t{0}.{1}:'.format(order, mate))
@@ -367,24 +762,67 @@ def make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres):
     if len(family) < min_reads:
       logging.debug('\tnot enough reads ({} < {})'.format(len(family), min_reads))
       continue
-    sscs = make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads)
+    sscs = make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads, gapped=gapped)
     sscss[(order, mate)] = sscs
   return sscss
 
 
-def make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads):
+def make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads, gapped=False):
   seqs = [read['seq'] for read in family]
   quals = [read['qual'] for read in family]
   consensus_seq = consensus.get_consensus(seqs,
                                           quals,
                                           cons_thres=cons_thres,
                                           min_reads=min_cons_reads,
-                                          qual_thres=qual_thres
+                                          qual_thres=qual_thres,
+                                          gapped=gapped
                                          )
-  return {'seq':consensus_seq, 'order':order, 'mate':mate, 'nreads':len(family)}
+  return package_sscs(consensus_seq, order, mate, len(family), gapped=gapped)
 
 
-def make_dcss(sscss):
+def make_sscss_batch(duplexes, min_reads, cons_thres, min_cons_reads, qual_thres, gapped=False,
+                     engine='c'):
+  """Like make_sscss(), but for a list of duplexes, computing all the consensus sequences at once
+  with consensus.get_consensuses() (engine='c') or consensus_numpy (engine='numpy').
+  Returns a list of the sscss dicts for each duplex."""
+  if engine == 'numpy':
+    import consensus_numpy
+    get_consensuses = consensus_numpy.get_consensuses
+  else:
+    assert engine == 'c', engine
+    get_consensuses = consensus.get_consensuses
+  families = []
+  keys = []
+  for i, duplex in enumerate(duplexes):
+    for (order, mate), family in duplex.items():
+      if len(family) < min_reads:
+        logging.debug('\tnot enough reads ({} < {})'.format(len(family), min_reads))
+        continue
+      seqs = [read['seq'] for read in family]
+      quals = [read['qual'] for read in family]
+      families.append((seqs, quals))
+      keys.append((i, order, mate, len(family)))
+  consensus_seqs = get_consensuses(
+    families, cons_thres=cons_thres, min_reads=min_cons_reads, qual_thres=qual_thres,
+    gapped=gapped
+  )
+  all_sscss = [{} for duplex in duplexes]
+  for (i, order, mate, nreads), consensus_seq in zip(keys, consensus_seqs):
+    all_sscss[i][(order, mate)] = package_sscs(consensus_seq, order, mate, nreads, gapped=gapped)
+  return all_sscss
+
+
+def package_sscs(consensus_seq, order, mate, nreads, gapped=False):
+  sscs = {'seq':consensus_seq, 'order':order, 'mate':mate, 'nreads':nreads}
+  if gapped:
+    sscs['gapped'] = consensus_seq
+    sscs['seq'] = consensus_seq.replace('-', '')
+  return sscs
+
+
+def get_sscs_pairs(sscss):
+  """Gather the pairs of single-strand consensus sequences that make up each duplex consensus.
+  Returns a list of (sscs1, sscs2) tuples, indexed by (0-based) duplex mate."""
   # ordermates is the mapping between the duplex consensus mate number and the order/mates of the
   # SSCSs it's composed of. It's arbitrary but consistent, to make sure the duplex consensuses have
   # different mate numbers, and they're the same from run to run.
@@ -392,9 +830,7 @@ def make_dcss(sscss):
     0: (('ab', 0), ('ba', 1)),
     1: (('ab', 1), ('ba', 0)),
   }
-  # Get the consensus of each pair of SSCSs.
-  # dcss is indexed by (0-based) mate.
-  dcss = []
+  sscs_pairs = []
   for duplex_mate in 0, 1:
     # Gather the pair of reads for this duplex consensus.
     sscs_pair = []
@@ -406,12 +842,49 @@ def make_dcss(sscss):
       # If we didn't find two SSCSs for this duplex mate, we can't make a complete pair of duplex
       # consensus sequences.
       break
-    align = swalign.smith_waterman(sscs_pair[0]['seq'], sscs_pair[1]['seq'])
-    if len(align.target) != len(align.query):
-      message = '{} != {}:\n'.format(len(align.target), len(align.query))
-      message += '\n'.join([repr(sscs) for sscs in sscs_pair])
-      raise AssertionError(message)
-    seq = consensus.build_consensus_duplex_simple(align.target, align.query)
+    sscs_pairs.append(tuple(sscs_pair))
+  return sscs_pairs
+
+
+def align_sscs_pairs(all_sscss):
+  """Align the pairs of single-strand consensus sequences for a batch of duplexes, all in one call.
+  Returns a list with, for each duplex, the list of alignments make_dcss() takes."""
+  all_pairs = [get_sscs_pairs(sscss) for sscss in all_sscss]
+  targets = [sscs1['seq'] for sscs_pairs in all_pairs for sscs1, sscs2 in sscs_pairs]
+  queries = [sscs2['seq'] for sscs_pairs in all_pairs for sscs1, sscs2 in sscs_pairs]
+  aligns = iter(swalign.smith_waterman_batch(targets, queries))
+  return [[next(aligns) for sscs_pair in sscs_pairs] for sscs_pairs in all_pairs]
+
+
+def make_dcss(sscss, joint=False, aligns=None):
+  """Build the duplex consensus sequences from pairs of single-strand consensus sequences.
+  If joint is True, the SSCSs must have a "gapped" sequence, and each pair's gapped sequences must
+  already be aligned to each other.
+  Otherwise, each pair is aligned with swalign, unless the alignments are given in aligns (one per
+  pair returned by get_sscs_pairs())."""
+  sscs_pairs = get_sscs_pairs(sscss)
+  if not joint and aligns is None:
+    aligns = [swalign.smith_waterman(sscs1['seq'], sscs2['seq']) for sscs1, sscs2 in sscs_pairs]
+  # Get the consensus of each pair of SSCSs.
+  # dcss is indexed by (0-based) mate.
+  dcss = []
+  for duplex_mate, sscs_pair in enumerate(sscs_pairs):
+    if joint:
+      seq1, seq2 = sscs_pair[0]['gapped'], sscs_pair[1]['gapped']
+      if len(seq1) != len(seq2):
+        message = ('{} != {}: Single-strand consensus sequences have different alignment lengths. '
+                   'Was the input made with "align-families.py --joint"?\n'
+                   .format(len(seq1), len(seq2)))
+        message += '\n'.join([repr(sscs) for sscs in sscs_pair])
+        raise AssertionError(message)
+    else:
+      align = aligns[duplex_mate]
+      if len(align.target) != len(align.query):
+        message = '{} != {}:\n'.format(len(align.target), len(align.query))
+        message += '\n'.join([repr(sscs) for sscs in sscs_pair])
+        raise AssertionError(message)
+      seq1, seq2 = align.target, align.query
+    seq = consensus.build_consensus_duplex_simple(seq1, seq2)
     reads_per_strand = [sscs['nreads'] for sscs in sscs_pair]
     dcss.append({'seq':seq, 'nreads':reads_per_strand})
   assert len(dcss) == 0 or len(dcss) == 2, len(dcss)
@@ -456,8 +929,64 @@ def format_outputs(dcss, sscss, barcode, output_qual=None):
   return dcs_strs, sscs_strs
 
 
+def open_output(filehandle, compression=None):
+  """Wrap an output file opened by argparse in a ThreadedWriter, which buffers the output and writes
+  (and compresses) it in a background thread."""
+  if filehandle is None:
+    return None
+  return threaded_writer.ThreadedWriter(filehandle.buffer, compression=compression)
+
+
+def reject_duplexes(args, error, filehandles, stats, align=False):
+  """Write the duplex(es) in a task which kept failing (the args given to pool.compute()) to the
+  --rejects file."""
+  if len(args) == 4:
+    path, offset, length, barcodes = args
+    if isinstance(barcodes, str):
+      barcodes = [barcodes]
+    lines = parallel_tools.read_slice(path, offset, length)
+  else:
+    if len(args) == 1:
+      duplexes = args[0]
+    else:
+      duplexes = [args]
+    barcodes = [barcode for duplex, barcode in duplexes]
+    lines = []
+    for duplex, barcode in duplexes:
+      if align:
+        lines.extend(align_families.format_duplex(duplex, barcode))
+      else:
+        lines.extend(format_duplex(duplex, barcode))
+  logging.error('Error: Giving up on duplex(es) {}: {}: {}'
+                .format(', '.join(barcodes), type(error).__name__, error))
+  filehandles['rejects'].writelines(lines)
+  stats['rejects'] += len(barcodes)
+
+
+def format_duplex(duplex, barcode):
+  """Format a duplex from parse_duplexes() back into the lines of a families.msa.tsv."""
+  lines = []
+  for (order, mate), family in duplex.items():
+    for read in family:
+      fields = (barcode, order, str(mate+1), read['name'], read['seq'], read['qual'])
+      lines.append('\t'.join(fields)+'\n')
+  return lines
+
+
+def process_results(results, filehandles, stats):
+  """Process the results of a batch of duplexes from process_duplexes()."""
+  for result in results:
+    process_result(result, filehandles, stats)
+
+
 def process_result(result, filehandles, stats):
-  dcs_strs, sscs_strs, run_stats = result
+  # With --align, there's a 4th element: the formatted alignments, if they were requested.
+  if len(result) == 4:
+    dcs_strs, sscs_strs, run_stats, msa_str = result
+    if msa_str and filehandles['msa']:
+      filehandles['msa'].write(msa_str)
+  else:
+    dcs_strs, sscs_strs, run_stats = result
   # Stats
   for key, value in run_stats.items():
     stats[key] += value
@@ -0,0 +1,159 @@
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+
+# How long to wait on another process's lock on the database, in seconds.
+LOCK_TIMEOUT = 60
+# Don't bother updating an entry's access time if it was already used this recently, in seconds.
+ATIME_RESOLUTION = 3600
+# Save the updated access times after this many cache hits (or on the next insertion).
+ATIME_BATCH = 100
+
+# The open caches in this process, indexed by path.
+CACHES = {}
+
+
+class MsaCache(object):
+  """An on-disk cache of multiple sequence alignments, keyed by the content of the family.
+  The cache is an SQLite database, so it's a single compact file and it's safe for several worker
+  processes to read and write it at once. Once the total size of the stored alignments goes over
+  max_size bytes, the least recently used entries are evicted. The total is kept in the database
+  and updated with each insertion, so the limit holds no matter how many processes are writing.
+  Access times are only as precise as ATIME_RESOLUTION, and are saved in batches, so that cache
+  hits don't usually need to write to the database."""
+
+  def __init__(self, path, max_size=None):
+    self.path = path
+    self.max_size = max_size
+    # Updated access times not yet saved to the database, indexed by key.
+    self.atimes = {}
+    self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    # Write-ahead logging lets readers proceed while another process is writing.
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('PRAGMA synchronous=NORMAL')
+    self._transaction(self._create_tables)
+
+  @staticmethod
+  def make_key(seqs, aligner_id):
+    """Make a key from the (ordered) sequences in the family and a string identifying the aligner
+    (including its version)."""
+    hasher = hashlib.sha256(bytes(aligner_id, 'utf8')+b'\0')
+    for seq in seqs:
+      hasher.update(bytes(seq, 'utf8')+b'\n')
+    return hasher.digest()
+
+  def get(self, key):
+    """Return the list of aligned sequences stored for this key, or None if it's not cached."""
+    row = self.conn.execute('SELECT value, atime FROM alignments WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    value, atime = row
+    now = time.time()
+    if now - atime > ATIME_RESOLUTION:
+      self.atimes[key] = now
+      if len(self.atimes) >= ATIME_BATCH:
+        self._transaction(self._save_atimes)
+    return str(zlib.decompress(value), 'utf8').split('\n')
+
+  def put(self, key, aligned_seqs):
+    value = zlib.compress(bytes('\n'.join(aligned_seqs), 'utf8'))
+    total = self._transaction(self._insert, key, value)
+    if self.max_size is not None and total > self.max_size:
+      self.evict()
+
+  def evict(self):
+    """Remove the least recently used entries until the total size is under max_size."""
+    if self.max_size is None:
+      return 0
+    evicted = self._transaction(self._evict)
+    if evicted:
+      logging.info(f'Evicted {evicted} alignments from cache {self.path}.')
+    return evicted
+
+  def get_size(self):
+    """Return the total size of the stored alignments, in bytes."""
+    return self.conn.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+  def close(self):
+    """Save the pending access times, evict any excess entries, and close the database."""
+    if self.atimes:
+      self._transaction(self._save_atimes)
+    self.evict()
+    self.conn.close()
+    if CACHES.get(self.path) is self:
+      del CACHES[self.path]
+
+  # The methods below must be called inside a transaction, which _transaction() provides.
+
+  def _transaction(self, method, *args):
+    """Call the method in a write transaction, and return its result."""
+    self.conn.execute('BEGIN IMMEDIATE')
+    try:
+      result = method(*args)
+      self.conn.execute('COMMIT')
+    except Exception:
+      self.conn.execute('ROLLBACK')
+      raise
+    return result
+
+  def _create_tables(self):
+    self.conn.execute(
+      'CREATE TABLE IF NOT EXISTS alignments '
+      '(key BLOB PRIMARY KEY, value BLOB, size INTEGER, atime REAL)'
+    )
+    self.conn.execute('CREATE INDEX IF NOT EXISTS alignments_atime ON alignments (atime)')
+    # The total size of the alignments, so it doesn't have to be summed up on every insertion.
+    self.conn.execute('CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)')
+    self.conn.execute(
+      "INSERT OR IGNORE INTO totals (name, value) "
+      "SELECT 'size', COALESCE(SUM(size), 0) FROM alignments"
+    )
+
+  def _insert(self, key, value):
+    """Store the value and update the total size. Returns the new total."""
+    self._save_atimes()
+    row = self.conn.execute('SELECT size FROM alignments WHERE key = ?', (key,)).fetchone()
+    old_size = 0 if row is None else row[0]
+    self.conn.execute(
+      'INSERT OR REPLACE INTO alignments (key, value, size, atime) VALUES (?, ?, ?, ?)',
+      (key, value, len(value), time.time())
+    )
+    self._add_size(len(value) - old_size)
+    return self.get_size()
+
+  def _evict(self):
+    self._save_atimes()
+    excess = self.get_size() - self.max_size
+    if excess <= 0:
+      return 0
+    keys = []
+    evicted_size = 0
+    for key, size in self.conn.execute('SELECT key, size FROM alignments ORDER BY atime'):
+      keys.append((key,))
+      evicted_size += size
+      if evicted_size >= excess:
+        break
+    self.conn.executemany('DELETE FROM alignments WHERE key = ?', keys)
+    self._add_size(-evicted_size)
+    return len(keys)
+
+  def _save_atimes(self):
+    self.conn.executemany(
+      'UPDATE alignments SET atime = ? WHERE key = ?',
+      [(atime, key) for key, atime in self.atimes.items()]
+    )
+    self.atimes = {}
+
+  def _add_size(self, change):
+    self.conn.execute("UPDATE totals SET value = value + ? WHERE name = 'size'", (change,))
+
+
+def open_cache(path, max_size=None):
+  """Get the cache stored at this path, opening it if this process hasn't already."""
+  cache = CACHES.get(path)
+  if cache is None:
+    cache = MsaCache(path, max_size=max_size)
+    CACHES[path] = cache
+  return cache
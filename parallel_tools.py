@@ -1,13 +1,37 @@
 import os
 import sys
+import json
+import mmap
+import stat
+import time
+import pickle
+import socket
+import asyncio
 import getpass
 import logging
 import traceback
+import collections
 import multiprocessing.pool
+import concurrent.futures
 
 QUEUE_SIZE_MULTIPLIER = 8
+# When SyncAsyncPool picks its own chunksize, it aims for each batch of tasks to take about this many
+# seconds in the worker.
+TARGET_BATCH_TIME = 0.05
+# How much weight to give the latest batch when updating the running estimate of the time per task.
+TASK_TIME_WEIGHT = 0.3
+# How often PoolMetrics writes a record, in seconds.
+METRICS_INTERVAL = 1
+# While waiting on a result, how often SyncAsyncPool checks whether any workers have died, in
+# seconds.
+WORKER_CHECK_INTERVAL = 0.5
 
-class SyncAsyncPool(multiprocessing.pool.Pool):
+
+class WorkerLostError(Exception):
+  """The worker process running a task died before returning its result."""
+
+
+class SyncAsyncPool(object):
   """A wrapper around multiprocessing.Pool which allows parallel processing but ordered results.
   This offers a compromise between synchronous and asynchronous processing, trying to get the
   benefits of both.
@@ -15,7 +39,10 @@ class SyncAsyncPool(multiprocessing.pool.Pool):
   the inputs were given. It does this by chunking the jobs, periodically stopping to wait for all
   jobs in the chunk to finish.
   It allows giving a callback which will be executed in the parent process. It will also be given
-  results in the same order they were submitted."""
+  results in the same order they were submitted.
+  Consecutive tasks are sent to the workers in batches, which each worker runs in one go and returns
+  as a list. This saves the per-task cost of pickling, queueing, and result objects when the tasks
+  themselves are quick. The batching is invisible to the function and the callback."""
 
   def __init__(self,
                function,
@@ -24,7 +51,17 @@ class SyncAsyncPool(multiprocessing.pool.Pool):
                static_args=(),
                static_kwargs=None,
                callback=None,
-               callback_args=()
+               callback_args=(),
+               chunksize=None,
+               max_bytes=None,
+               task_sizer=None,
+               start_method=None,
+               preload=(),
+               executor=None,
+               metrics=None,
+               max_retries=None,
+               reject_callback=None,
+               reject_args=()
               ):
     """Create a new SyncAsyncPool.
     processes can be None, "auto", an integer 0 or greater, or something that produces an integer
@@ -33,7 +70,36 @@ class SyncAsyncPool(multiprocessing.pool.Pool):
       will execute the function directly in the main process (and won't actually create a
       multiprocessing.Pool).
     queue_size can be None or an integer greater than 0. If it's None, the queue_size will be set
-      to QUEUE_SIZE_MULTIPLIER * the number of processes."""
+      to QUEUE_SIZE_MULTIPLIER * the number of processes.
+    chunksize can be None or an integer greater than 0. It's the number of tasks to send to a worker
+      at once. If it's None, it will be chosen from the measured time per task, aiming for batches
+      which take TARGET_BATCH_TIME seconds, but no larger than queue_size / processes (so all the
+      workers get some work before each flush).
+    max_bytes can be None or an integer greater than 0. If given, the pool will also flush once the
+      tasks in flight add up to this many bytes, as estimated by task_sizer. task_sizer is called
+      with the args and kwargs given to compute() and should return the size of the task in bytes.
+      By default it's estimate_size(), which adds up the lengths of the strings in the arguments.
+      The current total is kept in inflight_bytes, and the highest it's been in max_inflight_bytes.
+      If max_bytes is None, these aren't tracked.
+    start_method is the multiprocessing start method for the workers ("fork", "spawn", or
+      "forkserver"), or None for the platform default. preload is a list of modules for the
+      forkserver to import before starting the workers (see get_context()).
+    executor can be something to run the batches of tasks on instead of a local
+      multiprocessing.Pool, like a socket_executor.SocketExecutor. It must have a
+      submit_batch(function, calls) method returning an object whose get() returns what run_batch()
+      does, close() and join() methods, and a processes attribute (how many tasks it can run at
+      once). If it's given, processes, start_method, and preload are ignored.
+    metrics can be a PoolMetrics, to periodically record how busy the pool is. It's closed when
+      the pool is.
+    max_retries can be None or an integer 0 or greater. If a batch of tasks fails, either because
+      the function raised an exception or because the worker process died (then all the workers
+      are restarted), each of its tasks is run again on its own, and retried up to max_retries more
+      times. A task that still fails is given to reject_callback (with the positional args given to
+      compute(), the last exception, and reject_args), and the pool carries on without its result.
+      Without a reject_callback, the exception is raised. If max_retries is None, the first failure
+      is raised (which is a WorkerLostError if the worker died).
+    The time from creating the pool to the first result being finished is kept in
+      time_to_first_result (None until there is one)."""
     # Validate arguments.
     if processes is not None and processes != 'auto':
       try:
@@ -46,20 +112,49 @@ class SyncAsyncPool(multiprocessing.pool.Pool):
       processes = None
     if queue_size is not None and queue_size <= 0:
       raise ValueError('queue_size must be > 0 (received {!r})'.format(queue_size))
+    if chunksize is not None and chunksize <= 0:
+      raise ValueError('chunksize must be > 0 (received {!r})'.format(chunksize))
+    if max_bytes is not None and max_bytes <= 0:
+      raise ValueError('max_bytes must be > 0 (received {!r})'.format(max_bytes))
     # Are we actually doing multiprocessing, or should we do everything directly in one process?
-    if processes == 0:
+    if processes == 0 and executor is None:
       self.multiproc = False
     else:
       self.multiproc = True
-    if self.multiproc:
-      multiprocessing.pool.Pool.__init__(self, processes=processes)
+    if max_retries is not None and max_retries < 0:
+      raise ValueError('max_retries must be >= 0 (received {!r})'.format(max_retries))
+    self.start_time = time.time()
+    self.first_result_time = None
+    # Which batch each worker process started last (by pid), the pids of all the workers, the
+    # batches lost to dead workers, and how many times the workers have been restarted. Only used
+    # with the local multiprocessing.Pool.
+    self.last_batch_id = 0
+    self.running = {}
+    self.workers = set()
+    self.lost = set()
+    self.generation = 0
     # Determine the number of processes.
-    if processes is None or processes == 'auto':
+    if executor is not None:
+      processes = executor.processes
+    elif processes is None:
       try:
         processes = multiprocessing.cpu_count()
       except NotImplementedError:
-        processes = self._processes
+        processes = 1
     self.processes = processes
+    # By default, the pool is its own executor (see submit_batch()), running the tasks on a
+    # multiprocessing.Pool in self.pool.
+    self.pool = None
+    if executor is None:
+      self.executor = self
+      if self.multiproc:
+        self.context = get_context(start_method, preload)
+        # Each worker reports its pid when it starts, and the batch it's starting on, on this pipe,
+        # so if it dies we know which one was lost.
+        self.started, self.started_writer = self.context.Pipe(duplex=False)
+        self.pool = self._start_pool()
+    else:
+      self.executor = executor
     # Determine the queue size.
     if queue_size is None:
       if self.processes == 0:
@@ -75,36 +170,245 @@ class SyncAsyncPool(multiprocessing.pool.Pool):
       self.static_kwargs = static_kwargs
     self.callback = callback
     self.callback_args = callback_args
+    self.chunksize = chunksize
+    # The running estimate of how long each task takes in a worker, in seconds.
+    self.task_time = None
+    # The tasks waiting to be sent to a worker as the next batch.
+    self.batch = []
+    # The results of each batch, as returned by run_batch().
     self.results = []
+    # The number of tasks in self.batch and self.results.
+    self.queued = 0
+    self.max_bytes = max_bytes
+    self.task_sizer = task_sizer or estimate_task_size
+    self.inflight_bytes = 0
+    self.max_inflight_bytes = 0
+    self.metrics = metrics
+    self.max_retries = max_retries
+    self.reject_callback = reject_callback
+    self.reject_args = reject_args
 
   def compute(self, *args, **kwargs):
     # Combine the static arguments with the args for this invocation.
     all_args = list(args) + self.static_args
     all_kwargs = self.static_kwargs.copy()
     all_kwargs.update(kwargs)
-    # Send args to multiprocessing pool worker, or execute directly in this process if we're not
-    # multiprocessing.
+    # Add the args to the batch for the multiprocessing pool workers, or execute directly in this
+    # process if we're not multiprocessing.
     if self.multiproc:
-      result = self.apply_async(with_context, [self.function]+all_args, all_kwargs)
+      self.batch.append((all_args, all_kwargs))
+      if len(self.batch) >= self.get_chunksize():
+        self._submit_batch()
     else:
-      result = FakeResult(self.function(*all_args, **all_kwargs))
-    self.results.append(result)
-    if len(self.results) >= self.queue_size:
+      result = self.function(*all_args, **all_kwargs)
+      self.results.append((None, FakeResult(([result], None, time.time(), get_worker_id()))))
+    self.queued += 1
+    if self.max_bytes is not None:
+      self.inflight_bytes += self.task_sizer(args, kwargs)
+      self.max_inflight_bytes = max(self.max_inflight_bytes, self.inflight_bytes)
+      if self.inflight_bytes >= self.max_bytes:
+        self.flush()
+        return
+    if self.queued >= self.queue_size:
       self.flush()
-      self.results = []
+    elif self.metrics:
+      self.metrics.check(self)
+
+  def get_chunksize(self):
+    """Decide how many tasks to put in the next batch."""
+    if self.chunksize is not None:
+      return self.chunksize
+    if self.task_time is None:
+      return 1
+    max_size = max(1, self.queue_size // self.processes)
+    if self.task_time <= 0:
+      return max_size
+    return max(1, min(max_size, int(TARGET_BATCH_TIME/self.task_time)))
+
+  def _submit_batch(self):
+    if self.batch:
+      if self.metrics:
+        self.metrics.add_batch(len(self.batch), len(pickle.dumps(self.batch)))
+      self.results.append((self.batch, self.executor.submit_batch(self.function, self.batch)))
+      self.batch = []
+
+  def submit_batch(self, function, calls):
+    """Run a batch of tasks on the local multiprocessing.Pool."""
+    self.last_batch_id += 1
+    result = self.pool.apply_async(run_tracked_batch, [function, calls, self.last_batch_id])
+    result.batch_id = self.last_batch_id
+    result.generation = self.generation
+    return result
+
+  def _record_time(self, elapsed, num_tasks):
+    task_time = elapsed/num_tasks
+    if self.task_time is None:
+      self.task_time = task_time
+    else:
+      self.task_time = TASK_TIME_WEIGHT*task_time + (1-TASK_TIME_WEIGHT)*self.task_time
 
   def flush(self):
-    if self.callback:
-      for result in self.results:
-        self.callback(result.get(), *self.callback_args)
+    self._submit_batch()
+    for calls, result in self.results:
+      if self.metrics:
+        wait_start = time.perf_counter()
+        values, elapsed, finished, worker = self._get_result(calls, result)
+        self.metrics.add_result_batch(worker, elapsed, len(values), time.perf_counter()-wait_start)
+      else:
+        values, elapsed, finished, worker = self._get_result(calls, result)
+      if elapsed is not None and values:
+        self._record_time(elapsed, len(values))
+      if self.first_result_time is None or finished < self.first_result_time:
+        self.first_result_time = finished
+      if self.callback:
+        for value in values:
+          self.callback(value, *self.callback_args)
+      if self.metrics:
+        self.queued -= len(calls) if calls else 1
+        self.metrics.check(self)
+    self.results = []
+    self.queued = 0
+    self.inflight_bytes = 0
+
+  def _get_result(self, calls, result):
+    """Get the results of a batch, retrying its tasks if it failed (see max_retries).
+    Returns the same thing as run_batch()."""
+    while True:
+      try:
+        result_data = self._wait(result)
+      except Exception as error:
+        if self.max_retries is None or calls is None:
+          raise
+        failure = error
+        break
+      if result_data is not None:
+        return result_data
+      result = self.executor.submit_batch(self.function, calls)
+    # Retry outside the except block, so workers restarted meanwhile don't inherit the exception.
+    return self._retry(calls, failure), None, time.time(), None
+
+  def _retry(self, calls, error):
+    """Run each task in a failed batch again on its own, retrying each up to max_retries times.
+    Returns the results of the ones that succeed, in order."""
+    logging.warning('Warning: A batch of {} task(s) failed ({}: {}). Retrying each on its own.'
+                    .format(len(calls), type(error).__name__, error))
+    # Submit them all at once, so they can run in parallel.
+    results = [self.executor.submit_batch(self.function, [call]) for call in calls]
+    values = []
+    for call, result in zip(calls, results):
+      failures = 0
+      while True:
+        try:
+          result_data = self._wait(result)
+        except Exception as error:
+          failures += 1
+          if failures > self.max_retries:
+            self._reject(call, error)
+            break
+          logging.warning('Warning: Task failed ({}: {}). Retrying ({} of {}).'
+                          .format(type(error).__name__, error, failures, self.max_retries))
+        else:
+          if result_data is not None:
+            values.extend(result_data[0])
+            break
+        result = self.executor.submit_batch(self.function, [call])
+    return values
+
+  def _reject(self, call, error):
+    if self.reject_callback is None:
+      raise error
+    all_args, all_kwargs = call
+    args = all_args[:len(all_args)-len(self.static_args)]
+    self.reject_callback(args, error, *self.reject_args)
+
+  def _wait(self, result):
+    """Wait for the results of a batch. Raises WorkerLostError if the worker running it died, or
+    returns None if the workers were restarted (because another one died) before it finished, so
+    it needs to be submitted again."""
+    batch_id = getattr(result, 'batch_id', None)
+    if batch_id is None:
+      return result.get()
+    while not result.ready():
+      if batch_id in self.lost:
+        self.lost.discard(batch_id)
+        raise WorkerLostError('The worker process died while running the task.')
+      if result.generation != self.generation:
+        return None
+      result.wait(WORKER_CHECK_INTERVAL)
+      if not result.ready():
+        self._check_workers()
+    return result.get()
+
+  def _start_pool(self):
+    return self.context.Pool(processes=self.processes, initializer=set_started_pipe,
+                             initargs=(self.started_writer,))
+
+  def _check_workers(self):
+    """Look for worker processes which have died. If there are any, mark the batches they were
+    running as lost and restart the workers."""
+    while self.started.poll():
+      pid, batch_id = self.started.recv()
+      self.workers.add(pid)
+      if batch_id is not None:
+        self.running[pid] = batch_id
+    # active_children() also reaps the dead ones, so they drop out of it.
+    alive = set([process.pid for process in multiprocessing.active_children()])
+    dead = self.workers - alive
+    if not dead:
+      return
+    for pid in dead:
+      logging.warning('Warning: Worker process {} died.'.format(pid))
+      batch_id = self.running.pop(pid, None)
+      if batch_id is not None:
+        self.lost.add(batch_id)
+    self._restart_workers()
+
+  def _restart_workers(self):
+    """Replace the multiprocessing.Pool with a new one.
+    A worker can die while holding the lock on the Pool's task or result queue (idle workers hold
+    the task queue lock while they wait), which would leave the others stuck forever, and
+    Pool.terminate() too. So the old workers are killed and the locks freed before terminating the
+    old Pool, and the batches which were still waiting on it are submitted again to the new one (see
+    _wait())."""
+    logging.warning('Warning: Restarting the worker processes.')
+    old_pool = self.pool
+    for process in multiprocessing.active_children():
+      if process.pid in self.workers:
+        process.kill()
+        process.join()
+    # The locks are private attributes of the Pool. tests/unit-tests.py (SyncAsyncPoolTest) kills a
+    # worker holding each of them, so if a new Python changes them, it fails there instead of here.
+    for lock in old_pool._inqueue._rlock, old_pool._outqueue._wlock:
+      lock.acquire(False)
+      lock.release()
+    old_pool.terminate()
+    # Ignore the reports from the old workers.
+    while self.started.poll():
+      self.started.recv()
+    self.pool = self._start_pool()
+    self.generation += 1
+    self.running = {}
+    self.workers = set()
+
+  @property
+  def time_to_first_result(self):
+    if self.first_result_time is None:
+      return None
+    return self.first_result_time - self.start_time
 
   def close(self):
-    if self.multiproc:
-      multiprocessing.pool.Pool.close(self)
+    if self.metrics:
+      self.metrics.close(self)
+    if self.executor is not self:
+      self.executor.close()
+    elif self.multiproc:
+      self.pool.close()
 
   def join(self):
-    if self.multiproc:
-      multiprocessing.pool.Pool.join(self)
+    if self.executor is not self:
+      self.executor.join()
+    elif self.multiproc:
+      self.pool.join()
 
 
 class FakeResult(object):
@@ -116,6 +420,489 @@ class FakeResult(object):
     return self.result_data
 
 
+class PoolMetrics(object):
+  """Periodically write statistics on how busy a SyncAsyncPool is, as lines of JSON.
+  Every interval seconds (checked whenever the pool is given a task or gets a result), it writes one
+  record covering the time since the last one:
+    time:            The time.time() the record was written.
+    elapsed:         Seconds since the PoolMetrics was created.
+    interval:        Seconds covered by this record.
+    in_flight:       Tasks given to the pool whose results haven't been handed to the callback yet.
+    in_flight_bytes: Their estimated size (if the pool has max_bytes, otherwise null).
+    chunksize:       The number of tasks the pool is currently putting in each batch.
+    submitted:       Tasks sent to the workers.
+    results:         Results handed to the callback.
+    results_per_sec: results / interval.
+    flush_blocked:   Seconds the parent spent in flush() waiting on the workers.
+    pickled_bytes_per_task: The average pickled size of the tasks sent.
+    workers:         For each worker ("host:pid"): the seconds it spent running the tasks whose
+                     results came back in this interval ("busy"), the rest of the interval ("idle"),
+                     and the fraction busy ("utilization").
+  Results only come back when the parent flushes, so the busy time lags behind the actual work, and
+  it's worth averaging a few records. The final record has "final": true.
+  Measuring the pickled size means pickling each batch an extra time in the parent."""
+
+  def __init__(self, output, interval=METRICS_INTERVAL):
+    self.output = output
+    self.interval = interval
+    self.start = self.last = time.time()
+    self.workers = set()
+    self._reset()
+
+  @classmethod
+  def open(cls, path, interval=METRICS_INTERVAL):
+    """Write to a file, or if path is an existing Unix socket, connect to it and write there."""
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sock.connect(path)
+      output = sock.makefile('w')
+      sock.close()
+    else:
+      output = open(path, 'w')
+    return cls(output, interval=interval)
+
+  def _reset(self):
+    self.submitted = 0
+    self.pickled_bytes = 0
+    self.results = 0
+    self.blocked = 0.0
+    self.busy = collections.defaultdict(float)
+
+  def add_batch(self, num_tasks, pickled_bytes):
+    self.submitted += num_tasks
+    self.pickled_bytes += pickled_bytes
+
+  def add_result_batch(self, worker, elapsed, num_results, blocked):
+    # Results computed directly in the parent (with 0 processes) aren't timed.
+    if elapsed is not None:
+      self.workers.add(worker)
+      self.busy[worker] += elapsed
+    self.results += num_results
+    self.blocked += blocked
+
+  def check(self, pool):
+    """Write a record if it's been interval seconds since the last one."""
+    if time.time() - self.last >= self.interval:
+      self.write(pool)
+
+  def write(self, pool, final=False):
+    if self.output is None:
+      return
+    now = time.time()
+    interval = now - self.last
+    record = {
+      'time': round(now, 3),
+      'elapsed': round(now - self.start, 3),
+      'interval': round(interval, 3),
+      'in_flight': pool.queued,
+      'in_flight_bytes': pool.inflight_bytes if pool.max_bytes is not None else None,
+      'chunksize': pool.get_chunksize(),
+      'submitted': self.submitted,
+      'results': self.results,
+      'results_per_sec': round(self.results/interval, 3) if interval > 0 else None,
+      'flush_blocked': round(self.blocked, 4),
+      'pickled_bytes_per_task': None,
+      'workers': {},
+    }
+    if self.submitted:
+      record['pickled_bytes_per_task'] = round(self.pickled_bytes/self.submitted, 1)
+    for worker in sorted(self.workers):
+      busy = self.busy[worker]
+      worker_data = {'busy':round(busy, 4), 'idle':round(max(0, interval-busy), 4)}
+      worker_data['utilization'] = round(min(1, busy/interval), 4) if interval > 0 else None
+      record['workers'][worker] = worker_data
+    if final:
+      record['final'] = True
+    try:
+      self.output.write(json.dumps(record)+'\n')
+      self.output.flush()
+    except OSError as error:
+      logging.warning('Warning: Could not write pool metrics ({}). Stopping.'.format(error))
+      self.output = None
+    self.last = now
+    self._reset()
+
+  def close(self, pool):
+    """Write the final record and close the output."""
+    self.write(pool, final=True)
+    if self.output is not None:
+      try:
+        self.output.close()
+      except OSError:
+        pass
+      self.output = None
+
+
+class AsyncioPool(object):
+  """A single-process alternative to SyncAsyncPool for work that mostly waits on subprocesses.
+  The function must be a coroutine function. Each call to compute() schedules it as a task in an
+  event loop in this process, and the results are given to the callback in the order they were
+  submitted. Up to queue_size tasks are in flight at once, and each task is given a semaphore
+  (as the keyword argument "slots") which allows "processes" holders at once. The function should
+  acquire it around each subprocess it runs."""
+
+  def __init__(self,
+               function,
+               processes=None,
+               queue_size=None,
+               static_args=(),
+               static_kwargs=None,
+               callback=None,
+               callback_args=(),
+               max_bytes=None,
+               task_sizer=None
+              ):
+    """See SyncAsyncPool for max_bytes and task_sizer."""
+    if processes is None or processes == 'auto':
+      processes = multiprocessing.cpu_count()
+    try:
+      processes = int(processes)
+    except (ValueError, TypeError):
+      raise ValueError('processes must be an integer, None, or "auto" (received {!r})'.format(processes))
+    if processes <= 0:
+      raise ValueError('processes must be greater than 0 (received {!r})'.format(processes))
+    if queue_size is not None and queue_size <= 0:
+      raise ValueError('queue_size must be > 0 (received {!r})'.format(queue_size))
+    if max_bytes is not None and max_bytes <= 0:
+      raise ValueError('max_bytes must be > 0 (received {!r})'.format(max_bytes))
+    self.multiproc = False
+    self.processes = processes
+    if queue_size is None:
+      queue_size = self.processes * QUEUE_SIZE_MULTIPLIER
+    self.queue_size = queue_size
+    self.function = function
+    self.static_args = list(static_args)
+    if static_kwargs is None:
+      self.static_kwargs = {}
+    else:
+      self.static_kwargs = static_kwargs
+    self.callback = callback
+    self.callback_args = callback_args
+    self.loop = asyncio.new_event_loop()
+    # Older versions of asyncio bind a Semaphore to the current event loop when it's created.
+    asyncio.set_event_loop(self.loop)
+    self.slots = asyncio.Semaphore(self.processes)
+    self.results = []
+    self.max_bytes = max_bytes
+    self.task_sizer = task_sizer or estimate_task_size
+    self.sizes = collections.deque()
+    self.inflight_bytes = 0
+    self.max_inflight_bytes = 0
+    self.start_time = time.time()
+    self.time_to_first_result = None
+
+  def compute(self, *args, **kwargs):
+    all_args = list(args) + self.static_args
+    all_kwargs = self.static_kwargs.copy()
+    all_kwargs.update(kwargs)
+    all_kwargs['slots'] = self.slots
+    coroutine = self.function(*all_args, **all_kwargs)
+    self.results.append(self.loop.create_task(coroutine))
+    self._add_size(args, kwargs)
+    # Process finished results in order as long as the queue is full.
+    while len(self.results) >= self.queue_size or self._over_budget():
+      self._process_next()
+
+  def flush(self):
+    while self.results:
+      self._process_next()
+
+  def _process_next(self):
+    task = self.results.pop(0)
+    self._remove_size()
+    try:
+      result = self.loop.run_until_complete(task)
+    except BaseException:
+      self.cancel()
+      raise
+    if self.time_to_first_result is None:
+      self.time_to_first_result = time.time() - self.start_time
+    if self.callback:
+      self.callback(result, *self.callback_args)
+
+  def _add_size(self, args, kwargs):
+    if self.max_bytes is None:
+      return
+    size = self.task_sizer(args, kwargs)
+    self.sizes.append(size)
+    self.inflight_bytes += size
+    self.max_inflight_bytes = max(self.max_inflight_bytes, self.inflight_bytes)
+
+  def _remove_size(self):
+    if self.sizes:
+      self.inflight_bytes -= self.sizes.popleft()
+
+  def _over_budget(self):
+    return self.max_bytes is not None and self.results and self.inflight_bytes >= self.max_bytes
+
+  def cancel(self):
+    """Cancel all pending tasks and wait for them to finish cancelling."""
+    for task in self.results:
+      task.cancel()
+    if self.results:
+      self.loop.run_until_complete(asyncio.gather(*self.results, return_exceptions=True))
+    self.results = []
+    self.sizes.clear()
+    self.inflight_bytes = 0
+
+  def close(self):
+    self.cancel()
+
+  def join(self):
+    if not self.loop.is_closed():
+      self.loop.close()
+
+
+class SyncAsyncThreadPool(object):
+  """A thread-based alternative to SyncAsyncPool, for work that releases the GIL (like calls to
+  the C libraries). The function runs in a pool of threads in this process, so the arguments are
+  shared instead of pickled and copied to subprocesses. The results are given to the callback in
+  the order they were submitted: finished results wait in a reorder buffer until all the ones
+  before them are done. Up to queue_size calls are in flight at once."""
+
+  def __init__(self,
+               function,
+               processes=None,
+               queue_size=None,
+               static_args=(),
+               static_kwargs=None,
+               callback=None,
+               callback_args=(),
+               max_bytes=None,
+               task_sizer=None
+              ):
+    """processes is the number of threads. None or "auto" mean to use as many as there are cpu
+    cores. See SyncAsyncPool for max_bytes and task_sizer."""
+    if processes is None or processes == 'auto':
+      processes = multiprocessing.cpu_count()
+    try:
+      processes = int(processes)
+    except (ValueError, TypeError):
+      raise ValueError('processes must be an integer, None, or "auto" (received {!r})'.format(processes))
+    if processes <= 0:
+      raise ValueError('processes must be greater than 0 (received {!r})'.format(processes))
+    if queue_size is not None and queue_size <= 0:
+      raise ValueError('queue_size must be > 0 (received {!r})'.format(queue_size))
+    if max_bytes is not None and max_bytes <= 0:
+      raise ValueError('max_bytes must be > 0 (received {!r})'.format(max_bytes))
+    self.multiproc = False
+    self.processes = processes
+    if queue_size is None:
+      queue_size = self.processes * QUEUE_SIZE_MULTIPLIER
+    self.queue_size = queue_size
+    self.function = function
+    self.static_args = list(static_args)
+    if static_kwargs is None:
+      self.static_kwargs = {}
+    else:
+      self.static_kwargs = static_kwargs
+    self.callback = callback
+    self.callback_args = callback_args
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.processes)
+    self.results = collections.deque()
+    self.max_bytes = max_bytes
+    self.task_sizer = task_sizer or estimate_task_size
+    self.sizes = collections.deque()
+    self.inflight_bytes = 0
+    self.max_inflight_bytes = 0
+    self.start_time = time.time()
+    self.time_to_first_result = None
+
+  def compute(self, *args, **kwargs):
+    all_args = list(args) + self.static_args
+    all_kwargs = self.static_kwargs.copy()
+    all_kwargs.update(kwargs)
+    self.results.append(self.executor.submit(self.function, *all_args, **all_kwargs))
+    self._add_size(args, kwargs)
+    # Process finished results in order as long as the queue is full.
+    while len(self.results) >= self.queue_size or self._over_budget():
+      self._process_next()
+
+  def flush(self):
+    while self.results:
+      self._process_next()
+
+  def _process_next(self):
+    future = self.results.popleft()
+    self._remove_size()
+    try:
+      result = future.result()
+    except BaseException:
+      self.cancel()
+      raise
+    if self.time_to_first_result is None:
+      self.time_to_first_result = time.time() - self.start_time
+    if self.callback:
+      self.callback(result, *self.callback_args)
+
+  def _add_size(self, args, kwargs):
+    if self.max_bytes is None:
+      return
+    size = self.task_sizer(args, kwargs)
+    self.sizes.append(size)
+    self.inflight_bytes += size
+    self.max_inflight_bytes = max(self.max_inflight_bytes, self.inflight_bytes)
+
+  def _remove_size(self):
+    if self.sizes:
+      self.inflight_bytes -= self.sizes.popleft()
+
+  def _over_budget(self):
+    return self.max_bytes is not None and self.results and self.inflight_bytes >= self.max_bytes
+
+  def cancel(self):
+    """Cancel all the calls which haven't started yet."""
+    for future in self.results:
+      future.cancel()
+    self.results.clear()
+    self.sizes.clear()
+    self.inflight_bytes = 0
+
+  def close(self):
+    self.cancel()
+    self.executor.shutdown(wait=False)
+
+  def join(self):
+    self.executor.shutdown(wait=True)
+
+
+def get_context(start_method=None, preload=()):
+  """Get the multiprocessing context for start_method (None means the platform default).
+  With "forkserver", the server process imports the modules in preload (which can include
+  "__main__") before forking any workers, so each one starts with them already imported, including
+  any C libraries they load. The server is started once, the first time a pool is created, and every
+  later pool in the same process forks its workers from it too."""
+  context = multiprocessing.get_context(start_method)
+  if context.get_start_method() == 'forkserver' and preload:
+    context.set_forkserver_preload(list(preload))
+  return context
+
+
+def estimate_task_size(args, kwargs):
+  """The default task_sizer for the pools: estimate_size() of the arguments."""
+  return estimate_size(args) + estimate_size(kwargs)
+
+
+def estimate_size(obj):
+  """Roughly estimate how many bytes of data an object holds, by adding up the lengths of the strings
+  in it (looking inside dicts, lists, and tuples). Anything else counts as 8 bytes."""
+  if isinstance(obj, (str, bytes)):
+    return len(obj)
+  elif isinstance(obj, dict):
+    return sum([estimate_size(key) + estimate_size(value) for key, value in obj.items()])
+  elif isinstance(obj, (list, tuple)):
+    return sum([estimate_size(item) for item in obj])
+  else:
+    return 8
+
+
+def slice_task_size(args, kwargs):
+  """A task_sizer for tasks which read a slice of a file with read_slice(): the length of the slice,
+  which is the third argument (after the path and offset)."""
+  return args[2]
+
+
+def scan_duplex_offsets(path, num_fields, comment=None):
+  """Find the boundaries of each duplex in a tab-delimited file sorted by barcode (column 1).
+  This only looks at the first column of each line, so it's much cheaper than fully parsing the
+  file. It's meant for the main process to hand off byte ranges to workers, which can parse their
+  own slices with read_slice().
+  Lines without exactly `num_fields` fields (and lines starting with `comment`, if given) don't
+  start new duplexes or count as reads. They're included in the range of the previous duplex.
+  Yields a tuple for each duplex: (offset, length, barcode, num_lines)."""
+  if comment is not None:
+    comment = bytes(comment, 'utf8')
+  num_tabs = num_fields - 1
+  barcode = None
+  start = None
+  num_lines = 0
+  offset = 0
+  with open(path, 'rb') as infile:
+    for line in infile:
+      line_start = offset
+      offset += len(line)
+      if comment is not None and line.startswith(comment):
+        continue
+      if line.count(b'\t') != num_tabs:
+        continue
+      this_barcode = line[:line.index(b'\t')]
+      if this_barcode != barcode:
+        if barcode is not None:
+          yield start, line_start-start, str(barcode, 'utf8'), num_lines
+        barcode = this_barcode
+        start = line_start
+        num_lines = 0
+      num_lines += 1
+  if barcode is not None:
+    yield start, offset-start, str(barcode, 'utf8'), num_lines
+
+
+# Memory maps of input files, kept open for the life of the (worker) process.
+MMAPS = {}
+
+def read_slice(path, offset, length):
+  """Read a range of bytes from a file and return it as a list of lines (with line endings).
+  The file is memory-mapped the first time this is called for it in a given process, and the map is
+  reused for later calls."""
+  mapped = MMAPS.get(path)
+  if mapped is None:
+    with open(path, 'rb') as infile:
+      mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    MMAPS[path] = mapped
+  return str(mapped[offset:offset+length], 'utf8').splitlines(keepends=True)
+
+
+def is_mappable(infile):
+  """Is this open file a regular, non-empty file (and not stdin or a pipe) we can mmap?"""
+  if infile is sys.stdin:
+    return False
+  path = getattr(infile, 'name', None)
+  if not isinstance(path, str):
+    return False
+  return os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+def run_batch(fxn, calls):
+  """Execute fxn once for each (args, kwargs) tuple in calls, for SyncAsyncPool.
+  Returns a list of the results, the number of seconds it took to compute them, the time (from
+  time.time()) they were finished, and the id of the worker which ran them (see get_worker_id()).
+  NOTE: This must execute in the child process."""
+  start = time.perf_counter()
+  results = [with_context(fxn, *args, **kwargs) for args, kwargs in calls]
+  return results, time.perf_counter() - start, time.time(), get_worker_id()
+
+
+# The pipe a SyncAsyncPool worker reports the batches it starts on (see set_started_pipe()).
+STARTED_PIPE = None
+
+def set_started_pipe(pipe):
+  """Initializer for SyncAsyncPool workers. Tells the parent this worker's pid.
+  NOTE: This must execute in the child process."""
+  global STARTED_PIPE
+  STARTED_PIPE = pipe
+  STARTED_PIPE.send((os.getpid(), None))
+
+
+def run_tracked_batch(fxn, calls, batch_id):
+  """Tell the parent which batch this worker is starting, then run_batch().
+  The message is small enough to be written to the pipe atomically, so workers don't need a lock
+  (which a dying worker could leave held).
+  NOTE: This must execute in the child process."""
+  STARTED_PIPE.send((os.getpid(), batch_id))
+  return run_batch(fxn, calls)
+
+
+# The "host:pid" of this process, cached by get_worker_id().
+WORKER_ID = None
+
+def get_worker_id():
+  """Identify this process as "host:pid", so workers on different hosts can't be confused."""
+  global WORKER_ID
+  if WORKER_ID is None or not WORKER_ID.endswith(':'+str(os.getpid())):
+    WORKER_ID = '{}:{}'.format(socket.gethostname(), os.getpid())
+  return WORKER_ID
+
+
 def with_context(fxn, *args, **kwargs):
   """Execute fxn, logging child process' stack trace for any Exceptions that are raised.
   When Exceptions are raised in a multiprocessing subprocess, the stack trace it gives ends where
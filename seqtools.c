@@ -99,6 +99,7 @@ double *get_diffs_frac_simple(char *cons, char *seqs[], int n_seqs) {
     }
     fracs[i] = (double)diffs[i]/j;
   }
+  free(diffs);
   return fracs;
 }
 
@@ -188,7 +189,9 @@ double **get_diffs_frac_binned(char *cons, char *seqs[], int n_seqs, int seq_len
       // printf("bin %d: %d / %d = %f\t", bin, diffs[i][bin], bin_lengths[bin], fracs[i][bin]);
     }
     // printf("\n");
+    free(diffs[i]);
   }
+  free(diffs);
   return fracs;
 }
 
@@ -3,6 +3,10 @@ import sys
 import errno
 import ctypes
 PY3 = sys.version_info.major >= 3
+try:
+  import _dunovo
+except ImportError:
+  _dunovo = None
 
 # Locate the library file.
 LIBFILE = 'libseqtools.so'
@@ -19,6 +23,8 @@ seqtools.transfer_gaps.restype = ctypes.c_char_p
 
 
 def get_revcomp(seq_raw):
+  if _dunovo:
+    return _dunovo.get_revcomp(seq_raw)
   if PY3:
     seq_bytes = bytes(seq_raw, 'utf8')
   else:
@@ -27,6 +33,8 @@ def get_revcomp(seq_raw):
 
 
 def get_diffs_frac_simple(consensus, family):
+  if _dunovo:
+    return _dunovo.get_diffs_frac_simple(consensus, family)
   consensus_c = pystr_to_cstr(consensus)
   family_c = str_pylist_to_str_carray(family)
   seqtools.get_diffs_frac_simple.restype = ctypes.POINTER(ctypes.c_double * len(family))
@@ -35,6 +43,8 @@ def get_diffs_frac_simple(consensus, family):
 
 
 def get_diffs_frac_binned(consensus, family, bins):
+  if _dunovo:
+    return _dunovo.get_diffs_frac_binned(consensus, family, bins)
   seq_len = None
   consensus_c = pystr_to_cstr(consensus)
   family_c = (ctypes.c_char_p * len(family))()
@@ -55,6 +65,8 @@ def get_diffs_frac_binned(consensus, family, bins):
 
 
 def transfer_gaps(aligned, seq, gap_char_in='-', gap_char_out='-'):
+  if _dunovo:
+    return transfer_gaps_multi([seq], [aligned], gap_char_in, gap_char_out)[0]
   aligned_c = pystr_to_cstr(aligned)
   seq_c = pystr_to_cstr(seq)
   if PY3:
@@ -73,6 +85,11 @@ def transfer_gaps(aligned, seq, gap_char_in='-', gap_char_out='-'):
 
 
 def transfer_gaps_multi(seqs, aligned, gap_char_in='-', gap_char_out='-'):
+  if _dunovo:
+    assert len(seqs) == len(aligned), ('Unequal number of gapped and ungapped sequences ({} vs {} '
+                                       'sequences, respectively)'.format(len(aligned), len(seqs)))
+    output = _dunovo.transfer_gaps_multi(seqs, aligned, gap_char_in, gap_char_out)
+    return [str(seq, 'utf8') for seq in output]
   if PY3:
     gap_char_in_bytes = bytes(gap_char_in, 'utf8')
     gap_char_out_bytes = bytes(gap_char_out, 'utf8')
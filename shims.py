@@ -1,5 +1,7 @@
+import os
 import sys
 import importlib
+import importlib.util
 """Stub versions of optional submodules which may fail to clone."""
 
 
@@ -56,3 +58,17 @@ def get_module_or_shim(module_path):
   except TypeError:
     sys.stderr.write('Error: problem loading shim "'+module_name+'".\n')
     raise
+
+
+def import_script(filename):
+  """Import one of the scripts in this directory whose filename isn't a valid module name, like
+  "align-families.py". The module is named after the file, with dashes replaced by underscores."""
+  module_name = os.path.splitext(filename)[0].replace('-', '_')
+  if module_name in sys.modules:
+    return sys.modules[module_name]
+  path = os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)
+  spec = importlib.util.spec_from_file_location(module_name, path)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[module_name] = module
+  spec.loader.exec_module(module)
+  return module
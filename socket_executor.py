@@ -0,0 +1,266 @@
+import os
+import sys
+import time
+import logging
+import importlib
+import threading
+import multiprocessing
+import multiprocessing.connection
+import parallel_tools
+import shims
+
+# The environment variable holding the key that workers and the parent use to authenticate each
+# other. If it's not set, connections aren't authenticated.
+AUTHKEY_VAR = 'DUNOVO_WORKER_KEY'
+# How many batches to keep outstanding on a worker, per process it has.
+BATCHES_PER_PROCESS = 2
+
+
+class SocketExecutor(object):
+  """An executor for SyncAsyncPool which runs the batches of tasks on dunovo-worker.py processes
+  listening on TCP or Unix sockets, possibly on other hosts.
+  Each worker reports how many processes it has when the connection is made, and is sent up to
+  BATCHES_PER_PROCESS batches per process at once. Submitting a batch when every worker is full
+  blocks until one of them returns a result.
+  The tasks and results are pickled, so only connect to workers on a trusted network. The
+  DUNOVO_WORKER_KEY environment variable (set to the same value for the workers) makes both sides
+  authenticate each other. It's required for TCP addresses (see check_authkey())."""
+
+  def __init__(self, addresses, authkey=None):
+    if authkey is None:
+      authkey = get_authkey()
+    for address in addresses:
+      check_authkey(address, authkey)
+    self.connections = []
+    self.capacities = {}
+    self.outstanding = {}
+    for address in addresses:
+      connection = multiprocessing.connection.Client(parse_address(address), authkey=authkey)
+      hello = connection.recv()
+      logging.info(f'Connected to worker {address} with {hello["processes"]} processes.')
+      self.connections.append(connection)
+      self.capacities[connection] = hello['processes'] * BATCHES_PER_PROCESS
+      self.outstanding[connection] = set()
+    if not self.connections:
+      raise ValueError('No worker addresses given.')
+    self.processes = sum([capacity // BATCHES_PER_PROCESS for capacity in self.capacities.values()])
+    self.last_task_id = 0
+    # Finished results, by task id: a tuple of (succeeded, value).
+    self.done = {}
+
+  def submit_batch(self, function, calls):
+    """Send a batch of calls to function to the least busy worker.
+    Returns a SocketResult, whose get() returns the same thing as parallel_tools.run_batch()."""
+    connection = self._get_free_connection()
+    self.last_task_id += 1
+    task_id = self.last_task_id
+    connection.send((task_id, get_function_ref(function), calls))
+    self.outstanding[connection].add(task_id)
+    return SocketResult(self, task_id)
+
+  def _get_free_connection(self):
+    while True:
+      if not self.connections:
+        raise ConnectionError('Lost the connections to all the workers.')
+      connection = min(self.connections,
+                       key=lambda conn: len(self.outstanding[conn])/self.capacities[conn])
+      if len(self.outstanding[connection]) < self.capacities[connection]:
+        return connection
+      self._receive()
+
+  def _receive(self):
+    """Wait for at least one result to come back, and store it in self.done."""
+    busy = [connection for connection in self.connections if self.outstanding[connection]]
+    if not busy:
+      raise RuntimeError('Waiting on a result, but no tasks are outstanding.')
+    for connection in multiprocessing.connection.wait(busy):
+      try:
+        task_id, succeeded, value = connection.recv()
+      except (EOFError, OSError) as error:
+        self._lose_connection(connection, error)
+        continue
+      self.outstanding[connection].discard(task_id)
+      self.done[task_id] = (succeeded, value)
+
+  def _lose_connection(self, connection, error):
+    """Fail all the tasks outstanding on a worker which has gone away."""
+    logging.error(f'Lost the connection to a worker with {len(self.outstanding[connection])} '
+                  f'tasks outstanding: {type(error).__name__}: {error}')
+    for task_id in self.outstanding[connection]:
+      self.done[task_id] = (False, ConnectionError('Lost the connection to the worker.'))
+    self.connections.remove(connection)
+    del self.outstanding[connection]
+    del self.capacities[connection]
+    connection.close()
+
+  def get_result(self, task_id):
+    while task_id not in self.done:
+      self._receive()
+    succeeded, value = self.done.pop(task_id)
+    if succeeded:
+      return value
+    else:
+      raise value
+
+  def close(self):
+    """Tell the workers we're done, once they've returned all their results."""
+    for connection in self.connections:
+      try:
+        connection.send(None)
+      except OSError:
+        pass
+
+  def join(self):
+    for connection in self.connections:
+      connection.close()
+    self.connections = []
+
+
+class SocketResult(object):
+  """Like multiprocessing.pool.AsyncResult, for a batch submitted to a SocketExecutor."""
+
+  def __init__(self, executor, task_id):
+    self.executor = executor
+    self.task_id = task_id
+
+  def get(self):
+    return self.executor.get_result(self.task_id)
+
+
+def get_function_ref(function):
+  """Get a picklable reference to a module-level function which a worker can resolve with
+  resolve_function_ref(). Functions in the main script are referred to by the script's filename,
+  so the worker can import the same script from its own Du Novo directory."""
+  module_name = function.__module__
+  if module_name in ('__main__', '__mp_main__'):
+    script = os.path.basename(sys.modules[module_name].__file__)
+    return ('script', script, function.__name__)
+  else:
+    return ('module', module_name, function.__name__)
+
+
+def resolve_function_ref(function_ref):
+  kind, name, function_name = function_ref
+  if kind == 'script':
+    module = shims.import_script(name)
+  else:
+    module = importlib.import_module(name)
+  return getattr(module, function_name)
+
+
+def run_remote_batch(function_ref, calls):
+  """Run a batch of tasks sent by a SocketExecutor.
+  NOTE: This must execute in the worker's child process."""
+  function = resolve_function_ref(function_ref)
+  return parallel_tools.run_batch(function, calls)
+
+
+def serve(address, processes=None, authkey=None):
+  """Listen on the address and run the batches of tasks sent by SocketExecutors in a pool of this
+  many processes (None means one per cpu core). Each connection is served in its own thread, all
+  sharing the same pool.
+  A Unix socket is created readable and writable only by its owner."""
+  if authkey is None:
+    authkey = get_authkey()
+  check_authkey(address, authkey)
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(processes=processes)
+  try:
+    old_umask = os.umask(0o177)
+    try:
+      listener = multiprocessing.connection.Listener(parse_address(address), authkey=authkey)
+    finally:
+      os.umask(old_umask)
+    with listener:
+      logging.warning(f'Listening on {address} with {processes} processes.')
+      while True:
+        try:
+          connection = listener.accept()
+        except (multiprocessing.AuthenticationError, EOFError, ConnectionError) as error:
+          logging.warning(f'Rejected a connection: {type(error).__name__}: {error}')
+          continue
+        thread = threading.Thread(target=serve_connection, args=(connection, pool, processes),
+                                  daemon=True)
+        thread.start()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def serve_connection(connection, pool, processes):
+  """Run the batches sent over one connection until the parent says it's done or goes away, then
+  close it."""
+  with connection:
+    _serve_connection(connection, pool, processes)
+
+
+def _serve_connection(connection, pool, processes):
+  start = time.time()
+  logging.info('Accepted a connection.')
+  send_lock = threading.Lock()
+  outstanding = set()
+  all_done = threading.Condition(send_lock)
+  def reply(task_id, succeeded, value):
+    with send_lock:
+      try:
+        connection.send((task_id, succeeded, value))
+      except OSError:
+        pass
+      except Exception as error:
+        # The value couldn't be pickled (probably an exception). Send a description instead.
+        connection.send((task_id, False, RuntimeError(f'{type(value).__name__}: {value}')))
+      outstanding.discard(task_id)
+      all_done.notify_all()
+  connection.send({'processes':processes})
+  tasks = 0
+  while True:
+    try:
+      message = connection.recv()
+    except (EOFError, OSError):
+      logging.warning('The parent went away.')
+      break
+    if message is None:
+      break
+    task_id, function_ref, calls = message
+    with send_lock:
+      outstanding.add(task_id)
+    pool.apply_async(
+      run_remote_batch, (function_ref, calls),
+      callback=lambda result, task_id=task_id: reply(task_id, True, result),
+      error_callback=lambda error, task_id=task_id: reply(task_id, False, error),
+    )
+    tasks += 1
+  # Let the last results get sent before closing the connection.
+  with all_done:
+    while outstanding:
+      all_done.wait()
+  logging.info(f'Finished {tasks} batches in {time.time()-start:0.1f}s.')
+
+
+def parse_address(address):
+  """Parse a "host:port" string into a (host, port) tuple. Anything else is a Unix socket path."""
+  if '/' not in address and ':' in address:
+    host, port = address.rsplit(':', 1)
+    try:
+      return host, int(port)
+    except ValueError:
+      raise ValueError(f'Invalid port in address {address!r}.')
+  return address
+
+
+def check_authkey(address, authkey):
+  """Refuse to use a TCP address without an authkey. The tasks are pickles naming functions to
+  import and run, so an unauthenticated TCP worker would run code for anyone who can reach its port.
+  A Unix socket is protected by its file permissions instead."""
+  if authkey is None and isinstance(parse_address(address), tuple):
+    raise ValueError(f'Refusing to use the TCP address {address} without authentication. Set the '
+                     f'{AUTHKEY_VAR} environment variable to the same secret for the workers and '
+                     'the script, or use a Unix socket.')
+
+
+def get_authkey():
+  key = os.environ.get(AUTHKEY_VAR)
+  if key:
+    return bytes(key, 'utf8')
+  return None
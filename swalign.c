@@ -71,18 +71,22 @@ static char get_char_comp(char c) {
 
 // // works globally
 // Note: Currently the "local" flag isn't functional. It seems to always do a local alignment.
-static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
+// If the matrix is banded, "hit_band" is set to whether the path passed along the edge of the band
+// (where the cells outside it might have led to a different path).
+static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local, bool *hit_band) {
   align_t *result = malloc(sizeof(align_t));
   seq_pair_t *seqs = malloc(sizeof(seq_pair_t));
   unsigned int i    = S->m - 1;
   unsigned int j    = S->n - 1;
   unsigned int k    = 0;
+  entry_t *entry;
   // Create output strings. Allocate maximum potential length.
   char c[S->m + S->n + 1];
   char d[S->m + S->n + 1];
 
   memset(c, '\0', sizeof(c));
   memset(d, '\0', sizeof(d));
+  *hit_band = false;
 
   // This wasn't finished by NLH. Not functioning correctly yet.
   // It seems the purpose is to start the traceback from the place where the score reaches its
@@ -92,11 +96,21 @@ static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
     double max = FLT_MIN;
 
     for (l = 0; l < S->m; l++) {
-      for (m = 0; m < S->n; m++) {
-        if (S->mat[l][m].score > max) {
+      // In a banded matrix, only look at the cells in the band, so this isn't O(m*n) either.
+      unsigned int m_start = 0;
+      unsigned int m_end = S->n;
+      if (S->banded) {
+        int band_start = (int)l + S->band_lo;
+        int band_end = band_start + (int)S->band_width;
+        m_start = band_start > 0 ? band_start : 0;
+        m_end = band_end < (int)S->n ? (band_end > 0 ? band_end : 0) : S->n;
+      }
+      for (m = m_start; m < m_end; m++) {
+        entry = get_entry(S, l, m);
+        if (entry && entry->score > max) {
           i = l;
           j = m;
-          max = S->mat[l][m].score;
+          max = entry->score;
         } 
       } 
     }
@@ -112,10 +126,17 @@ static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
   bool move_j = false;
   // Walk back through the matrix from the end, taking the path determined by the "prev" values of
   // each cell. Assemble the sequence along the way.
-  if (S->mat[i][j].prev[0] != 0 && S->mat[i][j].prev[1] != 0) {
+  entry = get_entry(S, i, j);
+  if (entry->prev[0] != 0 && entry->prev[1] != 0) {
     while (i > 0 || j > 0) {
-      unsigned int new_i = S->mat[i][j].prev[0];
-      unsigned int new_j = S->mat[i][j].prev[1];
+      entry = get_entry(S, i, j);
+      unsigned int new_i = entry->prev[0];
+      unsigned int new_j = entry->prev[1];
+      // Is a neighbor of this cell outside the band?
+      if (S->banded && ((j > 0 && get_entry(S, i, j-1) == NULL) ||
+                        (i > 0 && get_entry(S, i-1, j) == NULL))) {
+        *hit_band = true;
+      }
   
       // If we've moved in the i axis, add the new base to the sequence. Otherwise, it's a gap.
       if (new_i < i) {
@@ -135,8 +156,8 @@ static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
         move_j = false;
       }
 
-      if (S->mat[i][j].score > score) {
-        score = S->mat[i][j].score;
+      if (entry->score > score) {
+        score = entry->score;
       }
 
       if (move_i && move_j) {
@@ -164,8 +185,8 @@ static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
   seqs->a = malloc(sizeof(char) * k + 1);
   seqs->b = malloc(sizeof(char) * k + 1);
 
-  memset(seqs->a, '\0', sizeof(seqs->a));
-  memset(seqs->b, '\0', sizeof(seqs->b));
+  memset(seqs->a, '\0', sizeof(char) * k + 1);
+  memset(seqs->b, '\0', sizeof(char) * k + 1);
 
   reverse(c);
   reverse(d);
@@ -189,26 +210,47 @@ static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local) {
 
 static matrix_t *create_matrix(unsigned int m, unsigned int n) {
   matrix_t *S = malloc(sizeof(matrix_t));
-  unsigned int i;
 
   S->m = m;
   S->n = n;
+  S->banded = false;
+  S->band_lo = 0;
+  S->band_width = n;
 
-  S->mat = malloc(sizeof(entry_t) * m * n);
+  S->entries = malloc(sizeof(entry_t) * m * n);
 
-  for (i = 0; i < m; i++) {
-    S->mat[i] = malloc(sizeof(entry_t) * n);
-  }
+  return S;
+}
+
+// Create a matrix which only holds the cells where j-i is between band_lo and band_hi.
+static matrix_t *create_banded_matrix(unsigned int m, unsigned int n, int band_lo, int band_hi) {
+  matrix_t *S = malloc(sizeof(matrix_t));
+
+  S->m = m;
+  S->n = n;
+  S->banded = true;
+  S->band_lo = band_lo;
+  S->band_width = band_hi - band_lo + 1;
+
+  S->entries = malloc(sizeof(entry_t) * m * S->band_width);
 
   return S;
 }
 
-void destroy_matrix(matrix_t *S) {
-  unsigned int i;
-  for (i = 0; i < S->m; i++) {
-    free(S->mat[i]);
+// Get the cell at row i, column j, or NULL if it's outside the band.
+static entry_t *get_entry(matrix_t *S, unsigned int i, unsigned int j) {
+  if (S->banded) {
+    int offset = (int)j - (int)i - S->band_lo;
+    if (offset < 0 || offset >= (int)S->band_width) {
+      return NULL;
+    }
+    return &S->entries[(size_t)i * S->band_width + offset];
   }
-  free(S->mat);
+  return &S->entries[(size_t)i * S->n + j];
+}
+
+void destroy_matrix(matrix_t *S) {
+  free(S->entries);
   free(S);
   return;
 }
@@ -216,6 +258,7 @@ void destroy_matrix(matrix_t *S) {
 // Print a visual representation of the path through the matrix.
 void print_matrix(matrix_t *matrix, seq_pair_t *seq_pair) {
   int i, j;
+  entry_t *entry;
   for (i = 0; i < matrix->m; i++) {
     if (i == 0) {
       printf("\t\t");
@@ -235,7 +278,12 @@ void print_matrix(matrix_t *matrix, seq_pair_t *seq_pair) {
       printf("%c %4d  ", seq_pair->a[i-1], i);
     }
     for (j = 0; j < matrix->n; j++) {
-      printf("%d,%d|%0.0f\t", matrix->mat[i][j].prev[0], matrix->mat[i][j].prev[1], matrix->mat[i][j].score);
+      entry = get_entry(matrix, i, j);
+      if (entry) {
+        printf("%d,%d|%0.0f\t", entry->prev[0], entry->prev[1], entry->score);
+      } else {
+        printf("\t");
+      }
     }
     printf("\n");
   }
@@ -248,36 +296,64 @@ void destroy_seq_pair(seq_pair_t *pair) {
   return;
 }
 
-align_t *smith_waterman(seq_pair_t *problem, bool local) {
-  unsigned int m = problem->alen + 1;
-  unsigned int n = problem->blen + 1;
-  matrix_t *S = create_matrix(m, n);
-  align_t *result;
+void destroy_align(align_t *align) {
+  destroy_seq_pair(align->seqs);
+  free(align);
+}
+
+// The score of a cell, where cells outside the band count as if no alignment reached them.
+static double get_score(matrix_t *S, unsigned int i, unsigned int j) {
+  entry_t *entry = get_entry(S, i, j);
+  if (entry) {
+    return entry->score;
+  } else {
+    return DBL_MIN;
+  }
+}
+
+// Fill in the scores and paths of all the cells in the matrix (or in its band).
+static void fill_matrix(seq_pair_t *problem, matrix_t *S) {
   unsigned int i, j, k, l;
+  entry_t *entry;
 
-  S->mat[0][0].score   = 0;
-  S->mat[0][0].prev[0] = 0;
-  S->mat[0][0].prev[1] = 0;
+  entry = get_entry(S, 0, 0);
+  entry->score   = 0;
+  entry->prev[0] = 0;
+  entry->prev[1] = 0;
 
-  for (i = 1; i <= problem->alen; i++) {
-    S->mat[i][0].score   = 0.0;
-    S->mat[i][0].prev[0] = i-1;
-    S->mat[i][0].prev[1] = 0;
+  for (i = 1; i <= problem->alen && (entry = get_entry(S, i, 0)); i++) {
+    entry->score   = 0.0;
+    entry->prev[0] = i-1;
+    entry->prev[1] = 0;
   }
 
-  for (j = 1; j <= problem->blen; j++) {
-    S->mat[0][j].score   = 0.0;
-    S->mat[0][j].prev[0] = 0;
-    S->mat[0][j].prev[1] = j-1;
+  for (j = 1; j <= problem->blen && (entry = get_entry(S, 0, j)); j++) {
+    entry->score   = 0.0;
+    entry->prev[0] = 0;
+    entry->prev[1] = j-1;
   }
 
   for (i = 1; i <= problem->alen; i++) {
-    for (j = 1; j <= problem->blen; j++) {
+    // Only visit the columns within the band.
+    unsigned int j_start = 1;
+    unsigned int j_end = problem->blen;
+    if (S->banded) {
+      int band_start = (int)i + S->band_lo;
+      int band_end = band_start + (int)S->band_width - 1;
+      if (band_start > 1) {
+        j_start = band_start;
+      }
+      if (band_end < (int)problem->blen) {
+        j_end = band_end < 0 ? 0 : band_end;
+      }
+    }
+    for (j = j_start; j <= j_end; j++) {
       int nw_score = (strncmp(problem->a+(i-1), problem->b+(j-1), 1) == 0) ? MATCH : MISMATCH;
 
-      S->mat[i][j].score   = DBL_MIN;
-      S->mat[i][j].prev[0] = 0;
-      S->mat[i][j].prev[1] = 0;
+      entry = get_entry(S, i, j);
+      entry->score   = DBL_MIN;
+      entry->prev[0] = 0;
+      entry->prev[1] = 0;
 
       for (k = 0; k <= 1; k++) {
         for (l = 0; l <= 1; l++) {
@@ -297,19 +373,27 @@ align_t *smith_waterman(seq_pair_t *problem, bool local) {
             // do nothing..
           }
 
-          val += S->mat[i-k][j-l].score;
+          val += get_score(S, i-k, j-l);
 
-          if (val > S->mat[i][j].score) {
-            S->mat[i][j].score   = val;
-            S->mat[i][j].prev[0] = i-k;
-            S->mat[i][j].prev[1] = j-l;
+          if (val > entry->score) {
+            entry->score   = val;
+            entry->prev[0] = i-k;
+            entry->prev[1] = j-l;
           }
         }
       }
     }
   }
+}
+
+align_t *smith_waterman(seq_pair_t *problem, bool local) {
+  matrix_t *S = create_matrix(problem->alen + 1, problem->blen + 1);
+  align_t *result;
+  bool hit_band;
+
+  fill_matrix(problem, S);
 
-  result = traceback(problem, S, local);
+  result = traceback(problem, S, local, &hit_band);
 
   // print_matrix(S, problem);
 
@@ -318,6 +402,415 @@ align_t *smith_waterman(seq_pair_t *problem, bool local) {
   return result;
 }
 
+/* A faster version of smith_waterman() for sequences which are expected to be similar.
+ * Only the cells within "band" of the diagonals are computed: those where j-i is between
+ * min(0, blen-alen)-band and max(0, blen-alen)+band. That takes O(length*band) time and memory
+ * instead of O(alen*blen). The result is the same as smith_waterman() as long as the best path
+ * doesn't stray outside the band.
+ * Give a "band" of 0 to choose one automatically: it starts at a tenth of the shorter sequence (or
+ * MIN_AUTO_BAND), and is doubled and the alignment redone until the band holds the cell the full
+ * matrix's traceback would start from (found like smith_waterman_score() does), the alignment has
+ * that cell's score, and its path doesn't run along the edge of the band (or the band covers the
+ * whole matrix). Checking the cell catches best paths which lie entirely outside the band, like
+ * those of sequences which overlap at an offset. It costs a pass over the full matrix, but a
+ * vectorized one that only keeps a row in memory.
+ * The result then has the same score and end as smith_waterman()'s. Only the path to the end can
+ * differ, where the full matrix has an equally scoring one through cells outside the band. That's
+ * rare, and hasn't been seen except with unrelated sequences.
+ */
+align_t *smith_waterman_banded(seq_pair_t *problem, bool local, int band) {
+  bool auto_band = band <= 0;
+  int diff = (int)problem->blen - (int)problem->alen;
+  score_best_t full_best = {0, false, 0, 0};
+  if (auto_band) {
+    band = (problem->alen < problem->blen ? problem->alen : problem->blen) / 10;
+    if (band < MIN_AUTO_BAND) {
+      band = MIN_AUTO_BAND;
+    }
+    find_best(problem, &full_best, true);
+  }
+  while (true) {
+    int band_lo = (diff < 0 ? diff : 0) - band;
+    int band_hi = (diff > 0 ? diff : 0) + band;
+    // Once the band covers the whole matrix, there's no point in banding.
+    if (band_lo <= -(int)problem->alen && band_hi >= (int)problem->blen) {
+      return smith_waterman(problem, local);
+    }
+    matrix_t *S = create_banded_matrix(problem->alen + 1, problem->blen + 1, band_lo, band_hi);
+    bool hit_band;
+    fill_matrix(problem, S);
+    align_t *result = traceback(problem, S, local, &hit_band);
+    // The traceback has to start from the same cell as in the full matrix, with the same score.
+    // Other cells with that score can be inside the band when it isn't, or when the band cuts off
+    // the path which gives it its score.
+    entry_t *best_entry = get_entry(S, full_best.i, full_best.j);
+    bool found_best = full_best.score == 0 ||
+                      (best_entry != NULL && best_entry->score == full_best.score);
+    destroy_matrix(S);
+    if (! (auto_band && (hit_band || ! found_best || result->score < get_best_score(&full_best)))) {
+      return result;
+    }
+    destroy_align(result);
+    band *= 2;
+  }
+}
+
+/***** Score-only alignment *****/
+
+// The score given to the padding past the end of the query in the striped kernels, low enough that
+// no alignment through it can beat one through the real positions.
+#define PADDING_SCORE -1000
+
+// The instruction set smith_waterman_score() uses: one of the SIMD_* values. It's detected on the
+// first call, but it can be set beforehand (e.g. to test the fallbacks).
+int simd_level = SIMD_AUTO;
+
+// Gaps are free along the last row and column, like in fill_matrix().
+static int gap_h(seq_pair_t *problem, unsigned int i) {
+  return i == problem->alen ? 0 : GAP;
+}
+
+static int gap_v(seq_pair_t *problem, unsigned int j) {
+  return j == problem->blen ? 0 : GAP;
+}
+
+// Record the maximum score of row i, if it's higher than any before it. "j" is the first column
+// with that score (or, from the striped kernels, 1 if that's column 1 and 2 otherwise), and "left" and "up" are the scores of the cells to its left and above it.
+// traceback() only proceeds if the cell's prev is outside row and column 0, which depends on which
+// move (the first of horizontal, vertical, and diagonal) gave it its score.
+static void update_best(seq_pair_t *problem, score_best_t *best, unsigned int i, unsigned int j,
+                        int score, int left, int up) {
+  if (score <= best->score) {
+    return;
+  }
+  best->score = score;
+  best->i = i;
+  best->j = j;
+  if (i == 1) {
+    // Only a horizontal move stays out of row 0.
+    best->traceable = j > 1 && left + gap_h(problem, i) == score;
+  } else if (j == 1) {
+    // A horizontal move from column 0 can't give a positive score, and a diagonal one comes from
+    // column 0.
+    best->traceable = up + gap_v(problem, j) == score;
+  } else {
+    best->traceable = true;
+  }
+}
+
+static void update_best_from_row(seq_pair_t *problem, score_best_t *best, unsigned int i,
+                                 int *prev, int *cur) {
+  unsigned int j;
+  unsigned int max_j = 0;
+  int max = 0;
+  for (j = 1; j <= problem->blen; j++) {
+    if (cur[j] > max) {
+      max = cur[j];
+      max_j = j;
+    }
+  }
+  if (max_j) {
+    update_best(problem, best, i, max_j, max, cur[max_j-1], prev[max_j]);
+  }
+}
+
+// Compute the scores of row i from those of row i-1, like fill_matrix(). It adds up the scores as
+// ints, so a MISMATCH counts as 0, and a cell with no positive score counts as 0.
+static void score_row(seq_pair_t *problem, unsigned int i, int *prev, int *cur) {
+  int match = MATCH;
+  int mismatch = MISMATCH;
+  int gap = gap_h(problem, i);
+  char c = problem->a[i-1];
+  unsigned int j;
+  cur[0] = 0;
+  for (j = 1; j <= problem->blen; j++) {
+    int score = prev[j-1] + (c == problem->b[j-1] ? match : mismatch);
+    int up = prev[j] + gap_v(problem, j);
+    int left = cur[j-1] + gap;
+    if (up > score) {
+      score = up;
+    }
+    if (left > score) {
+      score = left;
+    }
+    cur[j] = score > 0 ? score : 0;
+  }
+}
+
+// traceback() gives a score of DBL_MIN when it doesn't proceed.
+static double get_best_score(score_best_t *best) {
+  if (best->score > 0 && best->traceable) {
+    return best->score;
+  } else {
+    return DBL_MIN;
+  }
+}
+
+// Compute the score one row at a time, in O(blen) memory.
+static void score_scalar(seq_pair_t *problem, score_best_t *best) {
+  int *prev = calloc(problem->blen + 1, sizeof(int));
+  int *cur = malloc(sizeof(int) * (problem->blen + 1));
+  int *tmp;
+  unsigned int i;
+  for (i = 1; i <= problem->alen; i++) {
+    score_row(problem, i, prev, cur);
+    update_best_from_row(problem, best, i, prev, cur);
+    tmp = prev;
+    prev = cur;
+    cur = tmp;
+  }
+  free(prev);
+  free(cur);
+}
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define HAVE_SIMD
+#include <immintrin.h>
+
+#define FILL_ROWS fill_rows_sse2
+#define TARGET __attribute__((target("sse2")))
+#define LANES 8
+#define VEC __m128i
+#define VLOAD(p) _mm_load_si128(p)
+#define VSTORE(p, v) _mm_store_si128(p, v)
+#define VSET1(x) _mm_set1_epi16(x)
+#define VZERO() _mm_setzero_si128()
+#define VADDS(a, b) _mm_adds_epi16(a, b)
+#define VMAX(a, b) _mm_max_epi16(a, b)
+#define VANY_GT(a, b) _mm_movemask_epi8(_mm_cmpgt_epi16(a, b))
+#define VSHIFT(v) _mm_slli_si128(v, 2)
+#define VFIRST(v) ((int16_t)_mm_cvtsi128_si32(v))
+#include "swalign_striped.h"
+#undef FILL_ROWS
+#undef TARGET
+#undef LANES
+#undef VEC
+#undef VLOAD
+#undef VSTORE
+#undef VSET1
+#undef VZERO
+#undef VADDS
+#undef VMAX
+#undef VANY_GT
+#undef VSHIFT
+#undef VFIRST
+
+#define FILL_ROWS fill_rows_avx2
+#define TARGET __attribute__((target("avx2")))
+#define LANES 16
+#define VEC __m256i
+#define VLOAD(p) _mm256_load_si256(p)
+#define VSTORE(p, v) _mm256_store_si256(p, v)
+#define VSET1(x) _mm256_set1_epi16(x)
+#define VZERO() _mm256_setzero_si256()
+#define VADDS(a, b) _mm256_adds_epi16(a, b)
+#define VMAX(a, b) _mm256_max_epi16(a, b)
+#define VANY_GT(a, b) _mm256_movemask_epi8(_mm256_cmpgt_epi16(a, b))
+// Shifting across the two 128-bit halves takes a permute first.
+#define VSHIFT(v) _mm256_alignr_epi8(v, _mm256_permute2x128_si256(v, v, 0x08), 14)
+#define VFIRST(v) ((int16_t)_mm_cvtsi128_si32(_mm256_castsi256_si128(v)))
+#include "swalign_striped.h"
+#undef FILL_ROWS
+#undef TARGET
+#undef LANES
+#undef VEC
+#undef VLOAD
+#undef VSTORE
+#undef VSET1
+#undef VZERO
+#undef VADDS
+#undef VMAX
+#undef VANY_GT
+#undef VSHIFT
+#undef VFIRST
+#endif
+
+static int get_simd_level(void) {
+  if (simd_level == SIMD_AUTO) {
+    simd_level = SIMD_NONE;
+#ifdef HAVE_SIMD
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) {
+      simd_level = SIMD_AVX2;
+    } else if (__builtin_cpu_supports("sse2")) {
+      simd_level = SIMD_SSE2;
+    }
+#endif
+  }
+  return simd_level;
+}
+
+// Compute the score with the striped kernel for the given instruction set. Rows 1 and alen (where
+// horizontal gaps are free) are done by score_row(), so this needs an alen of at least 3.
+// If find_cell, best->j is the exact column of the best score.
+static void score_striped(seq_pair_t *problem, int level, score_best_t *best, bool find_cell) {
+#ifdef HAVE_SIMD
+  striped_t st;
+  unsigned int lanes = level == SIMD_AVX2 ? 16 : 8;
+  unsigned int seg_len = (problem->blen + lanes - 1) / lanes;
+  size_t vec_len = (size_t)seg_len * lanes;
+  int match = MATCH;
+  int mismatch = MISMATCH;
+  int n_chars = 0;
+  unsigned char chars[256];
+  int16_t *block;
+  int *prev, *cur;
+  unsigned int i, q;
+
+  // Give each distinct character in the target a profile.
+  for (i = 0; i < 256; i++) {
+    st.char_indices[i] = -1;
+  }
+  for (i = 0; i < problem->alen; i++) {
+    unsigned char c = problem->a[i];
+    if (st.char_indices[c] == -1) {
+      chars[n_chars] = c;
+      st.char_indices[c] = n_chars++;
+    }
+  }
+  if (posix_memalign((void **)&block, 32, sizeof(int16_t) * vec_len * (4 + n_chars)) != 0) {
+    score_scalar(problem, best);
+    return;
+  }
+  st.lanes = lanes;
+  st.seg_len = seg_len;
+  st.h_prev = block;
+  st.h_cur = block + vec_len;
+  st.gaps_v = block + vec_len * 2;
+  st.best_row = find_cell ? block + vec_len * 3 : NULL;
+  st.profiles = block + vec_len * 4;
+  for (q = 0; q < vec_len; q++) {
+    size_t index = (q % seg_len) * lanes + q / seg_len;
+    st.gaps_v[index] = q < problem->blen ? gap_v(problem, q+1) : GAP;
+    for (i = 0; i < n_chars; i++) {
+      int16_t score = PADDING_SCORE;
+      if (q < problem->blen) {
+        score = (unsigned char)problem->b[q] == chars[i] ? match : mismatch;
+      }
+      st.profiles[i * vec_len + index] = score;
+    }
+  }
+
+  prev = calloc(problem->blen + 1, sizeof(int));
+  cur = malloc(sizeof(int) * (problem->blen + 1));
+  score_row(problem, 1, prev, cur);
+  update_best_from_row(problem, best, 1, prev, cur);
+  for (q = 0; q < vec_len; q++) {
+    st.h_prev[(q % seg_len) * lanes + q / seg_len] = q < problem->blen ? cur[q+1] : 0;
+  }
+  if (level == SIMD_AVX2) {
+    fill_rows_avx2(problem, &st, 2, problem->alen - 1, best);
+  } else {
+    fill_rows_sse2(problem, &st, 2, problem->alen - 1, best);
+  }
+  // If the best score came from the striped kernel, find its first column in the saved row.
+  if (find_cell && best->i > 1 && best->i < problem->alen) {
+    for (q = 0; q < problem->blen; q++) {
+      if (st.best_row[(q % seg_len) * lanes + q / seg_len] == best->score) {
+        best->j = q + 1;
+        break;
+      }
+    }
+  }
+  prev[0] = 0;
+  for (q = 0; q < problem->blen; q++) {
+    prev[q+1] = st.h_prev[(q % seg_len) * lanes + q / seg_len];
+  }
+  score_row(problem, problem->alen, prev, cur);
+  update_best_from_row(problem, best, problem->alen, prev, cur);
+
+  free(prev);
+  free(cur);
+  free(block);
+#else
+  score_scalar(problem, best);
+#endif
+}
+
+// Find the best score in the matrix, and the cell smith_waterman()'s traceback would start from.
+// Unless find_cell is true, best->j may not be exact (see update_best()).
+static void find_best(seq_pair_t *problem, score_best_t *best, bool find_cell) {
+  int level = get_simd_level();
+  unsigned int min_len = problem->alen < problem->blen ? problem->alen : problem->blen;
+  if (level == SIMD_NONE || problem->alen < 3 || min_len < MIN_SIMD_LEN || min_len > MAX_SIMD_LEN) {
+    score_scalar(problem, best);
+    return;
+  }
+  // For short queries, the wider vectors are mostly padding.
+  if (level == SIMD_AVX2 && problem->blen < MIN_AVX2_LEN) {
+    level = SIMD_SSE2;
+  }
+  score_striped(problem, level, best, find_cell);
+}
+
+/* Compute the score smith_waterman() would give an alignment, without doing the traceback.
+ * This only keeps one row of the matrix at a time, and uses a striped SIMD kernel (AVX2 or SSE2,
+ * whichever the CPU supports) when it can.
+ */
+double smith_waterman_score(seq_pair_t *problem) {
+  score_best_t best = {0, false, 0, 0};
+  find_best(problem, &best, false);
+  return get_best_score(&best);
+}
+
+/***** Batches *****/
+
+static void *run_batch(void *arg) {
+  batch_t *batch = arg;
+  unsigned int i;
+  while ((i = __sync_fetch_and_add(&batch->next, 1)) < batch->n) {
+    if (batch->aligns == NULL) {
+      batch->scores[i] = smith_waterman_score(&batch->problems[i]);
+    } else if (batch->band < 0) {
+      batch->aligns[i] = smith_waterman(&batch->problems[i], batch->local);
+    } else {
+      batch->aligns[i] = smith_waterman_banded(&batch->problems[i], batch->local, batch->band);
+    }
+  }
+  return NULL;
+}
+
+// Run the batch in this thread plus up to threads-1 others.
+static void run_batch_threads(batch_t *batch, unsigned int threads) {
+  unsigned int i;
+  unsigned int started = 0;
+  // Detect the instruction set before the threads can race to do it.
+  get_simd_level();
+  if (threads > batch->n) {
+    threads = batch->n;
+  }
+  pthread_t workers[threads > 1 ? threads - 1 : 1];
+  for (i = 0; i + 1 < threads; i++) {
+    // If a thread can't be started, the rest of the work just falls to the ones that were.
+    if (pthread_create(&workers[started], NULL, run_batch, batch) == 0) {
+      started++;
+    }
+  }
+  run_batch(batch);
+  for (i = 0; i < started; i++) {
+    pthread_join(workers[i], NULL);
+  }
+}
+
+/* Align each of an array of n sequence pairs, storing the results in "aligns" (an array of n
+ * pointers, each of which must be freed with destroy_align()).
+ * A "band" of -1 computes the full matrix, like smith_waterman(). Otherwise, it's passed to
+ * smith_waterman_banded(). The work is split between "threads" threads.
+ */
+void smith_waterman_batch(seq_pair_t *problems, unsigned int n, bool local, int band,
+                          unsigned int threads, align_t **aligns) {
+  batch_t batch = {problems, n, 0, local, band, aligns, NULL};
+  run_batch_threads(&batch, threads);
+}
+
+// Compute smith_waterman_score() for each of an array of n sequence pairs, storing the results in
+// "scores" (an array of n doubles).
+void smith_waterman_score_batch(seq_pair_t *problems, unsigned int n, unsigned int threads,
+                                double *scores) {
+  batch_t batch = {problems, n, 0, true, -1, NULL, scores};
+  run_batch_threads(&batch, threads);
+}
+
 void print_alignment(align_t *result, int target_len, int query_len) {
   printf("Score: %0.0f  Matches: %d\n", result->score, result->matches);
   printf("Target: %3d %s %-3d\n", result->start_a, result->seqs->a, result->end_a);
@@ -25,6 +25,8 @@
 
 #include <float.h>
 #include <math.h>
+#include <pthread.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -32,6 +34,19 @@
 #define GAP -1.0
 #define MATCH 2.0
 #define MISMATCH -0.5
+// The narrowest band smith_waterman_banded() will choose automatically.
+#define MIN_AUTO_BAND 8
+// The instruction sets smith_waterman_score() can use.
+#define SIMD_AUTO -1
+#define SIMD_NONE 0
+#define SIMD_SSE2 1
+#define SIMD_AVX2 2
+// The vectorized kernels use 16-bit scores, so they're only used when the shorter sequence is at
+// most MAX_SIMD_LEN long. Below MIN_SIMD_LEN, setting up the vectors costs more than it saves.
+#define MIN_SIMD_LEN 16
+#define MAX_SIMD_LEN 16000
+// Queries shorter than this use SSE2 even when AVX2 is available.
+#define MIN_AVX2_LEN 64
 //             ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz
 #define TRANS "TVGHEFCDIJMLKNOPQYWAABSXRZ[\\]^_`tvghefcdijmlknopqywaabsxrz"
 #define TRANS_OFFSET 65
@@ -52,10 +67,15 @@ typedef struct {
   unsigned int prev[2];
 } entry_t;
 
+// The matrix is stored in one block, row by row. If it's banded, only the cells within the band
+// are stored: for row i, the cells from column i+band_lo to i+band_lo+band_width-1.
 typedef struct {
   unsigned int m;
   unsigned int n;
-  entry_t **mat;
+  bool banded;
+  int band_lo;
+  unsigned int band_width;
+  entry_t *entries;
 } matrix_t;
 
 typedef struct {
@@ -68,16 +88,62 @@ typedef struct {
   double score;
 } align_t;
 
+// The highest score found so far by smith_waterman_score(), and whether the traceback in
+// smith_waterman() would proceed from the first cell with that score. That cell is at row i,
+// column j (but the striped kernels only give the exact column if asked to; see find_best()).
+typedef struct {
+  int score;
+  bool traceable;
+  unsigned int i;
+  unsigned int j;
+} score_best_t;
+
+// The state of a striped kernel. The scores for the query positions are stored in seg_len vectors
+// of "lanes" 16-bit ints: position q is in lane q/seg_len of vector q%seg_len (Farrar 2007).
+// Positions past the end of the query are padding which can't affect the real ones.
+typedef struct {
+  unsigned int lanes;
+  unsigned int seg_len;
+  int16_t *h_prev;
+  int16_t *h_cur;
+  // The score of a vertical gap into each position.
+  int16_t *gaps_v;
+  // For each distinct character in the target, the score of aligning it to each query position.
+  int16_t *profiles;
+  // If not NULL, a copy of the row with the best score is kept here, to find its column in.
+  int16_t *best_row;
+  int char_indices[256];
+} striped_t;
+
+// The work shared by the threads of smith_waterman_batch() and smith_waterman_score_batch().
+// Each thread takes the next unclaimed pair until there are none left. If "aligns" is NULL, only
+// the scores are computed.
+typedef struct {
+  seq_pair_t *problems;
+  unsigned int n;
+  unsigned int next;
+  bool local;
+  int band;
+  align_t **aligns;
+  double *scores;
+} batch_t;
+
 static char* reverse(char *str);
 
 static char get_char_comp(char c);
 
 char* revcomp(char *str);
 
-static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local);
+static align_t *traceback(seq_pair_t *problem, matrix_t *S, bool local, bool *hit_band);
 
 static matrix_t *create_matrix(unsigned int m, unsigned int n);
 
+static matrix_t *create_banded_matrix(unsigned int m, unsigned int n, int band_lo, int band_hi);
+
+static entry_t *get_entry(matrix_t *S, unsigned int i, unsigned int j);
+
+static void fill_matrix(seq_pair_t *problem, matrix_t *S);
+
 void destroy_matrix(matrix_t *S);
 
 void print_matrix(matrix_t *matrix, seq_pair_t *seq_pair);
@@ -86,4 +152,36 @@ void destroy_seq_pair(seq_pair_t *pair);
 
 align_t *smith_waterman(seq_pair_t *problem, bool local);
 
+align_t *smith_waterman_banded(seq_pair_t *problem, bool local, int band);
+
+void destroy_align(align_t *align);
+
+static void update_best(seq_pair_t *problem, score_best_t *best, unsigned int i, unsigned int j,
+                        int score, int left, int up);
+
+static void update_best_from_row(seq_pair_t *problem, score_best_t *best, unsigned int i,
+                                 int *prev, int *cur);
+
+static void score_row(seq_pair_t *problem, unsigned int i, int *prev, int *cur);
+
+static double get_best_score(score_best_t *best);
+
+static void score_scalar(seq_pair_t *problem, score_best_t *best);
+
+static void score_striped(seq_pair_t *problem, int level, score_best_t *best, bool find_cell);
+
+static void find_best(seq_pair_t *problem, score_best_t *best, bool find_cell);
+
+double smith_waterman_score(seq_pair_t *problem);
+
+static void *run_batch(void *arg);
+
+static void run_batch_threads(batch_t *batch, unsigned int threads);
+
+void smith_waterman_batch(seq_pair_t *problems, unsigned int n, bool local, int band,
+                          unsigned int threads, align_t **aligns);
+
+void smith_waterman_score_batch(seq_pair_t *problems, unsigned int n, unsigned int threads,
+                                double *scores);
+
 void print_alignment(align_t *result, int target_len, int query_len);
@@ -4,6 +4,10 @@ import errno
 import ctypes
 import string
 PY3 = sys.version_info.major >= 3
+try:
+  import _dunovo
+except ImportError:
+  _dunovo = None
 
 # Locate the library file.
 LIBFILE = 'libswalign.so'
@@ -65,6 +69,16 @@ class Align(object):
     self.matches = align_c.matches
     self.score = align_c.score
 
+  @classmethod
+  def from_tuple(cls, align_tuple):
+    """Make an Align from a tuple returned by the _dunovo extension module."""
+    align = cls.__new__(cls)
+    (target, query, align.start_target, align.start_query, align.end_target, align.end_query,
+     align.matches, align.score) = align_tuple
+    align.target = str(target, 'utf8')
+    align.query = str(query, 'utf8')
+    return align
+
   # Provide this common function.
   def __str__(self):
     """Print a human-readable representation of the alignment."""
@@ -77,12 +91,56 @@ class Align(object):
     return output
 
 
+class Aligns(object):
+  """The results of aligning a batch of sequence pairs, stored by column.
+  Each attribute is a list with one value per pair: targets, queries, start_targets, start_queries,
+  end_targets, end_queries, matches, and scores (the same values as in Align).
+  Indexing or iterating gives Align objects."""
+  COLUMNS = ('targets', 'queries', 'start_targets', 'start_queries', 'end_targets', 'end_queries',
+             'matches', 'scores')
+  ATTRS = ('target', 'query', 'start_target', 'start_query', 'end_target', 'end_query', 'matches',
+           'score')
+
+  def __init__(self, *columns):
+    for name, column in zip(self.COLUMNS, columns):
+      setattr(self, name, column)
+
+  @classmethod
+  def from_aligns(cls, aligns):
+    return cls(*[[getattr(align, attr) for align in aligns] for attr in cls.ATTRS])
+
+  def __len__(self):
+    return len(self.scores)
+
+  def __getitem__(self, i):
+    align = Align.__new__(Align)
+    for name, attr in zip(self.COLUMNS, self.ATTRS):
+      setattr(align, attr, getattr(self, name)[i])
+    return align
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+
 # Initialize functions (define types).
 swalign.smith_waterman.restype = ctypes.POINTER(AlignC)
+swalign.smith_waterman_banded.restype = ctypes.POINTER(AlignC)
+swalign.smith_waterman_score.restype = ctypes.c_double
 swalign.revcomp.restype = ctypes.c_char_p
 
 
-def smith_waterman(target_raw, query_raw):
+def smith_waterman(target_raw, query_raw, band=None):
+  """Align query to target.
+  By default, this computes the full dynamic programming matrix. For sequences expected to be
+  similar, give a band to only compute the cells within that distance of the diagonal. Give 'auto'
+  to choose the band automatically, widening it until the alignment has the same score and end as
+  with the full matrix (checked like smith_waterman_score()) and doesn't run up against the band.
+  Rarely, unrelated sequences can still get a different, equally scoring path. A fixed band gives
+  the same result unless the best alignment strays outside it."""
+  band_c = get_band_c(band)
+  if _dunovo:
+    return Align.from_tuple(_dunovo.smith_waterman(target_raw, query_raw, band=band_c))
   if PY3:
     target_bytes = bytes(target_raw, 'utf8')
     query_bytes = bytes(query_raw, 'utf8')
@@ -90,21 +148,130 @@ def smith_waterman(target_raw, query_raw):
     target_bytes = bytes(target_raw)
     query_bytes = bytes(query_raw)
   seq_pair = SeqPairC(target_bytes, len(target_raw), query_bytes, len(query_raw))
-  align_c = swalign.smith_waterman(ctypes.pointer(seq_pair), 1).contents
-  return Align(align_c)
+  if band_c < 0:
+    align_p = swalign.smith_waterman(ctypes.pointer(seq_pair), 1)
+  else:
+    align_p = swalign.smith_waterman_banded(ctypes.pointer(seq_pair), 1, band_c)
+  align = Align(align_p.contents)
+  swalign.destroy_align(align_p)
+  return align
+
+
+def smith_waterman_score(target_raw, query_raw):
+  """Return the score smith_waterman() would give the alignment, without doing the traceback.
+  This is much faster, and only needs memory for one row of the matrix."""
+  if _dunovo:
+    return _dunovo.smith_waterman_score(target_raw, query_raw)
+  if PY3:
+    target_bytes = bytes(target_raw, 'utf8')
+    query_bytes = bytes(query_raw, 'utf8')
+  else:
+    target_bytes = target_raw
+    query_bytes = query_raw
+  seq_pair = SeqPairC(target_bytes, len(target_raw), query_bytes, len(query_raw))
+  return swalign.smith_waterman_score(ctypes.pointer(seq_pair))
 
 
-def smith_waterman_duplex(target, query):
+def smith_waterman_batch(targets, queries, band=None, threads=1):
+  """Align each query to the target at the same index. Returns an Aligns.
+  The whole batch is done in one call to the C code, which splits the pairs between "threads"
+  threads. band is as in smith_waterman()."""
+  check_batch(targets, queries, threads)
+  band_c = get_band_c(band)
+  if _dunovo:
+    columns = list(_dunovo.smith_waterman_batch(targets, queries, band=band_c, threads=threads))
+    columns[0] = [str(target, 'utf8') for target in columns[0]]
+    columns[1] = [str(query, 'utf8') for query in columns[1]]
+    return Aligns(*columns)
+  seq_pairs = make_seq_pairs(targets, queries)
+  aligns_c = (ctypes.POINTER(AlignC) * len(targets))()
+  swalign.smith_waterman_batch(seq_pairs, len(targets), 1, band_c, threads, aligns_c)
+  aligns = []
+  for align_p in aligns_c:
+    aligns.append(Align(align_p.contents))
+    swalign.destroy_align(align_p)
+  return Aligns.from_aligns(aligns)
+
+
+def smith_waterman_score_batch(targets, queries, threads=1):
+  """Return a list of the smith_waterman_score() of each query against the target at the same
+  index. Like smith_waterman_batch(), this is done in one call to the C code."""
+  check_batch(targets, queries, threads)
+  if _dunovo:
+    return _dunovo.smith_waterman_score_batch(targets, queries, threads=threads)
+  seq_pairs = make_seq_pairs(targets, queries)
+  scores = (ctypes.c_double * len(targets))()
+  swalign.smith_waterman_score_batch(seq_pairs, len(targets), threads, scores)
+  return list(scores)
+
+
+def check_batch(targets, queries, threads):
+  if len(targets) != len(queries):
+    raise ValueError('Got {} targets but {} queries.'.format(len(targets), len(queries)))
+  if threads <= 0:
+    raise ValueError('threads must be at least 1 (received {!r})'.format(threads))
+
+
+def make_seq_pairs(targets, queries):
+  """Make a ctypes array of SeqPairCs."""
+  seq_pairs = (SeqPairC * len(targets))()
+  for seq_pair, target, query in zip(seq_pairs, targets, queries):
+    if PY3:
+      seq_pair.a = bytes(target, 'utf8')
+      seq_pair.b = bytes(query, 'utf8')
+    else:
+      seq_pair.a = bytes(target)
+      seq_pair.b = bytes(query)
+    seq_pair.alen = len(target)
+    seq_pair.blen = len(query)
+  return seq_pairs
+
+
+def get_band_c(band):
+  """Convert a band argument to the value the C code takes: -1 for no band, or 0 for automatic."""
+  if band is None:
+    return -1
+  elif band == 'auto':
+    return 0
+  elif band > 0:
+    return band
+  else:
+    raise ValueError('band must be None, "auto", or a positive integer (received {!r})'.format(band))
+
+
+def smith_waterman_duplex(target, query, band=None):
   """Smith-Waterman align query to target in both orientations and return the best.
-  Convenience function that calls smith_waterman() twice, and returns the
-  alignment with the highest score."""
-  align = smith_waterman(target, query)
+  Convenience function that compares the scores of both orientations, and returns the alignment
+  with the highest score."""
   query_rc = revcomp(query)
-  align_rc = smith_waterman(target, query_rc)
-  if align_rc.score > align.score:
-    return align_rc
+  if band is not None:
+    # A banded alignment's score can differ from the full one's, so compare the banded ones.
+    align = smith_waterman(target, query, band=band)
+    align_rc = smith_waterman(target, query_rc, band=band)
+    if align_rc.score > align.score:
+      return align_rc
+    else:
+      return align
+  if smith_waterman_score(target, query_rc) > smith_waterman_score(target, query):
+    return smith_waterman(target, query_rc)
   else:
-    return align
+    return smith_waterman(target, query)
+
+
+def smith_waterman_duplex_batch(targets, queries, threads=1):
+  """Do smith_waterman_duplex() on each query and the target at the same index. Returns an Aligns.
+  The orientations are all scored in one batch, then the best ones are aligned in another."""
+  queries_rc = [revcomp(query) for query in queries]
+  scores = smith_waterman_score_batch(targets*2, queries+queries_rc, threads=threads)
+  fwd_scores = scores[:len(queries)]
+  rc_scores = scores[len(queries):]
+  best_queries = []
+  for query, query_rc, fwd_score, rc_score in zip(queries, queries_rc, fwd_scores, rc_scores):
+    if rc_score > fwd_score:
+      best_queries.append(query_rc)
+    else:
+      best_queries.append(query)
+  return smith_waterman_batch(targets, best_queries, threads=threads)
 
 
 def revcomp(seq):
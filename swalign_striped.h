@@ -0,0 +1,86 @@
+/* A template for the striped score-only kernel used by smith_waterman_score().
+ * swalign.c includes this once per instruction set, after defining:
+ *   FILL_ROWS: the name of the function to define
+ *   TARGET: the function attribute which enables the instruction set
+ *   LANES: the number of 16-bit scores in a vector
+ *   VEC: the vector type
+ *   VLOAD(p), VSTORE(p, v), VSET1(x), VZERO(): aligned loads and stores, and constants
+ *   VADDS(a, b), VMAX(a, b): saturating addition and maximum of signed 16-bit lanes
+ *   VANY_GT(a, b): whether any lane of a is greater than the same lane of b
+ *   VSHIFT(v): move every lane up one, shifting a 0 into the first
+ *   VFIRST(v): the value of the first lane
+ * See striped_t in swalign.h for the layout of the vectors.
+ */
+
+// Fill in rows first_i to last_i of the matrix, starting from row first_i-1 in st->h_prev.
+// Afterward, st->h_prev holds row last_i.
+TARGET static void FILL_ROWS(seq_pair_t *problem, striped_t *st, unsigned int first_i,
+                             unsigned int last_i, score_best_t *best) {
+  unsigned int seg_len = st->seg_len;
+  VEC *h_prev = (VEC *)st->h_prev;
+  VEC *h_cur = (VEC *)st->h_cur;
+  VEC *h_tmp;
+  VEC *gaps_v = (VEC *)st->gaps_v;
+  VEC v_gap_h = VSET1((int16_t)GAP);
+  VEC v_zero = VZERO();
+  int16_t lane_maxes[LANES] __attribute__((aligned(32)));
+  unsigned int i, s, k;
+
+  for (i = first_i; i <= last_i; i++) {
+    unsigned char c = problem->a[i-1];
+    VEC *profile = (VEC *)(st->profiles + (size_t)st->char_indices[c] * seg_len * LANES);
+    // The cell diagonal to the first cell of each lane is the last cell of the previous lane.
+    VEC v_h = VSHIFT(VLOAD(h_prev+seg_len-1));
+    VEC v_f = v_zero;
+    VEC v_max = v_zero;
+    // Compute each cell from the cells diagonal to it, above it, and (within each lane) to its left.
+    for (s = 0; s < seg_len; s++) {
+      v_h = VADDS(v_h, VLOAD(profile+s));
+      v_h = VMAX(v_h, VADDS(VLOAD(h_prev+s), VLOAD(gaps_v+s)));
+      v_h = VMAX(v_h, v_f);
+      v_h = VMAX(v_h, v_zero);
+      VSTORE(h_cur+s, v_h);
+      v_max = VMAX(v_max, v_h);
+      v_f = VADDS(v_h, v_gap_h);
+      v_h = VLOAD(h_prev+s);
+    }
+    // Carry horizontal gaps across the lanes, until they no longer raise any scores.
+    v_f = VSHIFT(v_f);
+    s = 0;
+    while (VANY_GT(v_f, VLOAD(h_cur+s))) {
+      v_h = VMAX(VLOAD(h_cur+s), v_f);
+      VSTORE(h_cur+s, v_h);
+      v_max = VMAX(v_max, v_h);
+      v_f = VADDS(v_h, v_gap_h);
+      s++;
+      if (s == seg_len) {
+        s = 0;
+        v_f = VSHIFT(v_f);
+      }
+    }
+    // Only find the maximum of the row when it could beat the best so far.
+    if (VANY_GT(v_max, VSET1((int16_t)best->score))) {
+      int row_max = 0;
+      VSTORE((VEC *)lane_maxes, v_max);
+      for (k = 0; k < LANES; k++) {
+        if (lane_maxes[k] > row_max) {
+          row_max = lane_maxes[k];
+        }
+      }
+      // Only whether the first cell with the maximum is in column 1 matters to update_best().
+      // If the exact column is needed, it's found later in the copy of the row.
+      int16_t first = VFIRST(VLOAD(h_cur));
+      unsigned int j = first == row_max ? 1 : 2;
+      update_best(problem, best, i, j, row_max, 0, VFIRST(VLOAD(h_prev)));
+      if (st->best_row && best->i == i) {
+        memcpy(st->best_row, h_cur, sizeof(VEC) * seg_len);
+      }
+    }
+    h_tmp = h_prev;
+    h_prev = h_cur;
+    h_cur = h_tmp;
+  }
+
+  st->h_prev = (int16_t *)h_prev;
+  st->h_cur = (int16_t *)h_cur;
+}
@@ -158,6 +158,7 @@ function inactive {
 function errstats {
   errstats_simple
   errstats_indels
+  errstats_p2
   errstats_overlap
 }
 
@@ -215,6 +216,57 @@ function align_p3 {
     | diff -s - "$dirname/families.msa.tsv"
 }
 
+# align-families.py sending the work to a dunovo-worker.py
+function align_worker {
+  echo -e "\t${FUNCNAME[0]}:\talign-families.py --worker ::: families.sort.tsv:"
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  socket="$dirname/worker.tmp.sock"
+  "${local_prefix}dunovo-worker.py" -q -p 2 "$socket" &
+  worker_pid=$!
+  # Wait for the worker to start listening.
+  for i in $(seq 50); do
+    if [[ -S "$socket" ]]; then break; fi
+    sleep 0.1
+  done
+  "${local_prefix}align-families.py" --no-check-ids -q --worker "$socket" \
+    "$dirname/families.sort.tsv" | diff -s - "$dirname/families.msa.tsv"
+  kill $worker_pid
+  wait $worker_pid 2>/dev/null
+  rm -f "$socket"
+}
+
+# align-families.py --async, which should give the same output as the default mode
+function align_async {
+  if ! which mafft >/dev/null 2>/dev/null; then
+    echo -e "\t${FUNCNAME[0]}:\tSkipping: mafft is not installed."
+    return
+  fi
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  # --async only works with mafft, and families.msa.tsv is aligned with the default (kalign), so
+  # compare against mafft's output without --async.
+  for input in families.sort.tsv smoke.families.tsv; do
+    echo -e "\t${FUNCNAME[0]}:\talign-families.py -a mafft --async 3 ::: $input:"
+    "${local_prefix}align-families.py" -a mafft --no-check-ids -q "$dirname/$input" \
+      > "$dirname/align.tmp.mafft.tsv"
+    "${local_prefix}align-families.py" -a mafft --async 3 --no-check-ids -q "$dirname/$input" \
+      | diff -s - "$dirname/align.tmp.mafft.tsv"
+  done
+  rm -f "$dirname/align.tmp.mafft.tsv"
+}
+
+# align-families.py --rejects
+function align_rejects {
+  echo -e "\t${FUNCNAME[0]}:\talign-families.py --rejects ::: families.sort.tsv:"
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  # The read names in families.sort.tsv don't match, so checking them fails on every duplex, and
+  # the whole input should end up in the rejects file.
+  rejects="$dirname/rejects.tmp.tsv"
+  "${local_prefix}align-families.py" -q -p 2 --max-retries 0 --rejects "$rejects" \
+    "$dirname/families.sort.tsv" | diff - /dev/null
+  diff -s "$rejects" "$dirname/families.sort.tsv"
+  rm -f "$rejects"
+}
+
 # align-families.py smoke test
 function align_smoke {
   echo -e "\t${FUNCNAME[0]}:\talign-families.py ::: smoke.families.tsv:"
@@ -223,6 +275,115 @@ function align_smoke {
     | diff -s - "$dirname/smoke.families.aligned.tsv"
 }
 
+# align-families.py --cache
+function align_cache {
+  echo -e "\t${FUNCNAME[0]}:\talign-families.py --cache ::: families.sort.tsv:"
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  cache="$dirname/cache.tmp.db"
+  stats="$dirname/family-stats.tmp.tsv"
+  rm -f "$cache" "$cache-wal" "$cache-shm"
+  # The second run should get every alignment from the cache, and give the same output.
+  for run in 1 2; do
+    "${local_prefix}align-families.py" --no-check-ids -q -p 2 --cache "$cache" \
+      --family-stats "$stats" "$dirname/families.sort.tsv" | diff -s - "$dirname/families.msa.tsv"
+  done
+  awk -F '\t' '$6 != "cache" && $6 != "none" {print "Error: Not from the cache: " $0}' "$stats"
+  # The cache should shrink to fit a smaller --cache-size.
+  # (The alignments of families.sort.tsv take up a few hundred bytes.)
+  "${local_prefix}align-families.py" --no-check-ids -q --cache "$cache" --cache-size 0.0001 \
+    "$dirname/families.sort.tsv" >/dev/null
+  python3 -c 'import sqlite3, sys
+size = sqlite3.connect(sys.argv[1]).execute("SELECT SUM(size) FROM alignments").fetchone()[0]
+if size > 0.0001*1024*1024:
+  print(f"Error: --cache is {size} bytes, over the --cache-size.")' "$cache"
+  rm -f "$cache" "$cache-wal" "$cache-shm" "$stats"
+}
+
+# align-families.py --family-stats and --slowest
+function align_stats {
+  echo -e "\t${FUNCNAME[0]}:\talign-families.py --family-stats --slowest ::: families.sort.tsv:"
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  stats="$dirname/family-stats.tmp.tsv"
+  log="$dirname/align.tmp.log"
+  # The dummy aligner makes the aligner column predictable. The times (column 7) aren't, so
+  # they're left out.
+  "${local_prefix}align-families.py" -a dummy --no-check-ids -p 2 --family-stats "$stats" \
+    --slowest 3 -L "$log" "$dirname/families.sort.tsv" >/dev/null
+  cut -f 1-6,8 "$stats" | sort | diff -s - "$dirname/families.family-stats.tsv"
+  "${local_prefix}align-families.py" -a dummy --no-check-ids -q --family-stats "$stats" \
+    --family-stats-format jsonl "$dirname/families.sort.tsv" >/dev/null
+  python3 -c 'import json, sys
+keys = ("barcode", "order", "mate", "reads", "read_len", "aligner", "success")
+for line in sys.stdin:
+  record = json.loads(line)
+  print("\t".join([str(record[key]) for key in keys]))' < "$stats" \
+    | sort | diff -s - "$dirname/families.family-stats.tsv"
+  # The summary: the number of families in each size bin, then the 3 slowest.
+  grep -A 3 '^Alignment time by family size:$' "$log" | tail -n +2 | cut -f 1,2 \
+    | diff - <(echo -e "  reads\tfamilies\n  1\t6\n  3-4\t8")
+  slowest=$(grep -A 3 '^Slowest 3 families:$' "$log" | tail -n +2 \
+    | grep -cE $'^  [ACGT]+\t(ab|ba)\t[12]\t[0-9]+ reads\t[0-9]+bp\t(dummy|none)\t[0-9.]+s$')
+  if [[ $slowest != 3 ]]; then
+    echo "Error: Expected 3 lines on the slowest families in the log. Found $slowest:"
+    cat "$log"
+  fi
+  rm -f "$stats" "$log"
+}
+
+# align-families.py --timeout, with a mafft that hangs and a --fallback to the dummy aligner
+function align_timeout {
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" align-families.py); then return 1; fi
+  fakebin="$dirname/fakebin.tmp"
+  stats="$dirname/family-stats.tmp.tsv"
+  cache="$dirname/cache.tmp.db"
+  mkdir -p "$fakebin"
+  # Like the real mafft, it's a script that runs the aligner as a child process. So the child has to
+  # be killed too, or it'll keep the output pipe open.
+  cat > "$fakebin/mafft" <<'EOF'
+#!/usr/bin/env bash
+if [[ $1 == --version ]]; then
+  echo 'v0 (hangs)' >&2
+  exit
+fi
+sleep 60 &
+echo $! >> "$(dirname "$0")/pids"
+wait
+EOF
+  chmod +x "$fakebin/mafft"
+  "${local_prefix}align-families.py" -a dummy --no-check-ids -q "$dirname/families.sort.tsv" \
+    > "$dirname/align.tmp.dummy.tsv"
+  for mode in "-p 2" "--async 2" "-p 2 --cache $cache" "-p 2 --cache $cache"; do
+    echo -e "\t${FUNCNAME[0]}:\talign-families.py -a mafft -t 0.5 -f dummy $mode ::: families.sort.tsv:"
+    # If the child isn't killed, each alignment takes a minute, so give up long before that.
+    PATH="$fakebin:$PATH" timeout 30 "${local_prefix}align-families.py" -a mafft --timeout 0.5 \
+      --fallback dummy $mode --no-check-ids -q --family-stats "$stats" \
+      "$dirname/families.sort.tsv" | diff -s - "$dirname/align.tmp.dummy.tsv"
+    # Every family which needed aligning should be recorded as aligned by the fallback (including
+    # on the second run with the --cache, since only the primary aligner's alignments are cached).
+    awk -F '\t' '$4 > 1 && $6 != "dummy" {print "Error: Wrong aligner recorded: " $0}' "$stats"
+    for pid in $(cat "$fakebin/pids"); do
+      # (A killed process can linger as a zombie if nothing reaps it.)
+      if ps -o stat= -p $pid | grep -qv '^Z'; then
+        echo "Error: mafft's child process $pid was left running."
+        kill $pid
+      fi
+    done
+    rm -f "$fakebin/pids"
+  done
+  rm -rf "$fakebin"
+  rm -f "$dirname/align.tmp.dummy.tsv" "$stats" "$cache" "$cache-wal" "$cache-shm"
+}
+
+# make-consensi.py --align, aligning the families and making the consensus sequences in one step
+function align_consensi {
+  _consensi families.sort.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
+            families.dcs_2.fa --align --no-check-ids --msa "$dirname/cons.tmp.msa.tsv"
+  diff -s "$dirname/cons.tmp.msa.tsv" "$dirname/families.msa.tsv"
+  rm -f "$dirname/cons.tmp.msa.tsv"
+  _consensi families.sort.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
+            families.dcs_2.fa --align --no-check-ids -p 3
+}
+
 # make-consensi.py defaults on toy data
 function consensi {
   _consensi families.msa.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
@@ -235,6 +396,12 @@ function consensi_p3 {
             families.dcs_2.fa -p 3
 }
 
+# make-consensi.py with 3 threads
+function consensi_threads {
+  _consensi families.msa.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
+            families.dcs_2.fa -t 3
+}
+
 # make-consensi.py quality score consideration
 function consensi_qual {
   _consensi qual.msa.tsv qual.10.sscs_1.fa qual.10.sscs_2.fa empty.txt empty.txt -q 10
@@ -263,6 +430,46 @@ function consensi_regression {
             --fastq-out 40
 }
 
+# make-consensi.py on families aligned with align-families.py --joint
+function consensi_joint {
+  _consensi joint.msa.tsv joint.sscs_1.fa joint.sscs_2.fa joint.dcs_1.fa joint.dcs_2.fa --joint
+}
+
+# make-consensi.py making the consensus sequences for several duplexes in one call
+function consensi_batch {
+  _consensi families.msa.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
+            families.dcs_2.fa --batch-size 4
+  _consensi gapqual.msa.tsv gapqual.sscs_1.fa gapqual.sscs_2.fa empty.txt empty.txt -q 25 \
+            --batch-size 2 -p 2
+}
+
+# make-consensi.py writing compressed output
+function consensi_compress {
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" make-consensi.py); then return 1; fi
+  for format in gzip bgzf; do
+    echo -e "\t${FUNCNAME[0]}:\tmake-consensi.py --compress $format ::: families.msa.tsv:"
+    "${local_prefix}make-consensi.py" --compress $format "$dirname/families.msa.tsv" \
+      --sscs1 "$dirname/cons.tmp.sscs_1.fa.gz" --dcs1 "$dirname/cons.tmp.dcs_1.fa.gz"
+    gunzip -c "$dirname/cons.tmp.sscs_1.fa.gz" | diff -s - "$dirname/families.sscs_1.fa"
+    gunzip -c "$dirname/cons.tmp.dcs_1.fa.gz" | diff -s - "$dirname/families.dcs_1.fa"
+    rm -f "$dirname/cons.tmp.sscs_1.fa.gz" "$dirname/cons.tmp.dcs_1.fa.gz"
+  done
+}
+
+# make-consensi.py --engine numpy (skipped if numpy isn't installed)
+function consensi_numpy {
+  if ! python3 -c 'import numpy' 2>/dev/null; then
+    echo -e "\t${FUNCNAME[0]}:\tSkipping: numpy is not installed."
+    return
+  fi
+  _consensi families.msa.tsv families.sscs_1.fa families.sscs_2.fa families.dcs_1.fa \
+            families.dcs_2.fa --engine numpy
+  _consensi gapqual.msa.tsv gapqual.sscs_1.fa gapqual.sscs_2.fa empty.txt empty.txt -q 25 \
+            --engine numpy --batch-size 2
+  _consensi varylen.msa.tsv varylen.sscs_1.fa varylen.sscs_2.fa varylen.dcs_1.fa varylen.dcs_2.fa \
+            --engine numpy -p 2
+}
+
 # variable-length reads
 # make-barcodes.awk
 function varylen_barcodes {
@@ -378,6 +585,17 @@ function errstats_indels {
 }
 
 
+# errstats.py with 2 processes
+function errstats_p2 {
+  echo -e "\t${FUNCNAME[0]}:\terrstats.py -p 2 ::: families.msa.tsv:"
+  if ! local_prefix=$(_get_local_prefix "$cmd_prefix" utils/errstats.py); then return 1; fi
+  "${local_prefix}errstats.py" -p 2 --mate1 "$dirname/families.msa.tsv" \
+    | diff -s "$dirname/errstats.out.tsv" -
+  "${local_prefix}errstats.py" -p 2 --alignment "$dirname/families.msa.tsv" \
+    | diff -s "$dirname/errstats.-a.out.tsv" -
+}
+
+
 # All tests below here are considered inactive.
 all_declarations_minus_inactive=$(declare -F)
 
@@ -397,6 +615,30 @@ function errstats_overlap {
   fi
 }
 
+# Long-running check that making consensus sequences doesn't leak memory.
+function consensus_soak {
+  echo -e "\t${FUNCNAME[0]}:\tconsensus.py ::: 2000000 consensus calls:"
+  PYTHONPATH="$dirname/.." python3 - <<'EOF'
+import os
+import consensus
+CALLS = 2000000
+def get_rss():
+  with open('/proc/self/statm') as statm:
+    return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+align = ['ACGT-ACGTACGTAC'*10, 'ACGTTACGTACGTAC'*10, 'ACGT-ACCTACGTAC'*10]
+quals = ['IIII IIIIIIIIII'*10, 'IIIIIIIII#IIIII'*10, 'IIII IIIIIIIIII'*10]
+for i in range(CALLS):
+  consensus.get_consensus(align, quals, qual_thres='.')
+  consensus.get_consensus_duplex(align, align, quals, quals, qual_thres='.')
+  if i == CALLS//10:
+    start_rss = get_rss()
+growth = get_rss() - start_rss
+print('\tRSS grew by {} bytes.'.format(growth))
+if growth > 1024*1024:
+  raise SystemExit('\tFAILED: Memory usage grew by over 1MB.')
+EOF
+}
+
 # utility function for all make-consensi.py tests
 function _consensi {
   # Read required arguments.
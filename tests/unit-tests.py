@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 import argparse
+import ctypes
 import logging
+import multiprocessing
 import os
+import random
+import signal
 import sys
+import tempfile
+import time
 import unittest
-# Add the utils directory to sys.path so we can import errstats.
+# Add the root and utils directories to sys.path so we can import the modules under test.
 script_path = os.path.realpath(__file__)
 root_dir = os.path.dirname(os.path.dirname(script_path))
+sys.path.append(root_dir)
 sys.path.append(os.path.join(root_dir, 'utils'))
+import consensus
 import errstats
+import msa_cache
+import parallel_tools
+import swalign
+try:
+  import consensus_numpy
+except ImportError:
+  consensus_numpy = None
 
 DESCRIPTION = """"""
 
@@ -94,7 +109,7 @@ class GetAlignmentErrorsTest(unittest.TestCase):
       self.assertEqual(errors, result)
     return test
 
-make_tests(GetAlignmentErrorsTest, suite=errstatsTests, data=(
+ALIGNMENT_ERRORS_DATA = (
     {'consensus':  'GATTACA', 'qual_thres':0, 'count_indels':True,
      'seq_align': ('GATTACA',
                    'GATTACA'), 'name':'NoErrors',
@@ -176,9 +191,517 @@ make_tests(GetAlignmentErrorsTest, suite=errstatsTests, data=(
                    'GATTACA'), 'name':'EndIns',
      'qual_align':('IIIIIII',
                    'IIIIII '), 'errors':[{'alt':'A', 'type':'ins', 'seq':1, 'coord':6, 'pass':False}]},
-  )
 )
 
+make_tests(GetAlignmentErrorsTest, suite=errstatsTests, data=ALIGNMENT_ERRORS_DATA)
+
+
+class GetAlignmentErrorsNumpyTest(unittest.TestCase):
+  """Check that the NumPy version of get_alignment_errors() gives the same errors, in the same order,
+  as the pure Python one."""
+  @classmethod
+  def make_test(cls, consensus=None, seq_align=None, qual_align=None, qual_thres=None,
+                count_indels=None, **kwargs):
+    def test(self):
+      if errstats.np is None:
+        self.skipTest('NumPy is not installed.')
+      quals = qual_align
+      if count_indels:
+        quals = [errstats.fill_in_gap_quals(qual) for qual in qual_align]
+      results = []
+      for function in errstats.get_alignment_errors_python, errstats.get_alignment_errors_numpy:
+        errors = function(consensus, seq_align, quals, qual_thres, count_indels=count_indels)
+        results.append([(e.type, e.seq, e.aln_coord, e.alt, e.passes) for e in errors])
+      self.assertEqual(results[0], results[1])
+    return test
+
+make_tests(GetAlignmentErrorsNumpyTest, suite=errstatsTests, data=ALIGNMENT_ERRORS_DATA)
+
+
+########## swalign.py ##########
+
+swalignTests = unittest.TestSuite()
+
+def get_swalign_paths():
+  """The ways swalign can reach the C code: the _dunovo extension module, if it's built, and
+  ctypes."""
+  if swalign._dunovo:
+    return ('_dunovo', swalign._dunovo), ('ctypes', None)
+  else:
+    return (('ctypes', None),)
+
+
+def make_similar_pairs(num_pairs, max_len, rate, seed=1):
+  """Make random pairs of sequences, where each query is its target with a proportion "rate" of the
+  bases substituted, deleted, or followed by a 1-3bp insertion."""
+  rand = random.Random(seed)
+  targets = []
+  queries = []
+  while len(targets) < num_pairs:
+    target = ''.join([rand.choice('ACGT') for i in range(rand.randint(1, max_len))])
+    query = ''
+    for base in target:
+      roll = rand.random()
+      if roll < rate/3:
+        query += rand.choice('ACGT')
+      elif roll < rate*2/3:
+        continue
+      elif roll < rate:
+        query += base + ''.join([rand.choice('ACGT') for i in range(rand.randint(1, 3))])
+      else:
+        query += base
+    if query:
+      targets.append(target)
+      queries.append(query)
+  return targets, queries
+
+
+def make_offset_pairs(num_pairs, max_len, seed=1):
+  """Make pairs of sequences which are different windows of the same random sequence: the query
+  starts 1 to half the target's length past the start of the target, so their best alignment is
+  off the main diagonal. Most are the same length as the target, but some are shorter or longer."""
+  rand = random.Random(seed)
+  targets = []
+  queries = []
+  for i in range(num_pairs):
+    length = rand.randint(2, max_len)
+    offset = rand.randint(1, length//2)
+    if i % 4 == 0:
+      query_len = rand.randint(1, max_len)
+    else:
+      query_len = length
+    seq = ''.join([rand.choice('ACGT') for j in range(offset+max(length, query_len))])
+    targets.append(seq[:length])
+    queries.append(seq[offset:offset+query_len])
+  return targets, queries
+
+
+def align_to_tuple(align):
+  return tuple([getattr(align, attr) for attr in swalign.Aligns.ATTRS])
+
+
+def tuple_results(function):
+  """Wrap an alignment function so its Align (or Aligns) are returned as tuples."""
+  def wrapper(*args, **kwargs):
+    result = function(*args, **kwargs)
+    if isinstance(result, swalign.Align):
+      return align_to_tuple(result)
+    else:
+      return [align_to_tuple(align) for align in result]
+  return wrapper
+
+
+class SmithWatermanBandedTest(unittest.TestCase):
+  """Check that banded alignments match the full matrix: with a fixed band for similar sequences,
+  and with an automatic band for those and for sequences which only overlap at an offset."""
+
+  def setUp(self):
+    self.dunovo = swalign._dunovo
+    self.similar = make_similar_pairs(500, 300, 0.1)
+    self.offset = make_offset_pairs(500, 300)
+
+  def tearDown(self):
+    swalign._dunovo = self.dunovo
+
+  def check_band(self, targets, queries, band):
+    for path, module in get_swalign_paths():
+      swalign._dunovo = module
+      for target, query in zip(targets, queries):
+        with self.subTest(path=path, target=target, query=query):
+          full = swalign.smith_waterman(target, query)
+          banded = swalign.smith_waterman(target, query, band=band)
+          self.assertEqual(align_to_tuple(full), align_to_tuple(banded))
+
+  def check_band_batch(self, targets, queries, band):
+    for path, module in get_swalign_paths():
+      swalign._dunovo = module
+      aligns = swalign.smith_waterman_batch(targets, queries, band=band)
+      for target, query, banded in zip(targets, queries, aligns):
+        with self.subTest(path=path, target=target, query=query):
+          full = swalign.smith_waterman(target, query)
+          self.assertEqual(align_to_tuple(full), align_to_tuple(banded))
+
+  def test_fixed_band(self):
+    self.check_band(*self.similar, band=40)
+
+  def test_auto_band(self):
+    self.check_band(*self.similar, band='auto')
+
+  def test_auto_band_offset(self):
+    self.check_band(*self.offset, band='auto')
+
+  def test_auto_band_batch(self):
+    self.check_band_batch(*self.similar, band='auto')
+
+  def test_auto_band_batch_offset(self):
+    self.check_band_batch(*self.offset, band='auto')
+
+swalignTests.addTest(unittest.TestLoader().loadTestsFromTestCase(SmithWatermanBandedTest))
+
+
+# The values of simd_level in swalign.c, indexed by name.
+SIMD_LEVELS = ('none', 'sse2', 'avx2')
+# As in swalign.h.
+MAX_SIMD_LEN = 16000
+
+def get_simd_levels():
+  """Return the simd_level variable in the C library (shared by ctypes and the _dunovo module),
+  and the names of the levels this CPU supports."""
+  simd_level = ctypes.c_int.in_dll(swalign.swalign, 'simd_level')
+  if simd_level.value < 0:
+    # It's detected on the first call.
+    swalign.smith_waterman_score('A', 'A')
+  return simd_level, SIMD_LEVELS[:simd_level.value+1]
+
+
+def make_random_pairs(num_pairs, min_len, max_len, seed=1):
+  rand = random.Random(seed)
+  targets = []
+  queries = []
+  for i in range(num_pairs):
+    for seqs in targets, queries:
+      length = rand.randint(min_len, max_len)
+      seqs.append(''.join([rand.choice('ACGT') for j in range(length)]))
+  return targets, queries
+
+
+class SmithWatermanScoreTest(unittest.TestCase):
+  """Check smith_waterman_score() against the score from the full smith_waterman(), through each
+  kernel: scalar (short queries or targets, or no SIMD), SSE2 (queries under MIN_AVX2_LEN), and
+  AVX2."""
+
+  def setUp(self):
+    self.dunovo = swalign._dunovo
+    self.simd_level, self.levels = get_simd_levels()
+    self.level_orig = self.simd_level.value
+
+  def tearDown(self):
+    swalign._dunovo = self.dunovo
+    self.simd_level.value = self.level_orig
+
+  def check_scores(self, targets, queries):
+    for path, module in get_swalign_paths():
+      swalign._dunovo = module
+      for level, level_name in enumerate(self.levels):
+        self.simd_level.value = level
+        for target, query in zip(targets, queries):
+          with self.subTest(path=path, simd=level_name, target=target, query=query):
+            expected = swalign.smith_waterman(target, query).score
+            self.assertEqual(swalign.smith_waterman_score(target, query), expected)
+
+  def test_tiny(self):
+    # Targets under 3bp or sequences under MIN_SIMD_LEN always use the scalar code.
+    self.check_scores(*make_random_pairs(200, 1, 20))
+
+  def test_sse2_lengths(self):
+    # Queries between MIN_SIMD_LEN and MIN_AVX2_LEN.
+    self.check_scores(*make_random_pairs(200, 16, 63))
+
+  def test_avx2_lengths(self):
+    self.check_scores(*make_random_pairs(100, 64, 400))
+
+  def test_uneven_lengths(self):
+    targets1, queries1 = make_random_pairs(50, 3, 30)
+    targets2, queries2 = make_random_pairs(50, 100, 300)
+    self.check_scores(targets1+targets2, queries2+queries1)
+
+  def test_similar(self):
+    # High-scoring alignments with gaps, which the striped kernels have to correct for.
+    self.check_scores(*make_similar_pairs(200, 200, 0.05))
+
+  def test_long(self):
+    """Sequences too long for the full matrix. Substitutions only, so the banded alignment is the
+    full one. MAX_SIMD_LEN is the longest the 16-bit kernels are trusted with, and past it the
+    scalar code has to take over or the scores would overflow."""
+    rand = random.Random(1)
+    for length in MAX_SIMD_LEN, MAX_SIMD_LEN+1:
+      target = ''.join([rand.choice('ACGT') for i in range(length)])
+      query = list(target)
+      for i in range(50, length, 1000):
+        query[i] = 'C' if query[i] == 'A' else 'A'
+      query = ''.join(query)
+      expected = swalign.smith_waterman(target, query, band=8).score
+      with self.subTest(length=length):
+        self.assertEqual(swalign.smith_waterman_score(target, query), expected)
+
+swalignTests.addTest(unittest.TestLoader().loadTestsFromTestCase(SmithWatermanScoreTest))
+
+
+class SmithWatermanBatchTest(unittest.TestCase):
+  """Check that the batch functions give the same results as aligning each pair on its own, with
+  any number of threads."""
+
+  THREADS = (1, 2, 3, 8)
+
+  def setUp(self):
+    self.dunovo = swalign._dunovo
+    targets1, queries1 = make_random_pairs(100, 1, 200)
+    targets2, queries2 = make_similar_pairs(100, 200, 0.05)
+    # Some reverse complements, for the duplex functions.
+    queries2[::2] = [swalign.revcomp(query) for query in queries2[::2]]
+    self.targets = targets1 + targets2
+    self.queries = queries1 + queries2
+
+  def tearDown(self):
+    swalign._dunovo = self.dunovo
+
+  def check_batch(self, batch_function, pair_function, **kwargs):
+    for path, module in get_swalign_paths():
+      swalign._dunovo = module
+      expected = []
+      for target, query in zip(self.targets, self.queries):
+        expected.append(pair_function(target, query, **kwargs))
+      for threads in self.THREADS:
+        with self.subTest(path=path, threads=threads):
+          results = batch_function(self.targets, self.queries, threads=threads, **kwargs)
+          self.assertEqual(list(results), expected)
+          # Fewer pairs than threads.
+          results = batch_function(self.targets[:2], self.queries[:2], threads=threads, **kwargs)
+          self.assertEqual(list(results), expected[:2])
+          self.assertEqual(list(batch_function([], [], threads=threads, **kwargs)), [])
+
+  def test_align(self):
+    self.check_batch(
+      tuple_results(swalign.smith_waterman_batch),
+      tuple_results(swalign.smith_waterman)
+    )
+
+  def test_align_banded(self):
+    self.check_batch(
+      tuple_results(swalign.smith_waterman_batch),
+      tuple_results(swalign.smith_waterman),
+      band='auto'
+    )
+
+  def test_score(self):
+    self.check_batch(swalign.smith_waterman_score_batch, swalign.smith_waterman_score)
+
+  def test_duplex(self):
+    self.check_batch(
+      tuple_results(swalign.smith_waterman_duplex_batch),
+      tuple_results(swalign.smith_waterman_duplex)
+    )
+
+swalignTests.addTest(unittest.TestLoader().loadTestsFromTestCase(SmithWatermanBatchTest))
+
+
+########## consensus_numpy.py ##########
+
+consensusNumpyTests = unittest.TestSuite()
+
+@unittest.skipIf(consensus_numpy is None, 'numpy is not installed')
+class GetConsensusesNumpyTest(unittest.TestCase):
+  """Check that consensus_numpy.get_consensuses() agrees with consensus.get_consensuses()."""
+
+  def check_consensuses(self, families, **kwargs):
+    expected = consensus.get_consensuses(families, **kwargs)
+    self.assertEqual(consensus_numpy.get_consensuses(families, **kwargs), expected)
+
+  def test_quals(self):
+    self.check_consensuses(
+      [(['ACGT', 'ACGA'], ['IIII', 'IIII']), (['AC-T', 'ACGT'], ['II I', 'IIII'])], qual_thres='5'
+    )
+
+  def test_empty_family_quals(self):
+    # An empty family has no quality scores, but shouldn't make the batch look mixed.
+    self.check_consensuses(
+      [([], []), (['ACGT', 'ACGA'], ['IIII', 'IIII']), ([''], ['']), (['AC-T'], ['II I'])],
+      qual_thres='5'
+    )
+
+  def test_empty_family_no_quals(self):
+    self.check_consensuses([(['ACGT', 'ACGA'], []), ([], [])])
+
+  def test_all_empty(self):
+    self.check_consensuses([([], []), ([], [])])
+
+  def test_mixed_quals(self):
+    with self.assertRaises(ValueError):
+      consensus_numpy.get_consensuses([(['ACGT'], ['IIII']), (['ACGT'], [])])
+
+consensusNumpyTests.addTest(unittest.TestLoader().loadTestsFromTestCase(GetConsensusesNumpyTest))
+
+
+########## msa_cache.py ##########
+
+msaCacheTests = unittest.TestSuite()
+
+class MsaCacheTest(unittest.TestCase):
+
+  ALIGNED = ['GATTACA-', 'GATT-CAT']
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmpdir.name, 'cache.db')
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def make_entries(self, cache, num, aligner_id='mafft v7'):
+    keys = []
+    for i in range(num):
+      key = cache.make_key(['GATTACA', 'GATTCAT', str(i)], aligner_id)
+      cache.put(key, self.ALIGNED)
+      keys.append(key)
+    return keys
+
+  def get_stored_size(self, cache):
+    return cache.conn.execute('SELECT COALESCE(SUM(size), 0) FROM alignments').fetchone()[0]
+
+  def test_hit(self):
+    cache = msa_cache.MsaCache(self.path)
+    key = self.make_entries(cache, 1)[0]
+    self.assertEqual(cache.get(key), self.ALIGNED)
+    # The same family, in another process.
+    cache2 = msa_cache.MsaCache(self.path)
+    self.assertEqual(cache2.get(cache2.make_key(['GATTACA', 'GATTCAT', '0'], 'mafft v7')),
+                     self.ALIGNED)
+
+  def test_miss_other_aligner(self):
+    cache = msa_cache.MsaCache(self.path)
+    self.make_entries(cache, 1, aligner_id='mafft v7')
+    self.assertIsNone(cache.get(cache.make_key(['GATTACA', 'GATTCAT', '0'], 'mafft v8')))
+    self.assertIsNone(cache.get(cache.make_key(['GATTACA', 'GATTCAT', '0'], 'kalign 2')))
+
+  def test_hit_no_write(self):
+    """A hit on a recently used entry shouldn't write to the database."""
+    cache = msa_cache.MsaCache(self.path)
+    key = self.make_entries(cache, 1)[0]
+    changes = cache.conn.total_changes
+    for i in range(msa_cache.ATIME_BATCH*2):
+      cache.get(key)
+    self.assertEqual(cache.conn.total_changes, changes)
+
+  def test_size_limit(self):
+    """The total size stays within max_size, even with several processes each inserting far
+    fewer entries than it takes to fill it."""
+    cache = msa_cache.MsaCache(self.path)
+    self.make_entries(cache, 1)
+    entry_size = self.get_stored_size(cache)
+    caches = [msa_cache.MsaCache(self.path, max_size=entry_size*10) for i in range(4)]
+    for i in range(8):
+      for j, cache in enumerate(caches):
+        key = cache.make_key(['GATTACA', 'GATTCAT', str(i), str(j)], 'mafft v7')
+        cache.put(key, self.ALIGNED)
+        self.assertLessEqual(self.get_stored_size(cache), entry_size*10)
+        self.assertEqual(cache.get_size(), self.get_stored_size(cache))
+
+  def test_evict_lru(self):
+    cache = msa_cache.MsaCache(self.path)
+    keys = self.make_entries(cache, 10)
+    entry_size = self.get_stored_size(cache) // 10
+    # Make them all old enough to have their access times updated, then use the first one.
+    cache.conn.execute('UPDATE alignments SET atime = atime - ?', (msa_cache.ATIME_RESOLUTION*2,))
+    cache.get(keys[0])
+    cache.max_size = entry_size*8
+    self.assertEqual(cache.evict(), 2)
+    self.assertEqual(cache.get(keys[0]), self.ALIGNED)
+    self.assertIsNone(cache.get(keys[1]))
+    self.assertIsNone(cache.get(keys[2]))
+    self.assertEqual(cache.get(keys[3]), self.ALIGNED)
+
+  def test_close_evicts(self):
+    cache = msa_cache.open_cache(self.path)
+    self.make_entries(cache, 10)
+    entry_size = self.get_stored_size(cache) // 10
+    cache.close()
+    self.assertNotIn(self.path, msa_cache.CACHES)
+    msa_cache.open_cache(self.path, max_size=entry_size*5).close()
+    cache = msa_cache.MsaCache(self.path)
+    self.assertEqual(cache.get_size(), entry_size*5)
+    self.assertEqual(self.get_stored_size(cache), entry_size*5)
+
+msaCacheTests.addTest(unittest.TestLoader().loadTestsFromTestCase(MsaCacheTest))
+
+
+########## parallel_tools.py ##########
+
+syncAsyncPoolTests = unittest.TestSuite()
+
+def exit_on(value, bad_value):
+  """Return value, or kill this worker if it's bad_value."""
+  if value == bad_value:
+    os._exit(1)
+  return value
+
+
+class SyncAsyncPoolTest(unittest.TestCase):
+  """Restarting the workers relies on private attributes of multiprocessing.Pool, so a Python which
+  changes them should make these fail (by timing out instead of hanging)."""
+
+  TIMEOUT = 60
+
+  def setUp(self):
+    self.results = []
+    self.rejects = []
+    signal.signal(signal.SIGALRM, self.timeout)
+    signal.alarm(self.TIMEOUT)
+
+  def tearDown(self):
+    signal.alarm(0)
+    # Don't leave any stuck workers behind if a test failed.
+    self.kill_workers()
+
+  def timeout(self, signum, frame):
+    raise TimeoutError('The pool got stuck.')
+
+  def make_pool(self, bad_value=None):
+    return parallel_tools.SyncAsyncPool(
+      exit_on, processes=2, static_args=(bad_value,), callback=self.results.append, chunksize=1,
+      max_retries=1, reject_callback=lambda args, error: self.rejects.append(args[0])
+    )
+
+  def run_tasks(self, pool, values):
+    for value in values:
+      pool.compute(value)
+    pool.flush()
+
+  def kill_workers(self):
+    for process in multiprocessing.active_children():
+      os.kill(process.pid, signal.SIGKILL)
+
+  def test_no_deaths(self):
+    pool = self.make_pool()
+    self.run_tasks(pool, range(20))
+    pool.close()
+    pool.join()
+    self.assertEqual(self.results, list(range(20)))
+    self.assertEqual(pool.generation, 0)
+
+  def test_worker_dies(self):
+    pool = self.make_pool(bad_value=5)
+    self.run_tasks(pool, range(20))
+    pool.close()
+    pool.join()
+    self.assertEqual(self.results, [value for value in range(20) if value != 5])
+    self.assertEqual(self.rejects, [5])
+
+  def test_task_queue_lock(self):
+    """Kill the workers while they're idle, so one of them dies holding the task queue lock."""
+    pool = self.make_pool()
+    self.run_tasks(pool, range(10))
+    time.sleep(0.2)
+    self.kill_workers()
+    self.run_tasks(pool, range(10, 20))
+    pool.close()
+    pool.join()
+    self.assertEqual(self.results, list(range(20)))
+    self.assertGreater(pool.generation, 0)
+
+  def test_result_queue_lock(self):
+    """Take the result queue lock, as if a worker had died while sending a result, then have a
+    worker die."""
+    pool = self.make_pool(bad_value=10)
+    self.run_tasks(pool, range(10))
+    pool.pool._outqueue._wlock.acquire()
+    self.run_tasks(pool, range(10, 20))
+    pool.close()
+    pool.join()
+    self.assertEqual(self.results, [value for value in range(20) if value != 10])
+    self.assertEqual(self.rejects, [10])
+
+syncAsyncPoolTests.addTest(unittest.TestLoader().loadTestsFromTestCase(SyncAsyncPoolTest))
+
 
 def fail(message):
   logging.critical(message)
@@ -0,0 +1,166 @@
+import zlib
+import queue
+import struct
+import threading
+
+# How much text to accumulate before handing it to the writer thread, in characters.
+BUFFER_SIZE = 4*1024*1024
+# How many buffers can be waiting on the writer thread before write() blocks.
+QUEUE_SIZE = 4
+# The most uncompressed data to put in one BGZF block (the same limit htslib uses). This keeps the
+# compressed block under the 64KB maximum, even for incompressible data.
+BGZF_BLOCK_SIZE = 0xff00
+# The empty block which marks the end of a BGZF file.
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+COMPRESSIONS = ('gzip', 'bgzf')
+
+
+class ThreadedWriter(object):
+  """A write-only text file which collects what's written to it into large buffers and hands them to
+  a background thread. The thread compresses them (if requested) and writes them to the underlying
+  binary file, so the caller only pays for appending to a list.
+  compression can be None, "gzip", or "bgzf" (the blocked gzip used by samtools and tabix). Both
+  produce output readable by gzip.
+  An error in the background thread is raised by the next call to write() or close()."""
+
+  def __init__(self, raw_file, compression=None, buffer_size=BUFFER_SIZE, level=6):
+    if compression == 'gzip':
+      self.compressor = GzipCompressor(level)
+    elif compression == 'bgzf':
+      self.compressor = BgzfCompressor(level)
+    elif compression is None:
+      self.compressor = None
+    else:
+      raise ValueError('compression must be None or one of {} (received {!r})'
+                       .format(', '.join(COMPRESSIONS), compression))
+    self.raw_file = raw_file
+    self.name = getattr(raw_file, 'name', None)
+    self.buffer_size = buffer_size
+    self.buffer = []
+    self.buffered = 0
+    self.closed = False
+    self.error = None
+    self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  @classmethod
+  def open(cls, path, compression=None, **kwargs):
+    return cls(open(path, 'wb'), compression=compression, **kwargs)
+
+  def write(self, text):
+    self._check_error()
+    if self.closed:
+      raise ValueError('I/O operation on closed file.')
+    self.buffer.append(text)
+    self.buffered += len(text)
+    if self.buffered >= self.buffer_size:
+      self._hand_off()
+    return len(text)
+
+  def flush(self):
+    """Hand the buffered text to the background thread. This doesn't wait for it to be written."""
+    self._check_error()
+    self._hand_off()
+
+  def close(self):
+    """Write everything that's left, finish the compressed stream, and close the underlying file."""
+    if self.closed:
+      return
+    self.closed = True
+    self._hand_off()
+    self.queue.put(None)
+    self.thread.join()
+    self.raw_file.close()
+    self._check_error()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception_info):
+    self.close()
+
+  def _hand_off(self):
+    if self.buffer:
+      self.queue.put(''.join(self.buffer))
+      self.buffer = []
+      self.buffered = 0
+
+  def _run(self):
+    while True:
+      chunk = self.queue.get()
+      # After an error, keep emptying the queue so the main thread never blocks on it.
+      if self.error is not None:
+        if chunk is None:
+          break
+        continue
+      try:
+        if chunk is None:
+          if self.compressor:
+            self.raw_file.write(self.compressor.flush())
+          self.raw_file.flush()
+          break
+        data = bytes(chunk, 'utf8')
+        if self.compressor:
+          data = self.compressor.compress(data)
+        self.raw_file.write(data)
+      except Exception as error:
+        self.error = error
+        if chunk is None:
+          break
+
+  def _check_error(self):
+    if self.error is not None:
+      raise self.error
+
+
+class GzipCompressor(object):
+  """Compress a stream into a single gzip member."""
+
+  def __init__(self, level):
+    # Adding 16 to the window bits gives a gzip header and trailer.
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+
+  def compress(self, data):
+    return self.compressor.compress(data)
+
+  def flush(self):
+    return self.compressor.flush()
+
+
+class BgzfCompressor(object):
+  """Compress a stream into BGZF: a series of independent gzip members of at most BGZF_BLOCK_SIZE
+  bytes of data each, with the block size recorded in a "BC" extra field, and an empty block at the
+  end."""
+
+  def __init__(self, level):
+    self.level = level
+    self.pending = b''
+
+  def compress(self, data):
+    data = self.pending + data
+    blocks = []
+    end = len(data) - len(data) % BGZF_BLOCK_SIZE
+    for start in range(0, end, BGZF_BLOCK_SIZE):
+      blocks.append(self.make_block(data[start:start+BGZF_BLOCK_SIZE]))
+    self.pending = data[end:]
+    return b''.join(blocks)
+
+  def flush(self):
+    blocks = []
+    if self.pending:
+      blocks.append(self.make_block(self.pending))
+      self.pending = b''
+    blocks.append(BGZF_EOF)
+    return b''.join(blocks)
+
+  def make_block(self, data):
+    # Negative window bits give raw deflate data, without a header.
+    compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    # The header: the gzip magic number, deflate method, FEXTRA flag, no mtime, unknown OS, and an
+    # extra field holding the total size of the block, minus 1.
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                         len(cdata)+25)
+    trailer = struct.pack('<2I', zlib.crc32(data), len(data))
+    return header + cdata + trailer
@@ -24,11 +24,16 @@ try:
   import pyBamParser.bam
 except ImportError:
   pass
+try:
+  import numpy as np
+except ImportError:
+  np = None
 from utillib import simplewrap
 from kalign import kalign
 import consensus as consensuslib
 import seqtools
 import swalign
+import parallel_tools
 PY3 = sys.version_info.major >= 3
 
 #TODO: Fix deduplication.
@@ -51,8 +56,16 @@ else:
   for from_char, to_char in zip(*trans_args):
     REVCOMP_TABLE_UNICODE[ord(from_char)] = ord(to_char)
 
-GAP_WIN_LEN = 4
 QUAL_OFFSET = 33 # Sanger
+if np is not None:
+  # Lookup table: is this (ascii) character an ambiguous base?
+  AMBIGUOUS_CODES = np.zeros(256, dtype=bool)
+  for base in AMBIGUOUS:
+    AMBIGUOUS_CODES[ord(base)] = True
+  GAP_CODE = ord('-')
+  # The states of an alignment cell, for get_alignment_errors_numpy().
+  DEL_STATE = 1
+  INS_STATE = 2
 
 
 class Alignment(object):
@@ -189,6 +202,11 @@ def make_argparser():
   parser.add_argument('-o', '--overlap-stats', type=argparse.FileType('w'),
     help=wrap('Write statistics on overlaps and errors in overlaps to this file. Warning: will '
          'overwrite any existing file.'))
+  parser.add_argument('-p', '--processes', default=0,
+    help=wrap('Number of worker subprocesses to count errors in. If 0, everything will be done '
+         'inside one process. Give "auto" to use as many processes as there are CPU cores. The '
+         'output is in the same order either way. With --dedup, only finding the errors is done '
+         'in parallel, not deduplicating them. Default: %(default)s'))
   parser.add_argument('-K', '--validate-kalign', action='store_true',
     help=wrap('When using --duplex, check that Kalign is returning aligned sequences in the same '
          'order they were given.'))
@@ -243,23 +261,30 @@ def main(argv):
   logging.info('Calculating consensus sequences and counting errors..')
   counts = {'ss_families':0, 'ds_families':0}
   family_stats = collections.defaultdict(lambda: {'ab':[{}, {}], 'ba':[{}, {}]})
-  for align_stats, barcode, order, mate in get_family_stats(
-      parse_families(args.input),
-      include_stats,
-      args.duplex,
-      args.qual_thres,
-      args.indels,
-      args.validate_kalign,
-      error_qual_thres,
-      counts,
-  ):
-    if args.dedup:
-      family_stats[barcode][order][mate] = align_stats
-    else:
-      if align_stats['num_seqs'] >= args.min_reads:
-        print_errors(
-          args.human, barcode, order, mate+args.mate_offset, align_stats, var_columns, columns
-        )
+  # The pool hands the results back in the same order as the input, so the output is the same no
+  # matter how many --processes there are.
+  pool = parallel_tools.SyncAsyncPool(
+    process_family,
+    processes=args.processes,
+    static_kwargs={
+      'include_stats': include_stats,
+      'duplex': args.duplex,
+      'qual_thres': args.qual_thres,
+      'count_indels': args.indels,
+      'validate_kalign': args.validate_kalign,
+      'error_qual_thres': error_qual_thres,
+    },
+    callback=process_result,
+    callback_args=[args, columns, var_columns, counts, family_stats],
+  )
+  try:
+    for family in parse_families(args.input):
+      pool.compute(family)
+    pool.flush()
+  finally:
+    # If the main process stops without telling the workers, it will hang.
+    pool.close()
+    pool.join()
 
   total = sum(counts.values())
   logging.info('Processed {} families: {:0.2f}% single-stranded, {:0.2f}% double-stranded.'
@@ -363,43 +388,58 @@ def parse_families(infile):
   yield family
 
 
-def get_family_stats(
-  families,
+def process_family(
+  family,
   include_stats,
   duplex=False,
   qual_thres=0,
   count_indels=False,
   validate_kalign=False,
   error_qual_thres=0,
-  counts=None,
 ):
-  for family in families:
-    # Calculate the consensus sequences for the family and add them to it.
-    add_consensi(family, qual_thres)
-    # Count whether the family contains both strands.
-    # If it does, and we're doing --duplex, get the duplex consensus and realign the reads to it.
-    # Then replace both single-stranded alignments with the duplex one.
-    if is_double_stranded(family):
-      if counts:
-        counts['ds_families'] += 1
-      if duplex:
-        transform_to_duplex_family(family, validate=validate_kalign)
-    else:
-      if counts:
-        counts['ss_families'] += 1
-      if duplex:
+  """Find the errors in all the alignments in one family.
+  Returns the key in the counts dict for the type of family ('ss_families' or 'ds_families') and a
+  list of (align_stats, barcode, order, mate) tuples, one per alignment."""
+  results = []
+  # Calculate the consensus sequences for the family and add them to it.
+  add_consensi(family, qual_thres)
+  # Count whether the family contains both strands.
+  # If it does, and we're doing --duplex, get the duplex consensus and realign the reads to it.
+  # Then replace both single-stranded alignments with the duplex one.
+  if is_double_stranded(family):
+    family_type = 'ds_families'
+    if duplex:
+      transform_to_duplex_family(family, validate=validate_kalign)
+  else:
+    family_type = 'ss_families'
+    if duplex:
+      return family_type, results
+  # Main loop: Compare raw reads to consensi and find errors.
+  for order in 'ab', 'ba':
+    for mate in 0, 1:
+      if duplex and order == 'ba':
+        # Since ab.1 == ba.2 and ab.2 == ba.1 in duplex families, only process ab.
+        # This also means the mate value will still be accurate, meaning the duplex mate.
         continue
-    # Main loop: Compare raw reads to consensi and find errors.
-    for order in 'ab', 'ba':
-      for mate in 0, 1:
-        if duplex and order == 'ba':
-          # Since ab.1 == ba.2 and ab.2 == ba.1 in duplex families, only process ab.
-          # This also means the mate value will still be accurate, meaning the duplex mate.
-          continue
-        alignment = family[order][mate]
-        align_stats = get_align_stats(alignment, include_stats, count_indels, error_qual_thres)
-        yield align_stats, family['bar'], order, mate
-      #TODO: Deduplicate overlap errors here(?), using raw read alignments.
+      alignment = family[order][mate]
+      align_stats = get_align_stats(alignment, include_stats, count_indels, error_qual_thres)
+      results.append((align_stats, family['bar'], order, mate))
+    #TODO: Deduplicate overlap errors here(?), using raw read alignments.
+  return family_type, results
+
+
+def process_result(result, args, columns, var_columns, counts, family_stats):
+  """Tally and print (or, with --dedup, store) the results of process_family(), back in the main
+  process."""
+  family_type, results = result
+  counts[family_type] += 1
+  for align_stats, barcode, order, mate in results:
+    if args.dedup:
+      family_stats[barcode][order][mate] = align_stats
+    elif align_stats['num_seqs'] >= args.min_reads:
+      print_errors(
+        args.human, barcode, order, mate+args.mate_offset, align_stats, var_columns, columns
+      )
 
 
 def get_align_stats(alignment, include, count_indels=False, error_qual_thres=0):
@@ -444,11 +484,16 @@ def add_consensi(family, qual_thres):
 
 
 def get_duplex_consensi(family):
-  consensi = []
+  # Align both pairs of single-strand consensi in one call.
+  targets = []
+  queries = []
   for (order1, mate1), (order2, mate2) in (('ab', 0), ('ba', 1)), (('ab', 1), ('ba', 0)):
-    result = swalign.smith_waterman(family[order1][mate1].consensus.replace('-', ''),
-                                    family[order2][mate2].consensus.replace('-', ''))
-    consensi.append(consensuslib.build_consensus_duplex_simple(result.query, result.target))
+    targets.append(family[order1][mate1].consensus.replace('-', ''))
+    queries.append(family[order2][mate2].consensus.replace('-', ''))
+  results = swalign.smith_waterman_batch(targets, queries)
+  consensi = []
+  for query, target in zip(results.queries, results.targets):
+    consensi.append(consensuslib.build_consensus_duplex_simple(query, target))
   return consensi
 
 
@@ -593,11 +638,84 @@ def get_alignment_errors(consensus, seq_align, qual_align, qual_thres, count_ind
   """Determine errors in sequences in an alignment by comparing to a consensus.
   Uses VCF notation for indels: coordinate is that of the base before the indel starts.
   Can't handle complex mutants. Sees them as consecutive SNVs.
-  Can handle ambiguous bases in the consensus, but not the alignment."""
+  Can handle ambiguous bases in the consensus, but not the alignment.
+  Uses get_alignment_errors_numpy() if NumPy is available, otherwise
+  get_alignment_errors_python(). They give the same results."""
+  if count_indels:
+    qual_align = consensuslib.fill_gap_quals(qual_align)
+  if np is not None:
+    errors = get_alignment_errors_numpy(consensus, seq_align, qual_align, qual_thres,
+                                        count_indels=count_indels)
+    if errors is not None:
+      return errors
+  return get_alignment_errors_python(consensus, seq_align, qual_align, qual_thres,
+                                     count_indels=count_indels)
+
+
+def get_alignment_errors_numpy(consensus, seq_align, qual_align, qual_thres, count_indels=False):
+  """Vectorized get_alignment_errors(), which finds the errors with array operations over the whole
+  alignment instead of stepping through each base. The gaps in qual_align must already be filled in
+  (if count_indels).
+  Returns None if the alignment has non-ASCII characters (so it can't be made into an array)."""
+  # Like the zip()s in get_alignment_errors_python(), only look at the columns covered by every
+  # sequence, quality string, and the consensus, and the rows with both a sequence and qualities.
+  num_seqs = min(len(seq_align), len(qual_align))
+  if num_seqs == 0:
+    return []
+  width = min(len(consensus), min(map(len, seq_align)), min(map(len, qual_align)))
+  try:
+    cons = np.frombuffer(bytes(consensus[:width], 'ascii'), dtype=np.uint8)
+    seqs = np.frombuffer(bytes(''.join([seq[:width] for seq in seq_align[:num_seqs]]), 'ascii'),
+                         dtype=np.uint8).reshape(num_seqs, width)
+    quals = np.frombuffer(bytes(''.join([qual[:width] for qual in qual_align[:num_seqs]]), 'ascii'),
+                          dtype=np.uint8).reshape(num_seqs, width)
+  except UnicodeEncodeError:
+    return None
+  # Which cells don't match the consensus (with enough quality to say so).
+  mismatches = ((seqs != cons) & (quals.astype(np.int16) > qual_thres+QUAL_OFFSET)
+                & ~AMBIGUOUS_CODES[cons])
+  snvs = mismatches & (seqs != GAP_CODE) & (cons != GAP_CODE)
+  # Each error is sorted by the (column, sequence, 0 or 1) where get_alignment_errors_python() would
+  # add it to the list, so they come out in the same order.
+  snv_rows, snv_cols = np.nonzero(snvs)
+  sort_cols = [snv_cols]
+  sort_rows = [snv_rows]
+  sort_subs = [np.ones(len(snv_cols), dtype=np.int8)]
+  errors = [Error(type='SNV', seq=int(row), aln_coord=int(col)+1, alt=seq_align[row][col])
+            for row, col in zip(snv_rows.tolist(), snv_cols.tolist())]
+  if count_indels:
+    # Find the runs of consecutive deletion or insertion cells in each row.
+    states = np.zeros((num_seqs, width+2), dtype=np.int8)
+    states[:, 1:-1][mismatches & (seqs == GAP_CODE)] = DEL_STATE
+    states[:, 1:-1][mismatches & (cons == GAP_CODE) & (seqs != GAP_CODE)] = INS_STATE
+    changes = states[:, 1:] != states[:, :-1]
+    start_rows, starts = np.nonzero(changes & (states[:, 1:] != 0))
+    end_rows, ends = np.nonzero(changes & (states[:, :-1] != 0))
+    types = states[start_rows, starts+1]
+    # An indel is added when the column after it is reached (or at the end, for the last column).
+    sort_cols.append(ends)
+    sort_rows.append(start_rows)
+    sort_subs.append(np.zeros(len(starts), dtype=np.int8))
+    for row, start, end, state in zip(start_rows.tolist(), starts.tolist(), ends.tolist(),
+                                      types.tolist()):
+      if state == DEL_STATE:
+        error = Error(type='del', seq=row, aln_coord=start, alt=end-start)
+      else:
+        error = Error(type='ins', seq=row, aln_coord=start, alt=seq_align[row][start:end])
+      # Omit indels at the ends of reads (see get_alignment_errors_python()).
+      if end == len(seq_align[row]):
+        error.passes = False
+      errors.append(error)
+  order = np.lexsort((np.concatenate(sort_subs), np.concatenate(sort_rows),
+                      np.concatenate(sort_cols)))
+  return [errors[i] for i in order]
+
+
+def get_alignment_errors_python(consensus, seq_align, qual_align, qual_thres, count_indels=False):
+  """Pure Python get_alignment_errors(). The gaps in qual_align must already be filled in (if
+  count_indels)."""
   qual_thres_char = chr(qual_thres+QUAL_OFFSET)
   num_seqs = len(seq_align)
-  if count_indels:
-    qual_align = [fill_in_gap_quals(quals) for quals in qual_align]
   errors = []
   last_bases = [None] * num_seqs
   running_indels = [None] * num_seqs
@@ -671,62 +789,11 @@ def get_alignment_errors(consensus, seq_align, qual_align, qual_thres, count_ind
 
 
 def fill_in_gap_quals(quals):
-  """Replace the spaces (' ') in quality scores with gap quality scores."""
-  new_quals = ''
-  i = 0
-  while i < len(quals):
-    if quals[i] == ' ':
-      qual_score = get_gap_quality_score(quals, i+1)
-      if qual_score is None:
-        raise ValueError('No gap quality score could be obtained for {!r}.'.format(quals))
-      qual = chr(qual_score+QUAL_OFFSET)
-      while i < len(quals) and quals[i] == ' ':
-        i += 1
-        new_quals += qual
-    else:
-      new_quals += quals[i]
-      i += 1
-  return new_quals
-
-
-def get_gap_quality_score(quals, indel_coord):
-  """Calculate what should be considered the quality score of the indel.
-  Currently, this is just the simple average of the quality scores of the two bases bookending the
-  indel.
-  This should give the same results as the algorithm in `get_gap_qual()` of consensus.c.
-  `quals` is the quality scores. Gaps should be indicated by a space character.
-  `indel_coord` is any (1-based) coordinate inside the indel (any position where there's a '-')."""
-  left_i = right_i = indel_coord-1
-  while left_i > 0 and quals[left_i] == ' ':
-    left_i -= 1
-  while right_i < len(quals)-1 and quals[right_i] == ' ':
-    right_i += 1
-  score_sum = 0
-  weight_sum = 0
-  left_weight = right_weight = GAP_WIN_LEN
-  scores = []
-  weights = []
-  while not (left_i < 0 or left_weight <= 0) or not (right_i >= len(quals) or right_weight <= 0):
-    if left_i >= 0 and left_weight > 0:
-      if quals[left_i] != ' ':
-        scores.insert(0, ord(quals[left_i]))
-        weights.insert(0, left_weight)
-        score_sum += left_weight * ord(quals[left_i])
-        weight_sum += left_weight
-        left_weight -= 1
-      left_i -= 1
-    if right_i < len(quals) and right_weight > 0:
-      if quals[right_i] != ' ':
-        scores.append(ord(quals[right_i]))
-        weights.append(right_weight)
-        score_sum += right_weight * ord(quals[right_i])
-        weight_sum += right_weight
-        right_weight -= 1
-      right_i += 1
-  if weight_sum > 0:
-    return int(round(score_sum/weight_sum)) - QUAL_OFFSET
-  else:
-    return None
+  """Replace the spaces (' ') in quality scores with gap quality scores.
+  The score of a gap is a weighted average of the scores of the 4 bases on either side of it, as
+  computed by `fill_gap_quals_buf()` in consensus.c. To do a whole alignment at once, use
+  `consensuslib.fill_gap_quals()`."""
+  return consensuslib.fill_gap_quals([quals])[0]
 
 
 def group_errors(errors):
@@ -14,7 +14,7 @@ from bfx import getreads
 CANON = 'ACGT-'
 
 WGSIM_ID_REGEX = r'^(.+)_\d+_\d+_\d+:\d+:\d+_\d+:\d+:\d+_([0-9a-f]+)/[12]$'
-ARG_DEFAULTS = {'print_stats':True}
+ARG_DEFAULTS = {'print_stats':True, 'batch_size':1000, 'threads':1}
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Correlate (labeled) reads from duplex pipeline with truth from simulator input,
 and print the number of errors."""
@@ -37,17 +37,33 @@ def main(argv):
     help='Print the alignments of each read with each fragment. Mostly for debug purposes.')
   parser.add_argument('-S', '--no-stats', dest='print_stats', action='store_false',
     help='Don\'t print the normal output of statistics on differences.')
+  parser.add_argument('-b', '--batch-size', type=int,
+    help='Align this many reads to their fragments at a time. Default: %(default)s')
+  parser.add_argument('-t', '--threads', type=int,
+    help='Number of threads to use for each batch of alignments. Default: %(default)s')
 
   args = parser.parse_args(argv[1:])
 
-  reads = iter(args.reads)
-  frags = iter(args.frags)
-  while True:
-    # Read in the next output read.
-    try:
-      read_line = next(reads)
-    except StopIteration:
-      break
+  if args.batch_size <= 0:
+    fail('Error: --batch-size must be greater than 0.')
+  if args.threads <= 0:
+    fail('Error: --threads must be greater than 0.')
+
+  pairs = pair_reads_with_frags(args.reads, args.frags)
+  for batch in get_batches(pairs, args.batch_size):
+    # Align each output read to its fragment.
+    aligns = swalign.smith_waterman_duplex_batch([frag.seq for read, frag in batch],
+                                                 [read['seq'] for read, frag in batch],
+                                                 threads=args.threads)
+    for (read, frag), align in zip(batch, aligns):
+      print_read_stats(read, align, args.print_alignments, args.print_stats,
+                       args.ignore_ambiguous)
+
+
+def pair_reads_with_frags(reads, frags):
+  """Yield a (read, fragment) tuple for each output read."""
+  frags = iter(frags)
+  for read_line in reads:
     fields = read_line.rstrip('\r\n').split('\t')
     assert len(fields) == 7, fields
     read = dict(zip(('chrom', 'frag_num', 'frag_id', 'bar', 'reads+', 'reads-', 'seq'), fields))
@@ -66,29 +82,42 @@ def main(argv):
       else:
         sys.stderr.write('Invalid wgsim read name: {}\n'.format(frag.id))
     if frag_chrom is None and frag_frag_id is None:
-      break
-    # Align the output read to the fragment.
-    align = swalign.smith_waterman_duplex(frag.seq, read['seq'])
-    assert len(align.target) == len(align.query)
-    if args.print_alignments:
-      print(align.target)
-    diffs = get_diffs(align.target, align.query, print_mid=args.print_alignments,
-                      ignore_ambig=args.ignore_ambiguous)
-    if args.print_alignments:
-      print(align.query)
-    read_len = len(read['seq'])
-    snvs = ins = dels = 0
-    for diff in diffs:
-      if diff['type'] == 'snv':
-        snvs += 1
-      elif diff['type'] == 'ins':
-        ins += 1
-      elif diff['type'] == 'del':
-        dels += 1
-    match_rate = round(align.matches/read_len, 2)
-    if args.print_stats:
-      print(read['bar'], read['frag_id'], read['reads+'], read['reads-'], read_len,
-            read_len-align.matches, match_rate, len(diffs), snvs, ins, dels, sep='\t')
+      return
+    yield read, frag
+
+
+def get_batches(items, batch_size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def print_read_stats(read, align, print_alignments=False, print_stats=True, ignore_ambig=False):
+  assert len(align.target) == len(align.query)
+  if print_alignments:
+    print(align.target)
+  diffs = get_diffs(align.target, align.query, print_mid=print_alignments,
+                    ignore_ambig=ignore_ambig)
+  if print_alignments:
+    print(align.query)
+  read_len = len(read['seq'])
+  snvs = ins = dels = 0
+  for diff in diffs:
+    if diff['type'] == 'snv':
+      snvs += 1
+    elif diff['type'] == 'ins':
+      ins += 1
+    elif diff['type'] == 'del':
+      dels += 1
+  match_rate = round(align.matches/read_len, 2)
+  if print_stats:
+    print(read['bar'], read['frag_id'], read['reads+'], read['reads-'], read_len,
+          read_len-align.matches, match_rate, len(diffs), snvs, ins, dels, sep='\t')
 
 
 def get_diffs(target, query, print_mid=False, ignore_ambig=False):
@@ -110,11 +110,14 @@ def get_strand(seq, probes, thres):
   If the votes that were cast are unanimous for one direction, that strand is returned.
   Else, return None."""
   votes = []
-  for probe in probes:
-    alignment = swalign.smith_waterman(seq, probe)
-    sense_id = alignment.matches/len(probe)
-    alignment = swalign.smith_waterman(seq, seqtools.get_revcomp(probe))
-    anti_id  = alignment.matches/len(probe)
+  # Align all the probes, in both directions, in one batch.
+  probes_rc = [seqtools.get_revcomp(probe) for probe in probes]
+  alignments = swalign.smith_waterman_batch([seq]*len(probes)*2, probes+probes_rc)
+  sense_matches = alignments.matches[:len(probes)]
+  anti_matches = alignments.matches[len(probes):]
+  for probe, sense_match, anti_match in zip(probes, sense_matches, anti_matches):
+    sense_id = sense_match/len(probe)
+    anti_id  = anti_match/len(probe)
     # print '{}: sense: {}, anti: {}'.format(probe, sense_id, anti_id)
     if sense_id > thres or anti_id > thres:
       if sense_id > anti_id: